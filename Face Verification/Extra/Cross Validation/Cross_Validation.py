@@ -7,12 +7,14 @@ import solution_basic
 
 
 def inspect_final_data_set_without_labels(image_index_list, seed):
-    np.random.seed(seed)
     image_index_array = np.array(image_index_list)
 
     # Cross Validation
     fold_num = 5
-    label_kfold = KFold(image_index_array.size, n_folds=fold_num, shuffle=True)
+    label_kfold = KFold(image_index_array.size,
+                        n_folds=fold_num,
+                        shuffle=True,
+                        random_state=seed)
 
     true_records_num_list = []
     false_records_num_list = []
@@ -33,14 +35,14 @@ def inspect_final_data_set_without_labels(image_index_list, seed):
 
 
 def inspect_final_data_set_with_labels(image_index_list, seed):
-    np.random.seed(seed)
+    random_state = np.random.RandomState(seed)
 
     # Cross Validation
     fold_num = 5
     unique_label_values = np.unique(image_index_list)
-    selected_label_values = np.random.choice(unique_label_values, \
-                                             size=np.ceil(unique_label_values.size * (fold_num - 1) / fold_num), \
-                                             replace=False)
+    selected_label_values = random_state.choice(unique_label_values, \
+                                                size=int(np.ceil(1.0 * unique_label_values.size * (fold_num - 1) / fold_num)), \
+                                                replace=False)
 
     selected_index_list = []
     for single_image_index in image_index_list:
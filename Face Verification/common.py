@@ -1,8 +1,15 @@
+import contextlib
 import numpy as np
 import os
 import pandas as pd
 import shutil
 
+# threadpoolctl is optional, it limits the threads of the numerical libraries which are already loaded
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
 # The path of the folder where the scripts are saved
 SCRIPTS_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
 
@@ -13,6 +20,24 @@ TESTING_DATASET_NAME = "test"
 TESTING_FILE_NAME = "pairs.csv"
 BBOX_EXTENSION = "_bbox.csv"
 
+# The file name of the manifest which caches the image paths. This file is saved at DATA_PATH.
+MANIFEST_FILE_NAME = "manifest.json"
+
+# The path of the folder where the feature stores are saved
+FEATURE_STORE_FOLDER_PATH = os.path.join(DATA_PATH, "feature_store")
+
+# The path of the folder where the gallery indexes are saved
+GALLERY_INDEX_FOLDER_PATH = os.path.join(DATA_PATH, "gallery_index")
+
+# The path of the folder where the sampled pairs are saved
+PAIR_MANIFEST_FOLDER_PATH = os.path.join(DATA_PATH, "pair_manifest")
+
+# The path of the folder where the final data sets of the folds are cached
+PAIR_FEATURE_CACHE_FOLDER_PATH = os.path.join(DATA_PATH, "pair_feature_cache")
+
+# The maximum total size of the cached final data sets in bytes
+PAIR_FEATURE_CACHE_MAX_SIZE = 8 * 1024**3
+
 # The size of facial images
 FACIAL_IMAGE_SIZE = 300
 
@@ -25,9 +50,21 @@ MODEL_DEFINITION_FILE_NAME = "VGG_FACE_deploy.prototxt"
 TRAINED_MODEL_FILE_NAME = "VGG_FACE.caffemodel"
 VGG_FACE_IMAGE_SIZE = 224
 
+# The execution mode of each feature extractor, either "gpu" or "cpu"
+FEATURE_EXTRACTOR_MODE_DICT = {"open_face": "gpu", "vgg_face": "gpu"}
+
+# The number of threads of each feature extractor, None means the default of the backend.
+# The limit only applies while the backend of the feature extractor is initiated or running.
+FEATURE_EXTRACTOR_THREAD_NUM_DICT = {"open_face": None, "vgg_face": None}
+
 # Variables related to congealingcomplex
 CONGEALINGCOMPLEX_PATH = "/opt/congealingcomplex"
 
+# The environment variables which control the number of threads of the numerical libraries
+THREAD_NUM_VARIABLE_NAME_LIST = [
+    "OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"
+]
+
 # Variables related to Keras and scikit-learn models
 KERAS_MODEL_EXTENSION = ".hdf5"
 SCIKIT_LEARN_EXTENSION = ".pkl"
@@ -38,6 +75,9 @@ SUBMISSIONS_FOLDER_PATH = os.path.join(SCRIPTS_FOLDER_PATH, "Submissions")
 # The file name of the GroundTruth. This file is saved at SUBMISSIONS_FOLDER_PATH.
 GROUNDTRUTH_FILE_NAME = "GroundTruth.csv"
 
+# The file name of the cached scores of the submission files. This file is saved at SUBMISSIONS_FOLDER_PATH.
+EVALUATION_CACHE_FILE_NAME = "evaluation_cache.json"
+
 
 def read_from_file(file_path):
     file_content = pd.read_csv(file_path, delimiter=",", engine="c", header=None, \
@@ -49,6 +89,61 @@ def write_to_file(file_path, file_content):
     pd.Series(file_content).to_csv(file_path, header=False, index=False)
 
 
+def limit_thread_num(thread_num):
+    """Limit the number of threads used by the numerical libraries.
+    The environment variables only take effect on the libraries which are loaded afterwards, including child processes,
+    so the libraries which are already loaded are limited with threadpoolctl if it is available.
+    
+    :param thread_num: the number of threads
+    :type thread_num: int
+    :return: the environment variables will be updated
+    :rtype: None
+    """
+
+    for variable_name in THREAD_NUM_VARIABLE_NAME_LIST:
+        os.environ[variable_name] = str(thread_num)
+
+    if threadpool_limits is not None:
+        threadpool_limits(limits=thread_num)
+
+
+@contextlib.contextmanager
+def limit_thread_num_temporarily(thread_num):
+    """Limit the number of threads used by the numerical libraries within the context only.
+    The environment variables are restored afterwards, so they only reach the libraries and the child processes
+    which are started within the context, while the loaded libraries are limited with threadpoolctl if it is available.
+    
+    :param thread_num: the number of threads, None means no limit
+    :type thread_num: int
+    :return: the context in which the number of threads is limited
+    :rtype: object
+    """
+
+    if thread_num is None:
+        yield
+        return
+
+    original_environment_dict = {
+        variable_name: os.environ.get(variable_name)
+        for variable_name in THREAD_NUM_VARIABLE_NAME_LIST
+    }
+    for variable_name in THREAD_NUM_VARIABLE_NAME_LIST:
+        os.environ[variable_name] = str(thread_num)
+    try:
+        if threadpool_limits is None:
+            yield
+        else:
+            with threadpool_limits(limits=thread_num):
+                yield
+    finally:
+        for variable_name, variable_value in original_environment_dict.items(
+        ):
+            if variable_value is None:
+                os.environ.pop(variable_name, None)
+            else:
+                os.environ[variable_name] = variable_value
+
+
 def get_working_directory(description):
     """Get the path of working directory.
     
@@ -1,95 +1,204 @@
-from landmark import retrieve_facial_image_by_bbox
+from landmark import crop_facial_image_by_bbox
 import common
 import cv2
 import numpy as np
 import os
+import shutil
 import subprocess
+import tempfile
 
 
-def retrieve_facial_image_by_congealingcomplex(full_image_path,
-                                               force_continue=True):
-    """Retrieve the facial image by using congealingcomplex.
-    
-    :param full_image_path: the path of the full image
-    :type full_image_path: string
-    :param force_continue: whether crop facial images by using bbox coordinates
-    :type force_continue: boolean
-    :return: the facial image
-    :rtype: numpy array
+def call_congealingcomplex(facial_image_list):
+    """Call congealingcomplex to perform face frontalization on a batch of facial images.
+    Each call works within its own temporary directory, so several calls could run concurrently.
+
+    :param facial_image_list: the facial images
+    :type facial_image_list: list
+    :return: the processed facial images, None refers to a failure
+    :rtype: list
     """
 
-    def call_congealingcomplex(facial_image):
-        """Call congealingcomplex to perform face frontalization.
-        
-        :param facial_image: the facial image
-        :type facial_image: numpy array
-        :return: the processed facial image
-        :rtype: numpy array
-        """
-
-        input_image_path = os.path.join("/tmp", "input_image.jpg")
-        output_image_path = os.path.join("/tmp", "output_image.jpg")
-        cv2.imwrite(input_image_path, facial_image)
-
-        input_image_info_path = os.path.join("/tmp", "input_image.txt")
-        output_image_info_path = os.path.join("/tmp", "output_image.txt")
+    working_directory = tempfile.mkdtemp(prefix="congealingcomplex_")
+    try:
+        input_image_path_list = []
+        output_image_path_list = []
+        for image_index, facial_image in enumerate(facial_image_list):
+            input_image_path = os.path.join(
+                working_directory, "input_image_{:d}.jpg".format(image_index))
+            output_image_path = os.path.join(
+                working_directory, "output_image_{:d}.jpg".format(image_index))
+            cv2.imwrite(input_image_path, facial_image)
+            input_image_path_list.append(input_image_path)
+            output_image_path_list.append(output_image_path)
+
+        input_image_info_path = os.path.join(working_directory,
+                                             "input_image.txt")
+        output_image_info_path = os.path.join(working_directory,
+                                              "output_image.txt")
         with open(input_image_info_path, "w") as text_file:
-            text_file.write("{}\n".format(input_image_path))
+            for input_image_path in input_image_path_list:
+                text_file.write("{}\n".format(input_image_path))
         with open(output_image_info_path, "w") as text_file:
-            text_file.write("{}\n".format(output_image_path))
+            for output_image_path in output_image_path_list:
+                text_file.write("{}\n".format(output_image_path))
 
+        # The model is loaded once for the whole batch
         subprocess.call([os.path.join(common.CONGEALINGCOMPLEX_PATH, "funnelReal"), \
                          input_image_info_path, \
                          os.path.join(common.CONGEALINGCOMPLEX_PATH, "people.train"), \
                          output_image_info_path])
 
-        # Read the processed facial image
-        processed_facial_image = cv2.imread(output_image_path)
+        processed_facial_image_list = []
+        for output_image_path in output_image_path_list:
+            # Read the processed facial image
+            processed_facial_image = cv2.imread(output_image_path)
+            if processed_facial_image is None:
+                processed_facial_image_list.append(None)
+                continue
 
-        # Omit the totally black rows and columns
-        gray_processed_facial_image = cv2.cvtColor(processed_facial_image,
-                                                   cv2.COLOR_BGR2GRAY)
-        cumsum_in_row = np.cumsum(gray_processed_facial_image, axis=1)
-        valid_row_indexes = cumsum_in_row[:, -1] > 0
-        cumsum_in_column = np.cumsum(gray_processed_facial_image, axis=0)
-        valid_column_indexes = cumsum_in_column[-1, :] > 0
+            # Omit the totally black rows and columns
+            gray_processed_facial_image = cv2.cvtColor(processed_facial_image,
+                                                       cv2.COLOR_BGR2GRAY)
+            cumsum_in_row = np.cumsum(gray_processed_facial_image, axis=1)
+            valid_row_indexes = cumsum_in_row[:, -1] > 0
+            cumsum_in_column = np.cumsum(gray_processed_facial_image, axis=0)
+            valid_column_indexes = cumsum_in_column[-1, :] > 0
 
-        return processed_facial_image[
-            valid_row_indexes, :, :][:, valid_column_indexes, :]
+            processed_facial_image_list.append(processed_facial_image[
+                valid_row_indexes, :, :][:, valid_column_indexes, :])
 
-    try:
-        # Read the coordinates of facial image from the bbox file
-        bbox_file_path = full_image_path + common.BBOX_EXTENSION
-        y, x, w, h = common.read_from_file(bbox_file_path)
-
-        # Find the middle point of the bounding rectangle
-        x_middle = x + 0.5 * h
-        y_middle = y + 0.5 * w
-
-        # Make the bouding square a little bit larger
-        x_start = int(x_middle - 0.8 * h)
-        x_end = int(x_middle + 0.8 * h)
-        y_start = int(y_middle - 0.8 * w)
-        y_end = int(y_middle + 0.8 * w)
-
-        # Retrieve the original facial image
-        full_image = cv2.imread(full_image_path)
-        facial_image = full_image[
-            max(x_start, 0):min(x_end, full_image.shape[0]),
-            max(y_start, 0):min(y_end, full_image.shape[1]), :]
-
-        # Call congealingcomplex and resize it
-        facial_image = call_congealingcomplex(facial_image)
-        facial_image = cv2.resize(facial_image,
-                                  dsize=(common.FACIAL_IMAGE_SIZE,
-                                         common.FACIAL_IMAGE_SIZE))
-
-        # Successful case
-        assert facial_image is not None
-        return facial_image
-    except:
-        # Failure case
-        if force_continue:
-            return retrieve_facial_image_by_bbox(full_image_path)
-        else:
-            return None
+        return processed_facial_image_list
+    finally:
+        shutil.rmtree(working_directory, ignore_errors=True)
+
+
+def crop_enlarged_facial_image(full_image, bbox):
+    """Crop the facial image within an enlarged bounding square.
+
+    :param full_image: the full image
+    :type full_image: numpy array
+    :param bbox: the content of the bbox file
+    :type bbox: numpy array
+    :return: the facial image
+    :rtype: numpy array
+    """
+
+    y, x, w, h = bbox
+
+    # Find the middle point of the bounding rectangle
+    x_middle = x + 0.5 * h
+    y_middle = y + 0.5 * w
+
+    # Make the bouding square a little bit larger
+    x_start = int(x_middle - 0.8 * h)
+    x_end = int(x_middle + 0.8 * h)
+    y_start = int(y_middle - 0.8 * w)
+    y_end = int(y_middle + 0.8 * w)
+
+    # Retrieve the original facial image
+    return full_image[max(x_start, 0):min(x_end, full_image.shape[0]),
+                      max(y_start, 0):min(y_end, full_image.shape[1]), :]
+
+
+def crop_facial_images_by_congealingcomplex(full_image_list,
+                                            bbox_list,
+                                            force_continue=True):
+    """Crop the facial images from decoded full images by using congealingcomplex in one batch.
+
+    :param full_image_list: the full images
+    :type full_image_list: list
+    :param bbox_list: the contents of the bbox files
+    :type bbox_list: list
+    :param force_continue: whether crop facial images by using bbox coordinates
+    :type force_continue: boolean
+    :return: the facial images, None refers to a failure
+    :rtype: list
+    """
+
+    # Retrieve the original facial images
+    facial_image_list = [None] * len(full_image_list)
+    for image_index, (full_image,
+                      bbox) in enumerate(zip(full_image_list, bbox_list)):
+        try:
+            facial_image_list[image_index] = crop_enlarged_facial_image(
+                full_image, bbox)
+        except:
+            pass
+
+    # Call congealingcomplex on the valid facial images
+    valid_image_indexes = [image_index for image_index, facial_image in \
+                           enumerate(facial_image_list) if facial_image is not None]
+    processed_facial_image_list = [None] * len(full_image_list)
+    if len(valid_image_indexes) > 0:
+        try:
+            for image_index, processed_facial_image in zip(valid_image_indexes, \
+                    call_congealingcomplex([facial_image_list[image_index] for image_index in valid_image_indexes])):
+                processed_facial_image_list[
+                    image_index] = processed_facial_image
+        except:
+            pass
+
+    final_facial_image_list = []
+    for full_image, bbox, processed_facial_image in zip(
+            full_image_list, bbox_list, processed_facial_image_list):
+        try:
+            # Resize the processed facial image
+            facial_image = cv2.resize(processed_facial_image,
+                                      dsize=(common.FACIAL_IMAGE_SIZE,
+                                             common.FACIAL_IMAGE_SIZE))
+
+            # Successful case
+            assert facial_image is not None
+            final_facial_image_list.append(facial_image)
+        except:
+            # Failure case
+            if force_continue:
+                final_facial_image_list.append(
+                    crop_facial_image_by_bbox(full_image, bbox))
+            else:
+                final_facial_image_list.append(None)
+
+    return final_facial_image_list
+
+
+def retrieve_facial_images_by_congealingcomplex(full_image_path_list,
+                                                force_continue=True):
+    """Retrieve the facial images by using congealingcomplex in one batch.
+
+    :param full_image_path_list: the paths of the full images
+    :type full_image_path_list: list
+    :param force_continue: whether crop facial images by using bbox coordinates
+    :type force_continue: boolean
+    :return: the facial images, None refers to a failure
+    :rtype: list
+    """
+
+    # Read the full images and the coordinates of facial images from the bbox files
+    full_image_list = []
+    bbox_list = []
+    for full_image_path in full_image_path_list:
+        full_image_list.append(cv2.imread(full_image_path))
+        try:
+            bbox_list.append(
+                common.read_from_file(full_image_path + common.BBOX_EXTENSION))
+        except:
+            bbox_list.append(None)
+
+    return crop_facial_images_by_congealingcomplex(full_image_list, bbox_list,
+                                                   force_continue)
+
+
+def retrieve_facial_image_by_congealingcomplex(full_image_path,
+                                               force_continue=True):
+    """Retrieve the facial image by using congealingcomplex.
+
+    :param full_image_path: the path of the full image
+    :type full_image_path: string
+    :param force_continue: whether crop facial images by using bbox coordinates
+    :type force_continue: boolean
+    :return: the facial image
+    :rtype: numpy array
+    """
+
+    return retrieve_facial_images_by_congealingcomplex([full_image_path],
+                                                       force_continue)[0]
@@ -1,14 +1,39 @@
 from itertools import product
-from sklearn.metrics import auc, roc_curve, matthews_corrcoef
+try:
+    from itertools import izip_longest as zip_longest
+except ImportError:
+    from itertools import zip_longest
+from scipy.stats import rankdata, trim_mean
+from sklearn.metrics import roc_curve
 import common
+import fnmatch
 import glob
+import json
+import multiprocessing
 import numpy as np
 import os
 import pandas as pd
 import prepare_data
 import pylab
+import shutil
+import tempfile
 import time
 
+# The number of bins of the score histograms
+HISTOGRAM_BIN_NUM = 100000
+
+# The number of processes which evaluate the submission files
+EVALUATION_WORKER_NUM = multiprocessing.cpu_count()
+
+# The number of rows which are read at once when combining the submission files
+COMBINING_CHUNK_SIZE = 100000
+
+# The proportion which is cut off at each end in the trimmed mean of the submission files
+TRIMMING_PROPORTION = 0.1
+
+# The GroundTruth labels within the worker process
+groundtruth_label = None
+
 
 def get_ranks(input_array):
     """Get the ranks of the elements in an array.
@@ -24,36 +49,101 @@ def get_ranks(input_array):
     return ranks
 
 
-def compute_MCC(y_true, y_score, threshold_num=500):
+def compute_MCC_with_counts(TP, FP, positive_num, negative_num):
+    """Compute the Matthews Correlation Coefficient from the confusion matrices.
+    
+    :param TP: the numbers of true positives
+    :type TP: numpy array
+    :param FP: the numbers of false positives
+    :type FP: numpy array
+    :param positive_num: the number of positive records
+    :type positive_num: float
+    :param negative_num: the number of negative records
+    :type negative_num: float
+    :return: the Matthews Correlation Coefficient of each confusion matrix
+    :rtype: numpy array
+    """
+
+    TP = np.asarray(TP, dtype=np.float64)
+    FP = np.asarray(FP, dtype=np.float64)
+    FN = positive_num - TP
+    TN = negative_num - FP
+
+    # The Matthews Correlation Coefficient is defined as 0 if any sum is 0
+    numerator = TP * TN - FP * FN
+    denominator = np.sqrt((TP + FP) * (TP + FN) * (TN + FP) * (TN + FN))
+    MCC_array = np.zeros(TP.shape[0])
+    valid_indexes = denominator > 0
+    MCC_array[valid_indexes] = numerator[valid_indexes] / denominator[
+        valid_indexes]
+    return MCC_array
+
+
+def compute_MCC_with_cutoffs(y_true_in_order, cutoff_array):
+    """Compute the Matthews Correlation Coefficient when the top records are predicted as positive.
+    
+    :param y_true_in_order: true binary labels in range {0, 1}, sorted by the scores in descending order
+    :type y_true_in_order: numpy array
+    :param cutoff_array: the numbers of the top records which are predicted as positive
+    :type cutoff_array: numpy array
+    :return: the Matthews Correlation Coefficient of each cutoff
+    :rtype: numpy array
+    """
+
+    # Get the confusion matrices from the cumulative sums
+    cumsum_array = np.hstack(([0], np.cumsum(y_true_in_order, dtype=np.float64)))
+    record_num = y_true_in_order.shape[0]
+    positive_num = cumsum_array[-1]
+    cutoff_array = cutoff_array.astype(np.float64)
+    TP = cumsum_array[cutoff_array.astype(np.int64)]
+    FP = cutoff_array - TP
+    return compute_MCC_with_counts(TP, FP, positive_num,
+                                   record_num - positive_num)
+
+
+def compute_MCC(y_true, y_score, threshold_num=None):
     """Compute the Matthews Correlation Coefficient.
+    The scores are sorted once, and the confusion matrices of all thresholds are computed with cumulative sums.
     
     :param y_true: true binary labels in range {0, 1}
     :type y_true: numpy array
     :param y_score: the probability estimates of the positive class
     :type y_score: numpy array
-    :param threshold_num: the number of thresholds
+    :param threshold_num: the number of thresholds which are evenly spaced over the ranks.
+        If it is None, all distinct thresholds of y_score will be used.
     :type threshold_num: int
     :return: the maximum Matthews Correlation Coefficient
     :rtype: float
     """
 
-    # Get the ranks
-    ranks = get_ranks(y_score)
+    y_true = np.asarray(y_true) > 0
+    y_score = np.asarray(y_score)
+    record_num = y_score.shape[0]
+
+    # The records with higher ranks come first
+    order = y_score.argsort()[::-1]
+    y_true_in_order = y_true[order]
 
-    # Generate the array which contains the value of thresholds
-    threshold_array = np.linspace(np.min(ranks) - 1,
-                                  np.max(ranks) + 1,
-                                  num=threshold_num)
+    if threshold_num is None:
+        # Only cut between records with different scores
+        y_score_in_order = y_score[order]
+        cutoff_array = np.hstack(
+            ([0], np.flatnonzero(y_score_in_order[:-1] != y_score_in_order[1:])
+             + 1, [record_num]))
+    else:
+        # Generate the array which contains the value of thresholds
+        threshold_array = np.linspace(-1, record_num, num=threshold_num)
+
+        # The records whose ranks are higher than the threshold are predicted as positive
+        cutoff_array = record_num - np.clip(
+            np.floor(threshold_array) + 1, 0, record_num)
 
     # Generate MCC values
-    MCC_list = []
-    for threshold in threshold_array:
-        MCC_list.append(matthews_corrcoef(y_true, ranks > threshold))
-    MCC_array = np.array(MCC_list)
+    MCC_array = compute_MCC_with_cutoffs(y_true_in_order, cutoff_array)
 
     # Illustrate threshold and MCC values
     # pylab.figure()
-    # pylab.plot(threshold_array / np.max(ranks), MCC_array)
+    # pylab.plot(cutoff_array / record_num, MCC_array)
     # pylab.show()
 
     return np.max(MCC_array)
@@ -61,6 +151,7 @@ def compute_MCC(y_true, y_score, threshold_num=500):
 
 def perform_interpolation(x_array, y_array, threshold_array):
     """Perform interpolation on the ROC curve.
+    The interpolated data is inserted in one shot, and y_array must be sorted in ascending order.
     
     :param x_array: the data along the x axis
     :type x_array: numpy array
@@ -72,26 +163,95 @@ def perform_interpolation(x_array, y_array, threshold_array):
     :rtype: tuple
     """
 
-    for threshold in threshold_array:
+    # The positions in the original arrays where the thresholds would be inserted
+    position_array = np.searchsorted(y_array, threshold_array, side="left")
+
+    inserted_record_list = []
+    for threshold, position in zip(threshold_array, position_array):
         # Neglect the interpolation if the threshold is aleady in y_array
-        if np.sum(y_array == threshold) > 0:
+        if (position < len(y_array) and y_array[position] == threshold) or \
+            threshold in [record[2] for record in inserted_record_list]:
             continue
 
-        # Find the index which meets y_array[previous_index] < threshold
-        # and y_array[previous_index+1] > threshold
-        previous_index = np.max(np.argwhere(y_array < threshold))
-        following_index = previous_index + 1
+        # Find the records which meet previous_y < threshold and following_y > threshold,
+        # taking the records which have been inserted at the same position into account
+        previous_x, previous_y = x_array[position - 1], y_array[position - 1]
+        following_x, following_y = x_array[position], y_array[position]
+        for inserted_position, inserted_x, inserted_y in inserted_record_list:
+            if inserted_position != position:
+                continue
+            if previous_y < inserted_y < threshold:
+                previous_x, previous_y = inserted_x, inserted_y
+            if threshold < inserted_y < following_y:
+                following_x, following_y = inserted_x, inserted_y
 
-        # Insert the interpolated data to y_array and x_array.
         # The interpolated data is generated by using linear interpolation.
-        value = (threshold - y_array[previous_index]) * (x_array[following_index] - x_array[previous_index]) / \
-            (y_array[following_index] - y_array[previous_index]) + x_array[previous_index]
-        y_array = np.insert(y_array, following_index, threshold)
-        x_array = np.insert(x_array, following_index, value)
+        value = (threshold - previous_y) * (following_x - previous_x) / \
+            (following_y - previous_y) + previous_x
+        inserted_record_list.append((position, value, threshold))
+
+    if len(inserted_record_list) == 0:
+        return (x_array, y_array)
+
+    # Insert the interpolated data to y_array and x_array
+    inserted_record_list = sorted(inserted_record_list,
+                                  key=lambda record: (record[0], record[2]))
+    inserted_position_list, inserted_x_list, inserted_y_list = zip(
+        *inserted_record_list)
+    y_array = np.insert(y_array, inserted_position_list, inserted_y_list)
+    x_array = np.insert(x_array, inserted_position_list, inserted_x_list)
 
     return (x_array, y_array)
 
 
+def compute_Weighted_AUC_from_roc(fpr,
+                                  tpr,
+                                  weight_distribution=np.arange(4, -1, -1.0)):
+    """Compute the Weighted AUC score from the ROC curve.
+    
+    :param fpr: the increasing false positive rates
+    :type fpr: numpy array
+    :param tpr: the increasing true positive rates
+    :type tpr: numpy array
+    :param weight_distribution: the weights of different areas
+    :type weight_distribution: numpy array
+    :return: the Weighted AUC score
+    :rtype: float
+    """
+
+    # Divide the range [0, 1] evenly
+    weight_num = weight_distribution.shape[0]
+    evenly_spaced_thresholds = np.linspace(0, 1, num=weight_num + 1)
+
+    # Perform interpolation
+    fpr, tpr = perform_interpolation(fpr, tpr, evenly_spaced_thresholds[1:-1])
+
+    # Compute the lowest and highest indexes of the records within each area
+    highest_record_index_array = np.searchsorted(
+        tpr, evenly_spaced_thresholds[1:], side="right") - 1
+    lowest_record_index_array = np.hstack(([0],
+                                           highest_record_index_array[:-1]))
+
+    # The cumulative areas under the trapezoids between consecutive records
+    cumulative_area_array = np.hstack(
+        ([0], np.cumsum(np.diff(fpr) * (tpr[:-1] + tpr[1:]) / 2)))
+
+    # In each area, the curve is shifted down by its lowest True Positive Rate,
+    # and extended horizontally to the range [0, 1]
+    lowest_fpr = fpr[lowest_record_index_array]
+    lowest_tpr = tpr[lowest_record_index_array]
+    highest_fpr = fpr[highest_record_index_array]
+    highest_tpr = tpr[highest_record_index_array]
+    area_array = cumulative_area_array[highest_record_index_array] - \
+        cumulative_area_array[lowest_record_index_array] - \
+        lowest_tpr * (highest_fpr - lowest_fpr) + \
+        (highest_tpr - lowest_tpr) * (1 - highest_fpr)
+
+    # Normalize weight distribution and return final score
+    weight_distribution = weight_distribution / np.mean(weight_distribution)
+    return np.sum(np.multiply(area_array, weight_distribution))
+
+
 def compute_Weighted_AUC(y_true,
                          y_score,
                          weight_distribution=np.arange(4, -1, -1.0)):
@@ -107,13 +267,8 @@ def compute_Weighted_AUC(y_true,
     :rtype: float
     """
 
-    # Divide the range [0, 1] evenly
-    weight_num = weight_distribution.shape[0]
-    evenly_spaced_thresholds = np.linspace(0, 1, num=weight_num + 1)
-
-    # Compute ROC curve and perform interpolation
+    # Compute ROC curve
     fpr, tpr, _ = roc_curve(y_true, y_score)
-    fpr, tpr = perform_interpolation(fpr, tpr, evenly_spaced_thresholds[1:-1])
 
     # Plot ROC curve
     # pylab.figure()
@@ -125,45 +280,7 @@ def compute_Weighted_AUC(y_true,
     # pylab.title("ROC Curve")
     # pylab.show()
 
-    # Compute the areas
-    area_array = np.zeros(weight_num)
-    lowest_record_index = 0
-    for area_index in range(weight_num):
-        # Compute the highest index of the records within current area
-        high_threshold = evenly_spaced_thresholds[area_index + 1]
-        highest_record_index = np.sum(tpr <= high_threshold) - 1
-
-        # Select the records within current area
-        selected_fpr = fpr[lowest_record_index:highest_record_index + 1]
-        selected_tpr = tpr[lowest_record_index:highest_record_index + 1]
-
-        # Remove bias in True Positive Rate
-        selected_tpr = selected_tpr - selected_tpr[0]
-
-        # Extend the curve to the range [0, 1]
-        selected_fpr = np.hstack(([0], selected_fpr, [1]))
-        selected_tpr = np.hstack(
-            (selected_tpr[0], selected_tpr, selected_tpr[-1]))
-
-        # Plot selected ROC curve
-        # pylab.figure()
-        # pylab.plot(selected_fpr, selected_tpr)
-        # pylab.axis("equal")
-        # pylab.grid()
-        # pylab.xlabel("False Positive Rate")
-        # pylab.ylabel("True Positive Rate")
-        # pylab.title("Selected ROC Curve")
-        # pylab.show()
-
-        # Compute current area
-        area_array[area_index] = auc(selected_fpr, selected_tpr, reorder=True)
-
-        # Update lowest_record_index
-        lowest_record_index = highest_record_index
-
-    # Normalize weight distribution and return final score
-    weight_distribution = weight_distribution / np.mean(weight_distribution)
-    return np.sum(np.multiply(area_array, weight_distribution))
+    return compute_Weighted_AUC_from_roc(fpr, tpr, weight_distribution)
 
 
 def compute_tpr_with_fpr(y_true, y_score, chosen_fpr=1e-2):
@@ -187,36 +304,274 @@ def compute_tpr_with_fpr(y_true, y_score, chosen_fpr=1e-2):
     return tpr[np.argwhere(fpr == chosen_fpr)[0][0]]
 
 
-def perform_evaluation():
-    """Perform evaluation on the submission files."""
+class Score_Histogram(object):
+    """Streaming accumulator of the scores, which keeps one fixed-resolution histogram per class.
+    The memory usage only depends on the number of bins, and the accumulators
+    in different processes could be combined with merge.
+    """
+
+    def __init__(self, bin_num=HISTOGRAM_BIN_NUM, score_range=(0.0, 1.0)):
+        """Init function.
+        
+        :param bin_num: the number of bins, the scores within the same bin are treated as ties
+        :type bin_num: int
+        :param score_range: the lowest and highest scores, the other scores are clipped into the range
+        :type score_range: tuple
+        :return: the class object will be initiated based on the arguments
+        :rtype: None
+        """
+
+        self.bin_num = bin_num
+        self.score_range = tuple(score_range)
+        self.positive_histogram = np.zeros(bin_num, dtype=np.int64)
+        self.negative_histogram = np.zeros(bin_num, dtype=np.int64)
+
+    def update(self, y_true, y_score):
+        """Add a batch of records.
+        
+        :param y_true: true binary labels in range {0, 1}
+        :type y_true: numpy array
+        :param y_score: the probability estimates of the positive class
+        :type y_score: numpy array
+        :return: the histograms will be updated
+        :rtype: None
+        """
+
+        y_true = np.asarray(y_true).ravel() > 0
+        y_score = np.asarray(y_score, dtype=np.float64).ravel()
+
+        lowest_score, highest_score = self.score_range
+        bin_index_array = np.floor((y_score - lowest_score) /
+                                   (highest_score - lowest_score) *
+                                   self.bin_num)
+        bin_index_array = np.clip(bin_index_array, 0,
+                                  self.bin_num - 1).astype(np.int64)
+
+        self.positive_histogram += np.bincount(bin_index_array[y_true],
+                                               minlength=self.bin_num)
+        self.negative_histogram += np.bincount(bin_index_array[~y_true],
+                                               minlength=self.bin_num)
+
+    def merge(self, other):
+        """Add the records of another accumulator.
+        
+        :param other: another accumulator with the same bins
+        :type other: Score_Histogram
+        :return: the accumulator itself
+        :rtype: Score_Histogram
+        """
+
+        assert self.bin_num == other.bin_num and self.score_range == other.score_range, \
+            "The bins of the accumulators are different."
+        self.positive_histogram += other.positive_histogram
+        self.negative_histogram += other.negative_histogram
+        return self
+
+    def get_cumulative_counts(self):
+        """Get the numbers of true positives and false positives at the thresholds between the non-empty bins.
+        
+        :return: TP and FP are in descending order of the thresholds, starting from predicting nothing as positive.
+        :rtype: tuple
+        """
+
+        valid_indexes = (self.positive_histogram +
+                         self.negative_histogram)[::-1] > 0
+        TP = np.hstack(([0], np.cumsum(
+            self.positive_histogram[::-1])[valid_indexes])).astype(np.float64)
+        FP = np.hstack(([0], np.cumsum(
+            self.negative_histogram[::-1])[valid_indexes])).astype(np.float64)
+        return (TP, FP)
+
+    def get_roc_curve(self):
+        """Get the ROC curve.
+        
+        :return: the false positive rates and the true positive rates
+        :rtype: tuple
+        """
+
+        TP, FP = self.get_cumulative_counts()
+        return (FP / FP[-1], TP / TP[-1])
+
+    def compute_Weighted_AUC(self, weight_distribution=np.arange(4, -1, -1.0)):
+        """Compute the Weighted AUC score.
+        
+        :param weight_distribution: the weights of different areas
+        :type weight_distribution: numpy array
+        :return: the Weighted AUC score
+        :rtype: float
+        """
+
+        fpr, tpr = self.get_roc_curve()
+        return compute_Weighted_AUC_from_roc(fpr, tpr, weight_distribution)
+
+    def compute_tpr_with_fpr(self, chosen_fpr=1e-2):
+        """Compute the tpr value with the given fpr value.
+        
+        :param chosen_fpr: the given fpr value
+        :type chosen_fpr: float
+        :return: the tpr value
+        :rtype: float
+        """
+
+        fpr, tpr = self.get_roc_curve()
+        tpr, fpr = perform_interpolation(tpr, fpr, [chosen_fpr])
+        return tpr[np.argwhere(fpr == chosen_fpr)[0][0]]
+
+    def compute_MCC(self):
+        """Compute the maximum Matthews Correlation Coefficient over the thresholds between the bins.
+        
+        :return: the maximum Matthews Correlation Coefficient
+        :rtype: float
+        """
+
+        TP, FP = self.get_cumulative_counts()
+        return np.max(compute_MCC_with_counts(TP, FP, TP[-1], FP[-1]))
+
+
+def get_file_signature(file_path):
+    """Get the signature of a file, which changes whenever the file is modified.
+    
+    :param file_path: the path of the file
+    :type file_path: string
+    :return: the size and the modification time of the file
+    :rtype: list
+    """
+
+    file_stat = os.stat(file_path)
+    return [file_stat.st_size, file_stat.st_mtime]
+
+
+def init_evaluation_worker(current_groundtruth_label):
+    """Init the worker process which evaluates the submission files.
+    
+    :param current_groundtruth_label: the labels in the GroundTruth file
+    :type current_groundtruth_label: numpy array
+    :return: the GroundTruth labels will be shared by the tasks of the worker
+    :rtype: None
+    """
+
+    global groundtruth_label
+    groundtruth_label = current_groundtruth_label
+
+
+def evaluate_submission_file(submission_file_path):
+    """Evaluate one submission file with the GroundTruth labels of the worker.
+    
+    :param submission_file_path: the path of the submission file
+    :type submission_file_path: string
+    :return: the score of the submission file
+    :rtype: float
+    """
+
+    # Read current submission file
+    submission_file_content = pd.read_csv(submission_file_path,
+                                          skiprows=0).as_matrix()
+    submission_label = submission_file_content[:, 1]
+
+    # Compute Weighted AUC or MCC of current submission file
+    score = compute_Weighted_AUC(groundtruth_label, submission_label)
+    # score = compute_tpr_with_fpr(groundtruth_label, submission_label)
+    # score = compute_MCC(groundtruth_label, submission_label)
+
+    return float(score)
+
+
+def perform_evaluation(worker_num=EVALUATION_WORKER_NUM):
+    """Perform evaluation on the submission files.
+    The scores are cached, so that only the new or modified submission files are evaluated.
+    
+    :param worker_num: the number of processes which evaluate the submission files
+    :type worker_num: int
+    :return: the scores will be printed
+    :rtype: None
+    """
 
     # Read GroundTruth file
     groundtruth_file_path = os.path.join(common.SUBMISSIONS_FOLDER_PATH,
                                          common.GROUNDTRUTH_FILE_NAME)
     groundtruth_file_content = pd.read_csv(groundtruth_file_path,
                                            skiprows=0).as_matrix()
-    groundtruth_label = groundtruth_file_content[:, 1]
-    groundtruth_label = groundtruth_label.astype(np.float64)
-
-    # List all csv files in current folder and evaluate them
+    current_groundtruth_label = groundtruth_file_content[:, 1]
+    current_groundtruth_label = current_groundtruth_label.astype(np.float64)
+
+    # Load the cached scores, which are only valid for the same GroundTruth file
+    evaluation_cache_file_path = os.path.join(
+        common.SUBMISSIONS_FOLDER_PATH, common.EVALUATION_CACHE_FILE_NAME)
+    evaluation_cache = {}
+    if os.path.isfile(evaluation_cache_file_path):
+        try:
+            with open(evaluation_cache_file_path) as evaluation_cache_file:
+                evaluation_cache = json.load(evaluation_cache_file)
+        except ValueError:
+            evaluation_cache = {}
+    groundtruth_signature = get_file_signature(groundtruth_file_path)
+    if evaluation_cache.get("groundtruth_signature") != groundtruth_signature:
+        evaluation_cache = {
+            "groundtruth_signature": groundtruth_signature,
+            "score_dict": {}
+        }
+    score_dict = evaluation_cache["score_dict"]
+
+    # List all csv files in current folder
     submission_file_path_list = glob.glob(
         os.path.join(common.SUBMISSIONS_FOLDER_PATH, "*.csv"))
     submission_file_path_list = sorted(submission_file_path_list)
+    submission_file_path_list = [submission_file_path for submission_file_path in submission_file_path_list \
+                                 if submission_file_path != groundtruth_file_path and "Anonymous" not in submission_file_path]
+
+    # Evaluate the submission files which are not in the cache
+    submission_signature_dict = {
+        submission_file_path: get_file_signature(submission_file_path)
+        for submission_file_path in submission_file_path_list
+    }
+    new_submission_file_path_list = []
+    for submission_file_path in submission_file_path_list:
+        submission_signature = submission_signature_dict[submission_file_path]
+        cached_record = score_dict.get(submission_file_path)
+        if cached_record is None or cached_record[
+                "signature"] != submission_signature:
+            new_submission_file_path_list.append(submission_file_path)
+
+    if worker_num > 1 and len(new_submission_file_path_list) > 1:
+        pool = multiprocessing.Pool(processes=worker_num,
+                                    initializer=init_evaluation_worker,
+                                    initargs=(current_groundtruth_label,))
+        try:
+            new_score_list = pool.map(evaluate_submission_file,
+                                      new_submission_file_path_list)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_evaluation_worker(current_groundtruth_label)
+        new_score_list = [
+            evaluate_submission_file(submission_file_path)
+            for submission_file_path in new_submission_file_path_list
+        ]
+
+    for submission_file_path, score in zip(new_submission_file_path_list,
+                                           new_score_list):
+        score_dict[submission_file_path] = {
+            "signature": submission_signature_dict[submission_file_path],
+            "score":
+                score
+        }
+
+    # Only keep the records of the existing submission files, and save the cache
+    evaluation_cache["score_dict"] = {
+        submission_file_path: score_dict[submission_file_path]
+        for submission_file_path in submission_file_path_list
+    }
+    temporary_evaluation_cache_file_path = evaluation_cache_file_path + ".tmp"
+    with open(temporary_evaluation_cache_file_path,
+              "w") as evaluation_cache_file:
+        json.dump(evaluation_cache, evaluation_cache_file)
+    os.rename(temporary_evaluation_cache_file_path, evaluation_cache_file_path)
+
     submission_file_name_list = []
     score_list = []
     for submission_file_path in submission_file_path_list:
-        if submission_file_path == groundtruth_file_path or "Anonymous" in submission_file_path:
-            continue
-
-        # Read current submission file
-        submission_file_content = pd.read_csv(submission_file_path,
-                                              skiprows=0).as_matrix()
-        submission_label = submission_file_content[:, 1]
-
-        # Compute Weighted AUC or MCC of current submission file
-        score = compute_Weighted_AUC(groundtruth_label, submission_label)
-        # score = compute_tpr_with_fpr(groundtruth_label, submission_label)
-        # score = compute_MCC(groundtruth_label, submission_label)
+        score = score_dict[submission_file_path]["score"]
 
         submission_file_name = os.path.basename(submission_file_path)
         print("{} achieved {:.4f}.".format(submission_file_name, score))
@@ -233,10 +588,149 @@ def perform_evaluation():
                                         np.array(score_list)[flag][0], current_index + 1))
 
 
+def read_submission_files_in_lockstep(submission_file_path_list, chunk_size):
+    """Read the submission files chunk by chunk in lockstep.
+    
+    :param submission_file_path_list: the paths of the submission files
+    :type submission_file_path_list: list
+    :param chunk_size: the number of rows which are read at once
+    :type chunk_size: int
+    :return: the content of the first submission file and the predictions of all submission files in each chunk
+    :rtype: generator
+    """
+
+    reader_list = [
+        pd.read_csv(submission_file_path, skiprows=0, chunksize=chunk_size)
+        for submission_file_path in submission_file_path_list
+    ]
+
+    for chunk_list in zip_longest(*reader_list):
+        # All submission files must contain the same number of records
+        for submission_file_path, chunk in zip(submission_file_path_list,
+                                               chunk_list):
+            if chunk is None:
+                raise ValueError(
+                    "{} contains fewer records than the others.".format(
+                        os.path.basename(submission_file_path)))
+
+        # The records must refer to the same pairs in all submission files
+        for submission_file_path, chunk in zip(submission_file_path_list[1:],
+                                               chunk_list[1:]):
+            if not np.array_equal(chunk["Id"].values,
+                                  chunk_list[0]["Id"].values):
+                raise ValueError("The Ids in {} are not aligned with {}.".format(
+                    os.path.basename(submission_file_path),
+                    os.path.basename(submission_file_path_list[0])))
+
+        yield (chunk_list[0], np.column_stack([
+            chunk["Prediction"].values.astype(np.float64) for chunk in chunk_list
+        ]))
+
+
+def combine_submission_files(submission_file_path_list,
+                             prediction_file_prefix,
+                             chunk_size=COMBINING_CHUNK_SIZE,
+                             proportion_to_cut=TRIMMING_PROPORTION):
+    """Combine the submission files with the mean, median, trimmed mean and rank average.
+    The first three are computed in one pass, while the predictions of each submission file are spilled to disk
+    so that the rank average only needs one column in memory at a time.
+    
+    :param submission_file_path_list: the paths of the submission files
+    :type submission_file_path_list: list
+    :param prediction_file_prefix: the prefix of the new submission files
+    :type prediction_file_prefix: string
+    :param chunk_size: the number of rows which are read at once
+    :type chunk_size: int
+    :param proportion_to_cut: the proportion which is cut off at each end in the trimmed mean
+    :type proportion_to_cut: float
+    :return: the new submission files will be created
+    :rtype: None
+    """
+
+    timestamp = str(int(time.time()))
+    combining_func_dict = {
+        "mean":
+            lambda prediction_array: np.mean(prediction_array, axis=1),
+        "median":
+            lambda prediction_array: np.median(prediction_array, axis=1),
+        "trimmed_mean":
+            lambda prediction_array: trim_mean(
+                prediction_array, proportion_to_cut, axis=1)
+    }
+    submission_file_path_dict = {
+        combining_name: os.path.join(
+            common.SUBMISSIONS_FOLDER_PATH, prediction_file_prefix + "_" +
+            combining_name + "_" + timestamp + ".csv")
+        for combining_name in list(combining_func_dict.keys()) +
+        ["rank_average"]
+    }
+
+    working_directory = tempfile.mkdtemp(prefix="combine_submissions_")
+    try:
+        spilled_file_path_list = [
+            os.path.join(working_directory, "prediction_{:d}.bin".format(
+                submission_file_index))
+            for submission_file_index in range(len(submission_file_path_list))
+        ]
+        spilled_file_list = [
+            open(spilled_file_path, "wb")
+            for spilled_file_path in spilled_file_path_list
+        ]
+
+        record_num = 0
+        for chunk_index, (submission_file_content, prediction_array) in enumerate(
+                read_submission_files_in_lockstep(submission_file_path_list,
+                                                  chunk_size)):
+            for combining_name, combining_func in combining_func_dict.items():
+                submission_file_content["Prediction"] = combining_func(
+                    prediction_array)
+                submission_file_content.to_csv(
+                    submission_file_path_dict[combining_name],
+                    mode="w" if chunk_index == 0 else "a",
+                    header=chunk_index == 0,
+                    index=False)
+
+            for spilled_file, prediction in zip(spilled_file_list,
+                                                prediction_array.T):
+                prediction.tofile(spilled_file)
+            record_num += prediction_array.shape[0]
+
+        for spilled_file in spilled_file_list:
+            spilled_file.close()
+
+        # Accumulate the normalized ranks of each submission file
+        rank_average_array = np.lib.format.open_memmap(
+            os.path.join(working_directory, "rank_average.npy"),
+            mode="w+",
+            dtype=np.float64,
+            shape=(record_num,))
+        for spilled_file_path in spilled_file_path_list:
+            prediction = np.fromfile(spilled_file_path, dtype=np.float64)
+            rank_average_array += rankdata(prediction) / record_num / len(
+                spilled_file_path_list)
+
+        # Write the rank average with the Ids of the first submission file
+        for chunk_index, submission_file_content in enumerate(
+                pd.read_csv(submission_file_path_list[0],
+                            skiprows=0,
+                            chunksize=chunk_size)):
+            start_index = chunk_index * chunk_size
+            submission_file_content["Prediction"] = rank_average_array[
+                start_index:start_index + submission_file_content.shape[0]]
+            submission_file_content.to_csv(
+                submission_file_path_dict["rank_average"],
+                mode="w" if chunk_index == 0 else "a",
+                header=chunk_index == 0,
+                index=False)
+        del rank_average_array
+    finally:
+        shutil.rmtree(working_directory, ignore_errors=True)
+
+
 def combine_submissions():
     """Combine submissions.
     
-    :return: the new submission file will be created
+    :return: the new submission files will be created
     :rtype: None
     """
 
@@ -250,6 +744,14 @@ def combine_submissions():
     ]
     classifier_name_list = ["keras", "sklearn"]
 
+    # List the submission files once, and divide them into the combinations
+    submission_file_name_list = sorted([
+        os.path.basename(submission_file_path)
+        for submission_file_path in glob.glob(
+            os.path.join(common.SUBMISSIONS_FOLDER_PATH,
+                         "Aurora_*_Model_*.csv"))
+    ])
+
     for facial_image_extension, feature_extension, classifier_name in \
         product(facial_image_extension_list, feature_extension_list, classifier_name_list):
 
@@ -257,32 +759,17 @@ def combine_submissions():
         submission_file_name_rule = prediction_file_prefix + "_Model_*.csv"
         print("Working on {:s} ...".format(submission_file_name_rule))
 
-        # Read the submission files
-        submission_label_list = []
-        submission_file_path_list = glob.glob(
-            os.path.join(common.SUBMISSIONS_FOLDER_PATH,
-                         submission_file_name_rule))
-        for submission_file_path in submission_file_path_list:
-            submission_file_content = pd.read_csv(submission_file_path,
-                                                  skiprows=0)
-            submission_label = submission_file_content["Prediction"].as_matrix()
-            submission_label_list.append(submission_label)
-
-        # Generate the mean submission file
-        submission_file_content["Prediction"] = np.mean(submission_label_list,
-                                                        axis=0)
-        submission_file_path = os.path.join(
-            common.SUBMISSIONS_FOLDER_PATH,
-            prediction_file_prefix + "_mean_" + str(int(time.time())) + ".csv")
-        submission_file_content.to_csv(submission_file_path, index=False)
-
-        # Generate the median submission file
-        submission_file_content["Prediction"] = np.median(submission_label_list,
-                                                          axis=0)
-        submission_file_path = os.path.join(
-            common.SUBMISSIONS_FOLDER_PATH, prediction_file_prefix +
-            "_median_" + str(int(time.time())) + ".csv")
-        submission_file_content.to_csv(submission_file_path, index=False)
+        submission_file_path_list = [
+            os.path.join(common.SUBMISSIONS_FOLDER_PATH, submission_file_name)
+            for submission_file_name in fnmatch.filter(
+                submission_file_name_list, submission_file_name_rule)
+        ]
+        if len(submission_file_path_list) == 0:
+            print("No submission file is found.")
+            continue
+
+        combine_submission_files(submission_file_path_list,
+                                 prediction_file_prefix)
 
 
 if __name__ == "__main__":
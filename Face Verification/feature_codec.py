@@ -0,0 +1,445 @@
+import gallery_index
+import numpy as np
+import time
+
+# The number of rows which are encoded at once
+ENCODING_CHUNK_SIZE = 65536
+
+# Variables related to product quantization
+SUBSPACE_NUM = 8
+SUBSPACE_CENTROID_NUM = 256
+
+# The number of identities which are used in the benchmark
+BENCHMARK_IDENTITY_NUM = 500
+
+
+class Feature_Codec(object):
+    """Lossless codec which stores the features in float32.
+    The other codecs share the same interface, and their parameters are listed in PARAMETER_NAME_LIST.
+    """
+
+    PARAMETER_NAME_LIST = []
+
+    def fit(self, feature_array):
+        """Fit the parameters of the codec.
+
+        :param feature_array: the features, one row for each image
+        :type feature_array: numpy array
+        :return: the codec itself
+        :rtype: Feature_Codec
+        """
+
+        return self
+
+    def encode(self, feature_array):
+        """Encode the features.
+
+        :param feature_array: the features, one row for each image
+        :type feature_array: numpy array
+        :return: the codes, one row for each image
+        :rtype: numpy array
+        """
+
+        return np.asarray(feature_array, dtype=np.float32)
+
+    def decode(self, code_array):
+        """Decode the codes.
+
+        :param code_array: the codes, one row for each image
+        :type code_array: numpy array
+        :return: the reconstructed features in float32
+        :rtype: numpy array
+        """
+
+        return np.asarray(code_array, dtype=np.float32)
+
+    def get_parameter_size(self):
+        """Get the number of bytes of the parameters.
+
+        :return: the number of bytes
+        :rtype: int
+        """
+
+        return int(
+            np.sum([
+                getattr(self, parameter_name).nbytes
+                for parameter_name in self.PARAMETER_NAME_LIST
+            ]))
+
+    def save(self, file_path):
+        """Save the parameters of the codec.
+
+        :param file_path: the path of the parameter file
+        :type file_path: string
+        :return: the parameter file will be saved to disk
+        :rtype: None
+        """
+
+        with open(file_path, "wb") as parameter_file:
+            np.savez(
+                parameter_file, **{
+                    parameter_name: getattr(self, parameter_name)
+                    for parameter_name in self.PARAMETER_NAME_LIST
+                })
+
+    def load(self, file_path):
+        """Load the parameters of the codec.
+
+        :param file_path: the path of the parameter file
+        :type file_path: string
+        :return: the codec itself
+        :rtype: Feature_Codec
+        """
+
+        with np.load(file_path) as parameter_file_content:
+            for parameter_name in self.PARAMETER_NAME_LIST:
+                setattr(self, parameter_name,
+                        parameter_file_content[parameter_name])
+        return self
+
+
+class Float16_Codec(Feature_Codec):
+    """Codec which stores the features in float16."""
+
+    def encode(self, feature_array):
+        return np.asarray(feature_array, dtype=np.float16)
+
+
+class Int8_Codec(Feature_Codec):
+    """Codec which maps each dimension linearly to int8 with its own scale and offset."""
+
+    PARAMETER_NAME_LIST = ["scale_array", "offset_array"]
+
+    def fit(self, feature_array):
+        self.offset_array = np.min(feature_array, axis=0).astype(np.float64)
+        self.scale_array = (np.max(feature_array, axis=0).astype(np.float64) -
+                            self.offset_array) / 255
+        self.scale_array[self.scale_array == 0] = 1
+        return self
+
+    def encode(self, feature_array):
+        level_array = np.round(
+            (np.asarray(feature_array, dtype=np.float64) - self.offset_array) /
+            self.scale_array)
+        return (np.clip(level_array, 0, 255) - 128).astype(np.int8)
+
+    def decode(self, code_array):
+        return ((np.asarray(code_array, dtype=np.float64) + 128) *
+                self.scale_array + self.offset_array).astype(np.float32)
+
+
+class Product_Quantization_Codec(Feature_Codec):
+    """Codec which divides the features into subspaces, and stores the nearest centroid of each subspace in uint8.
+    The distances between the uncompressed queries and the codes are computed asymmetrically with lookup tables.
+    """
+
+    PARAMETER_NAME_LIST = ["centroid_array", "boundary_array"]
+
+    def __init__(self,
+                 subspace_num=SUBSPACE_NUM,
+                 centroid_num=SUBSPACE_CENTROID_NUM):
+        """Init function.
+
+        :param subspace_num: the number of subspaces
+        :type subspace_num: int
+        :param centroid_num: the number of centroids in each subspace, at most 256
+        :type centroid_num: int
+        :return: the class object will be initiated based on the arguments
+        :rtype: None
+        """
+
+        assert centroid_num <= 256, "The codes are stored in uint8."
+        self.subspace_num = subspace_num
+        self.centroid_num = centroid_num
+
+    def fit(self, feature_array):
+        self.boundary_array = np.linspace(0,
+                                          feature_array.shape[1],
+                                          num=self.subspace_num + 1).astype(
+                                              np.int64)
+        centroid_num = min(self.centroid_num, feature_array.shape[0])
+
+        # The subspaces may have different dimensions, so the centroids are padded with zeros
+        max_subspace_dimension = np.max(np.diff(self.boundary_array))
+        self.centroid_array = np.zeros(
+            (self.subspace_num, centroid_num, max_subspace_dimension),
+            dtype=np.float32)
+        for subspace_index in range(self.subspace_num):
+            start_index, end_index = self.boundary_array[
+                subspace_index:subspace_index + 2]
+            self.centroid_array[subspace_index, :, 0:end_index - start_index] = \
+                gallery_index.perform_kmeans(np.asarray(feature_array[:, start_index:end_index], dtype=np.float64), centroid_num)
+        return self
+
+    def encode(self, feature_array):
+        feature_array = np.asarray(feature_array, dtype=np.float64)
+        code_array = np.zeros((feature_array.shape[0], self.subspace_num),
+                              dtype=np.uint8)
+        for subspace_index in range(self.subspace_num):
+            start_index, end_index = self.boundary_array[
+                subspace_index:subspace_index + 2]
+            code_array[:, subspace_index] = gallery_index.assign_to_centroids(
+                feature_array[:, start_index:end_index],
+                self.centroid_array[subspace_index, :, 0:end_index -
+                                    start_index])
+        return code_array
+
+    def decode(self, code_array):
+        code_array = np.asarray(code_array)
+        feature_array = np.zeros((code_array.shape[0], self.boundary_array[-1]),
+                                 dtype=np.float32)
+        for subspace_index in range(self.subspace_num):
+            start_index, end_index = self.boundary_array[
+                subspace_index:subspace_index + 2]
+            feature_array[:, start_index:end_index] = self.centroid_array[
+                subspace_index, code_array[:, subspace_index],
+                0:end_index - start_index]
+        return feature_array
+
+    def load(self, file_path):
+        Feature_Codec.load(self, file_path)
+        self.subspace_num, self.centroid_num = self.centroid_array.shape[0:2]
+        return self
+
+    def compute_distance_table(self, query_feature):
+        """Compute the squared distances between the query and the centroids of each subspace.
+
+        :param query_feature: the uncompressed query feature
+        :type query_feature: numpy array
+        :return: the lookup table, one row for each subspace
+        :rtype: numpy array
+        """
+
+        query_feature = np.asarray(query_feature, dtype=np.float64)
+        distance_table = np.zeros((self.subspace_num, self.centroid_array.shape[1]))
+        for subspace_index in range(self.subspace_num):
+            start_index, end_index = self.boundary_array[
+                subspace_index:subspace_index + 2]
+            distance_table[subspace_index] = np.sum(
+                (self.centroid_array[subspace_index, :, 0:end_index -
+                                     start_index] -
+                 query_feature[start_index:end_index])**2,
+                axis=1)
+        return distance_table
+
+    def compute_asymmetric_distances(self, query_feature, code_array):
+        """Compute the euclidean distances between one uncompressed query and the codes.
+        The lookup table is computed once, and each distance is a sum of the entries gathered by the code.
+
+        :param query_feature: the uncompressed query feature
+        :type query_feature: numpy array
+        :param code_array: the codes, one row for each image
+        :type code_array: numpy array
+        :return: the distances between the query and the codes
+        :rtype: numpy array
+        """
+
+        distance_table = self.compute_distance_table(query_feature)
+        code_array = np.asarray(code_array)
+        square_distance_array = np.sum(distance_table[np.arange(
+            self.subspace_num), code_array],
+                                       axis=1)
+        return np.sqrt(np.maximum(square_distance_array, 0))
+
+    def compute_asymmetric_distances_by_index(self, query_feature_array,
+                                              code_array, index_array_1,
+                                              index_array_2):
+        """Compute the euclidean distances between the uncompressed queries and the codes of the pairs.
+        The pairs are grouped by their queries, so that each lookup table is computed once.
+
+        :param query_feature_array: the uncompressed features, which index_array_1 refers to
+        :type query_feature_array: numpy array
+        :param code_array: the codes, which index_array_2 refers to
+        :type code_array: numpy array
+        :param index_array_1: the rows of the queries in the pairs
+        :type index_array_1: numpy array
+        :param index_array_2: the rows of the codes in the pairs
+        :type index_array_2: numpy array
+        :return: the distances of the pairs
+        :rtype: numpy array
+        """
+
+        index_array_1 = np.asarray(index_array_1)
+        index_array_2 = np.asarray(index_array_2)
+        distance_array = np.zeros(index_array_1.size)
+
+        order = np.argsort(index_array_1, kind="mergesort")
+        unique_query_indexes, group_start_indexes = np.unique(
+            index_array_1[order], return_index=True)
+        group_end_indexes = np.append(group_start_indexes[1:], order.size)
+        for query_index, group_start_index, group_end_index in zip(
+                unique_query_indexes, group_start_indexes, group_end_indexes):
+            pair_indexes = order[group_start_index:group_end_index]
+            distance_array[pair_indexes] = self.compute_asymmetric_distances(
+                query_feature_array[query_index],
+                code_array[index_array_2[pair_indexes]])
+        return distance_array
+
+
+# The codecs which could be used in the feature store
+CODEC_CLASS_DICT = {
+    "float32": Feature_Codec,
+    "float16": Float16_Codec,
+    "int8": Int8_Codec,
+    "pq": Product_Quantization_Codec
+}
+
+
+class Quantized_Feature_Array(object):
+    """Read-only view of the codes which decodes the selected rows on access.
+    It could be passed to pairwise_metrics.compute_pairwise_metrics_by_index directly.
+    """
+
+    def __init__(self, codec, code_array):
+        """Init function.
+
+        :param codec: the codec which encoded the features
+        :type codec: Feature_Codec
+        :param code_array: the codes, one row for each image
+        :type code_array: numpy array
+        :return: the class object will be initiated based on the arguments
+        :rtype: None
+        """
+
+        self.codec = codec
+        self.code_array = code_array
+
+    @property
+    def shape(self):
+        if isinstance(self.codec, Product_Quantization_Codec):
+            return (self.code_array.shape[0], int(self.codec.boundary_array[-1]))
+        return self.code_array.shape
+
+    def __len__(self):
+        return self.code_array.shape[0]
+
+    def __getitem__(self, row_indexes):
+        if np.isscalar(row_indexes):
+            return self.codec.decode(self.code_array[[row_indexes]])[0]
+        return self.codec.decode(self.code_array[row_indexes])
+
+    def __array__(self, dtype=None, copy=None):
+        # Decode all rows, it should be avoided for large arrays
+        feature_array = self.codec.decode(self.code_array)
+        return feature_array if dtype is None else feature_array.astype(dtype)
+
+    def select(self, row_indexes):
+        """Select some rows without decoding them.
+
+        :param row_indexes: the selected rows
+        :type row_indexes: numpy array
+        :return: the view of the selected rows
+        :rtype: Quantized_Feature_Array
+        """
+
+        return Quantized_Feature_Array(self.codec,
+                                       np.asarray(self.code_array[row_indexes]))
+
+
+def benchmark_codecs(feature_array,
+                     index_array,
+                     metric_list=["euclidean", "cosine"],
+                     codec_name_list=["float32", "float16", "int8", "pq"]):
+    """Benchmark the codecs by using the distances of all pairs as the scores.
+
+    :param feature_array: the features, one row for each image
+    :type feature_array: numpy array
+    :param index_array: the indexes of the images
+    :type index_array: numpy array
+    :param metric_list: the metrics whose distances are evaluated
+    :type metric_list: list
+    :param codec_name_list: the names of the codecs
+    :type codec_name_list: list
+    :return: the records of the benchmark, one for each codec and metric
+    :rtype: list
+    """
+
+    import evaluation
+    import pairwise_metrics
+    import solution_basic
+
+    feature_array = np.asarray(feature_array, dtype=np.float32)
+    pair_array, label_array = solution_basic.get_record_map(
+        np.asarray(index_array), None)
+
+    benchmark_record_list = []
+    for codec_name in codec_name_list:
+        codec = CODEC_CLASS_DICT[codec_name]().fit(feature_array)
+
+        start_time = time.time()
+        code_array = codec.encode(feature_array)
+        encoding_time = time.time() - start_time
+        memory_size = code_array.nbytes + codec.get_parameter_size()
+
+        quantized_feature_array = Quantized_Feature_Array(codec, code_array)
+        start_time = time.time()
+        distance_array = pairwise_metrics.compute_pairwise_metrics_by_index(
+            quantized_feature_array, pair_array[:, 0], pair_array[:, 1],
+            metric_list)
+        pair_throughput = pair_array.shape[0] / max(
+            time.time() - start_time, 1e-6)
+
+        for metric_index, metric in enumerate(metric_list):
+            benchmark_record_list.append({
+                "codec": codec_name,
+                "metric": metric,
+                "memory_size": memory_size,
+                "encoding_throughput": feature_array.shape[0] /
+                                       max(encoding_time, 1e-6),
+                "pair_throughput": pair_throughput,
+                "score": evaluation.compute_Weighted_AUC(
+                    label_array, -distance_array[:, metric_index])
+            })
+
+        # The asymmetric distances only quantize the second image of each pair
+        if codec_name == "pq":
+            start_time = time.time()
+            distance_array = codec.compute_asymmetric_distances_by_index(
+                feature_array, code_array, pair_array[:, 0], pair_array[:, 1])
+            benchmark_record_list.append({
+                "codec": "pq_adc",
+                "metric": "euclidean",
+                "memory_size": memory_size,
+                "encoding_throughput": feature_array.shape[0] /
+                                       max(encoding_time, 1e-6),
+                "pair_throughput": pair_array.shape[0] /
+                                   max(time.time() - start_time, 1e-6),
+                "score": evaluation.compute_Weighted_AUC(label_array,
+                                                         -distance_array)
+            })
+
+    return benchmark_record_list
+
+
+def run(facial_image_extension="_bbox.jpg", feature_extension="_vgg_face.csv"):
+    import solution_basic
+
+    # Select the images of some identities, so that all pairs could be enumerated
+    training_image_feature_list, training_image_index_list, _ = \
+        solution_basic.load_feature(facial_image_extension, feature_extension)
+    training_image_index_array = np.array(training_image_index_list)
+    selected_identities = np.random.RandomState(0).permutation(
+        np.unique(training_image_index_array))[0:BENCHMARK_IDENTITY_NUM]
+    selected_indexes = np.flatnonzero(
+        np.in1d(training_image_index_array, selected_identities))
+
+    benchmark_record_list = benchmark_codecs(
+        np.array(training_image_feature_list)[selected_indexes],
+        training_image_index_array[selected_indexes])
+
+    reference_score_dict = {
+        record["metric"]: record["score"]
+        for record in benchmark_record_list
+        if record["codec"] == "float32"
+    }
+    print("Codec\tMetric\tMemory (MB)\tEncoding (images/s)\tPairs/s\tScore\tDegradation")
+    for record in benchmark_record_list:
+        print("{}\t{}\t{:.2f}\t{:.0f}\t{:.0f}\t{:.4f}\t{:.4f}".format(
+            record["codec"], record["metric"], record["memory_size"] / 1024.0**2,
+            record["encoding_throughput"], record["pair_throughput"],
+            record["score"],
+            reference_score_dict[record["metric"]] - record["score"]))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,123 @@
+import common
+import importlib
+import threading
+
+
+class Feature_Extractor(object):
+    """Feature extractor which wraps one of the backend modules, e.g., open_face and vgg_face.
+    The backend is initiated lazily on first use, so unused extractors cost nothing.
+    Since the execution mode of Caffe is thread-local, get_backend should be called
+    in the thread which retrieves the features before the work is sent to a thread pool.
+    """
+
+    def __init__(self, backend_name, use_gpu=True, thread_num=None):
+        """Init function.
+
+        :param backend_name: the name of the backend module, e.g., open_face
+        :type backend_name: string
+        :param use_gpu: whether run the network on GPU
+        :type use_gpu: boolean
+        :param thread_num: the number of threads used in the CPU mode, None means the default of the backend.
+            It is only applied while the backend is initiated or retrieving features.
+        :type thread_num: int
+        :return: the class object will be initiated based on the arguments
+        :rtype: None
+        """
+
+        self.backend_name = backend_name
+        self.use_gpu = use_gpu
+        self.thread_num = thread_num
+        self.backend = None
+        self.lock = threading.Lock()
+
+    def get_backend(self):
+        """Get the backend module, and initiate it if necessary.
+
+        :return: the backend module
+        :rtype: object
+        """
+
+        with self.lock:
+            if self.backend is None:
+                print("Initiating {} in the {} mode ...".format(
+                    self.backend_name, "GPU" if self.use_gpu else "CPU"))
+
+                # The numerical libraries and the child processes read the limit when they are started
+                with common.limit_thread_num_temporarily(self.thread_num):
+                    backend = importlib.import_module(self.backend_name)
+                    getattr(backend, "init_{}_module".format(
+                        self.backend_name))(self.use_gpu)
+                self.backend = backend
+
+        return self.backend
+
+    def retrieve_feature(self, facial_image_path, feature_file_path):
+        """Retrieve the deep feature of one facial image and save it to file.
+
+        :param facial_image_path: the path of the facial image
+        :type facial_image_path: string
+        :param feature_file_path: the path of the feature file
+        :type feature_file_path: string
+        :return: the deep feature
+        :rtype: numpy array
+        """
+
+        backend = self.get_backend()
+        with common.limit_thread_num_temporarily(self.thread_num):
+            return getattr(backend, "retrieve_feature_by_{}".format(
+                self.backend_name))(facial_image_path, feature_file_path)
+
+    def load_facial_image(self, facial_image_path):
+        """Load the facial image and convert it to the input of the network.
+
+        :param facial_image_path: the path of the facial image
+        :type facial_image_path: string
+        :return: the converted facial image, None refers to a failure
+        :rtype: numpy array
+        """
+
+        return getattr(self.get_backend(), "load_facial_image_for_{}".format(
+            self.backend_name))(facial_image_path)
+
+    def convert_facial_image(self, facial_image):
+        """Convert the decoded facial image to the input of the network.
+
+        :param facial_image: the facial image
+        :type facial_image: numpy array
+        :return: the converted facial image, None refers to a failure
+        :rtype: numpy array
+        """
+
+        return getattr(self.get_backend(), "convert_facial_image_for_{}".format(
+            self.backend_name))(facial_image)
+
+    def retrieve_features(self, facial_image_list):
+        """Retrieve the deep features of a batch of facial images.
+
+        :param facial_image_list: the facial images returned by load_facial_image
+        :type facial_image_list: list
+        :return: the deep features, one row for each facial image
+        :rtype: numpy array
+        """
+
+        backend = self.get_backend()
+        with common.limit_thread_num_temporarily(self.thread_num):
+            return getattr(backend, "retrieve_features_by_{}".format(
+                self.backend_name))(facial_image_list)
+
+
+def init_feature_extractor(backend_name):
+    """Init a feature extractor based on the settings in common.
+
+    :param backend_name: the name of the backend module, e.g., open_face
+    :type backend_name: string
+    :return: the feature extractor
+    :rtype: object
+    """
+
+    mode = common.FEATURE_EXTRACTOR_MODE_DICT[backend_name]
+    assert mode in ["gpu", "cpu"], "Unknown mode {}.".format(mode)
+    return Feature_Extractor(
+        backend_name,
+        use_gpu=mode == "gpu",
+        thread_num=common.FEATURE_EXTRACTOR_THREAD_NUM_DICT[backend_name])
@@ -0,0 +1,209 @@
+from sklearn.utils.extmath import randomized_svd
+import numpy as np
+import os
+
+# The suffix of the projection file which is saved next to the model of each fold
+PROJECTION_SUFFIX = "_projection.npz"
+
+# Variables related to the projection
+PROJECTION_DIMENSION = 256
+WHITEN = True
+
+# Variables related to the randomized SVD
+SVD_ITERATION_NUM = 4
+SVD_SAMPLE_NUM = 50000
+SVD_RANDOM_SEED = 0
+
+# The number of rows which are projected at once
+PROJECTION_CHUNK_SIZE = 65536
+
+
+class Feature_Projection(object):
+    """Project the features onto the leading principal components, and optionally whiten them."""
+
+    def __init__(self, dimension=PROJECTION_DIMENSION, whiten=WHITEN):
+        """Init function.
+
+        :param dimension: the dimension of the projected features
+        :type dimension: int
+        :param whiten: whether the projected features are scaled to unit variance
+        :type whiten: boolean
+        :return: the class object will be initiated based on the arguments
+        :rtype: None
+        """
+
+        self.dimension = dimension
+        self.whiten = whiten
+        self.mean_array = None
+        self.component_array = None
+        self.scale_array = None
+
+    def fit(self, feature_array):
+        """Fit the projection with randomized SVD on a sample of the features.
+
+        :param feature_array: the features, one row for each image
+        :type feature_array: numpy array or list
+        :return: the projection itself
+        :rtype: Feature_Projection
+        """
+
+        random_state = np.random.RandomState(SVD_RANDOM_SEED)
+        sample_indexes = np.sort(
+            random_state.choice(len(feature_array),
+                                min(len(feature_array), SVD_SAMPLE_NUM),
+                                replace=False))
+        sample_feature_array = np.array(
+            [feature_array[sample_index] for sample_index in sample_indexes],
+            dtype=np.float64)
+
+        self.mean_array = np.mean(sample_feature_array, axis=0)
+        dimension = min(self.dimension, *sample_feature_array.shape)
+        _, singular_value_array, self.component_array = randomized_svd(
+            sample_feature_array - self.mean_array,
+            dimension,
+            n_iter=SVD_ITERATION_NUM,
+            random_state=SVD_RANDOM_SEED)
+
+        # The standard deviations of the projected features are proportional to the singular values
+        self.scale_array = np.ones(dimension)
+        if self.whiten:
+            self.scale_array = singular_value_array / np.sqrt(
+                max(sample_feature_array.shape[0] - 1, 1))
+            self.scale_array[self.scale_array == 0] = 1
+        return self
+
+    def transform(self, feature_array):
+        """Project the features.
+
+        :param feature_array: the features, one row for each image
+        :type feature_array: numpy array
+        :return: the projected features in float32
+        :rtype: numpy array
+        """
+
+        projected_feature_array = np.zeros(
+            (len(feature_array), self.component_array.shape[0]),
+            dtype=np.float32)
+        for start_index in range(0, len(feature_array), PROJECTION_CHUNK_SIZE):
+            end_index = min(start_index + PROJECTION_CHUNK_SIZE,
+                            len(feature_array))
+            chunk_feature_array = np.asarray(
+                feature_array[start_index:end_index], dtype=np.float64)
+            projected_feature_array[start_index:end_index] = (
+                chunk_feature_array - self.mean_array).dot(
+                    self.component_array.T) / self.scale_array
+        return projected_feature_array
+
+    def save(self, file_path):
+        """Save the projection.
+
+        :param file_path: the path of the projection file
+        :type file_path: string
+        :return: the projection file will be saved to disk
+        :rtype: None
+        """
+
+        with open(file_path, "wb") as projection_file:
+            np.savez(projection_file,
+                     dimension=self.dimension,
+                     whiten=self.whiten,
+                     mean_array=self.mean_array,
+                     component_array=self.component_array,
+                     scale_array=self.scale_array)
+
+    def load(self, file_path):
+        """Load the projection.
+
+        :param file_path: the path of the projection file
+        :type file_path: string
+        :return: the projection itself
+        :rtype: Feature_Projection
+        """
+
+        with np.load(file_path) as projection_file_content:
+            self.dimension = int(projection_file_content["dimension"])
+            self.whiten = bool(projection_file_content["whiten"])
+            self.mean_array = projection_file_content["mean_array"]
+            self.component_array = projection_file_content["component_array"]
+            self.scale_array = projection_file_content["scale_array"]
+        return self
+
+
+def get_projection_file_path(model_path):
+    """Get the path of the projection file which belongs to a model.
+
+    :param model_path: the path of the model file
+    :type model_path: string
+    :return: the path of the projection file
+    :rtype: string
+    """
+
+    return os.path.splitext(model_path)[0] + PROJECTION_SUFFIX
+
+
+def load_projection(model_path):
+    """Load the projection which was fitted together with a model.
+
+    :param model_path: the path of the model file
+    :type model_path: string
+    :return: the projection, None means the model was trained without projection
+    :rtype: Feature_Projection
+    """
+
+    projection_file_path = get_projection_file_path(model_path)
+    if not os.path.isfile(projection_file_path):
+        return None
+    return Feature_Projection().load(projection_file_path)
+
+
+def run(facial_image_extension="_bbox.jpg", feature_extension="_vgg_face.csv"):
+    import evaluation
+    import pairwise_metrics
+    import solution_basic
+    import solution_keras
+    import time
+
+    # Enumerate all pairs within a subset of the training images
+    training_image_feature_list, training_image_index_list, _ = \
+        solution_basic.load_feature(facial_image_extension, feature_extension)
+    training_image_index_array = np.array(training_image_index_list)
+    selected_indexes = np.arange(min(len(training_image_index_list), 5000))
+    feature_array = solution_basic.select_feature(training_image_feature_list,
+                                                  selected_indexes)
+    pair_array, label_array = solution_basic.get_record_map(
+        training_image_index_array[selected_indexes], None)
+
+    # The projection is fitted on the other identities, so that the subset is held out
+    fitting_indexes = np.flatnonzero(~np.in1d(
+        training_image_index_array,
+        training_image_index_array[selected_indexes]))
+    if fitting_indexes.size == 0:
+        fitting_indexes = selected_indexes
+    projection = Feature_Projection().fit(
+        solution_basic.select_feature(training_image_feature_list,
+                                      fitting_indexes))
+
+    metric_list = solution_keras.METRIC_LIST_DICT[feature_extension]
+    for description, selected_feature_array, selected_metric_list in [
+        ("Original", feature_array, metric_list),
+        ("Projected", projection.transform(feature_array),
+         solution_basic.get_metric_list(metric_list, True))
+    ]:
+        start_time = time.time()
+        distance_array = pairwise_metrics.compute_pairwise_metrics_by_index(
+            selected_feature_array, pair_array[:, 0], pair_array[:, 1],
+            selected_metric_list)
+        elapsed_time = time.time() - start_time
+
+        print("\n{} features with {:d} dimensions and {:d} metrics take {:.2f} seconds for {:d} pairs.".format(
+            description, selected_feature_array.shape[1],
+            len(selected_metric_list), elapsed_time, pair_array.shape[0]))
+        for metric_index, metric in enumerate(selected_metric_list):
+            print("{}\t{:.4f}".format(
+                metric,
+                evaluation.compute_Weighted_AUC(
+                    label_array, -distance_array[:, metric_index])))
+
+
+if __name__ == "__main__":
+    run()
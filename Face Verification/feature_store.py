@@ -0,0 +1,390 @@
+import common
+import feature_codec
+import numpy as np
+import os
+import pandas as pd
+import pyprind
+
+# The suffixes of the files which make up a feature store
+FEATURE_MATRIX_SUFFIX = "_feature.npy"
+IMAGE_INDEX_SUFFIX = "_index.csv"
+VALIDITY_BITMAP_SUFFIX = "_validity.npy"
+
+# The suffixes of the files which make up a quantized copy, the name of the codec is inserted before them
+CODE_MATRIX_SUFFIX = "_code.npy"
+CODEC_PARAMETER_SUFFIX = "_codec.npz"
+
+# The suffix of the files which are still being written
+TEMPORARY_SUFFIX = ".tmp"
+
+
+def get_feature_store_prefix(facial_image_extension, feature_extension):
+    """Get the common prefix of the files in the feature store.
+
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :return: the common prefix of the files in the feature store
+    :rtype: string
+    """
+
+    selected_facial_image = os.path.splitext(facial_image_extension)[0][1:]
+    selected_feature = os.path.splitext(feature_extension)[0][1:]
+    return os.path.join(common.FEATURE_STORE_FOLDER_PATH,
+                        selected_facial_image + "_with_" + selected_feature)
+
+
+def is_feature_store_available(facial_image_extension, feature_extension):
+    """Check whether the feature store exists.
+
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :return: whether the feature store exists
+    :rtype: boolean
+    """
+
+    prefix = get_feature_store_prefix(facial_image_extension,
+                                      feature_extension)
+    for suffix in [
+            FEATURE_MATRIX_SUFFIX, IMAGE_INDEX_SUFFIX, VALIDITY_BITMAP_SUFFIX
+    ]:
+        if not os.path.isfile(prefix + suffix):
+            return False
+    return True
+
+
+class Feature_Store_Writer(object):
+    """Write features into a feature store.
+    The feature matrix is allocated once the dimension of the features is known,
+    and the feature store only becomes visible after calling close.
+    """
+
+    def __init__(self, image_paths, facial_image_extension, feature_extension):
+        """Init function.
+
+        :param image_paths: the file paths of the images, each of them occupies one row
+        :type image_paths: list
+        :param facial_image_extension: the extension of the facial images
+        :type facial_image_extension: string
+        :param feature_extension: the extension of the feature files
+        :type feature_extension: string
+        :return: the class object will be initiated based on the arguments
+        :rtype: None
+        """
+
+        self.image_paths = image_paths
+        self.prefix = get_feature_store_prefix(facial_image_extension,
+                                               feature_extension)
+        self.feature_matrix = None
+        self.validity_array = np.zeros(len(image_paths), dtype=bool)
+
+    def write(self, row_indexes, feature_array):
+        """Write features into specific rows.
+
+        :param row_indexes: the rows which the features belong to
+        :type row_indexes: list
+        :param feature_array: the features, one row for each entry in row_indexes
+        :type feature_array: numpy array
+        :return: the features will be written into the feature matrix
+        :rtype: None
+        """
+
+        feature_array = np.atleast_2d(feature_array)
+        if self.feature_matrix is None:
+            if not os.path.isdir(common.FEATURE_STORE_FOLDER_PATH):
+                os.makedirs(common.FEATURE_STORE_FOLDER_PATH)
+            self.feature_matrix = np.lib.format.open_memmap(
+                self.prefix + FEATURE_MATRIX_SUFFIX + TEMPORARY_SUFFIX,
+                mode="w+",
+                dtype=np.float32,
+                shape=(len(self.image_paths), feature_array.shape[1]))
+
+        self.feature_matrix[row_indexes, :] = feature_array
+        self.validity_array[row_indexes] = True
+
+    def close(self):
+        """Flush the feature matrix and write the sidecar files.
+
+        :return: whether the feature store has been saved to disk
+        :rtype: boolean
+        """
+
+        if self.feature_matrix is None:
+            return False
+
+        # Release the memory-mapped file
+        self.feature_matrix.flush()
+        self.feature_matrix = None
+
+        # Invalidate the old feature store before replacing its files
+        if os.path.isfile(self.prefix + IMAGE_INDEX_SUFFIX):
+            os.remove(self.prefix + IMAGE_INDEX_SUFFIX)
+
+        os.rename(self.prefix + FEATURE_MATRIX_SUFFIX + TEMPORARY_SUFFIX,
+                  self.prefix + FEATURE_MATRIX_SUFFIX)
+        np.save(self.prefix + VALIDITY_BITMAP_SUFFIX,
+                np.packbits(self.validity_array))
+
+        # The image paths are saved relative to the data folder
+        relative_image_paths = [
+            os.path.relpath(image_path, common.DATA_PATH)
+            for image_path in self.image_paths
+        ]
+        pd.DataFrame({
+            "Path": relative_image_paths
+        }).to_csv(self.prefix + IMAGE_INDEX_SUFFIX, index=False, header=True)
+
+        return True
+
+
+def load_feature_store(facial_image_extension, feature_extension):
+    """Load the feature store without reading the features into memory.
+
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :return: feature_matrix refers to the memory-mapped features,
+        image_path_to_row_dict maps the image path to the row in the feature matrix,
+        while validity_array refers to whether each row contains a valid feature.
+    :rtype: tuple
+    """
+
+    prefix = get_feature_store_prefix(facial_image_extension,
+                                      feature_extension)
+    feature_matrix = np.load(prefix + FEATURE_MATRIX_SUFFIX, mmap_mode="r")
+
+    relative_image_paths = pd.read_csv(prefix + IMAGE_INDEX_SUFFIX,
+                                       na_filter=False)["Path"]
+    image_path_to_row_dict = {}
+    for row_index, relative_image_path in enumerate(relative_image_paths):
+        image_path = os.path.join(common.DATA_PATH, relative_image_path)
+        image_path_to_row_dict[image_path] = row_index
+
+    validity_array = np.unpackbits(np.load(prefix + VALIDITY_BITMAP_SUFFIX))
+    validity_array = validity_array[0:feature_matrix.shape[0]].astype(bool)
+
+    return (feature_matrix, image_path_to_row_dict, validity_array)
+
+
+def load_feature_from_store(image_paths, facial_image_extension,
+                            feature_extension):
+    """Load feature from the feature store.
+
+    :param image_paths: the file paths of the images
+    :type image_paths: list
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :return: the features, each of them is a view into the memory-mapped feature matrix
+    :rtype: list
+    """
+
+    feature_matrix, image_path_to_row_dict, validity_array = load_feature_store(
+        facial_image_extension, feature_extension)
+
+    feature_list = []
+    for image_path in image_paths:
+        row_index = image_path_to_row_dict.get(image_path)
+        if row_index is not None and validity_array[row_index]:
+            feature_list.append(feature_matrix[row_index])
+        else:
+            feature_list.append(None)
+
+    return feature_list
+
+
+def get_quantized_feature_store_prefix(facial_image_extension,
+                                       feature_extension, codec_name):
+    """Get the common prefix of the files in the quantized copy of the feature store.
+
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :param codec_name: the name of the codec in feature_codec.CODEC_CLASS_DICT
+    :type codec_name: string
+    :return: the common prefix of the files in the quantized copy
+    :rtype: string
+    """
+
+    return get_feature_store_prefix(facial_image_extension,
+                                    feature_extension) + "_" + codec_name
+
+
+def quantize_feature_store(facial_image_extension, feature_extension,
+                           codec_name):
+    """Encode the feature store with a codec, the codec is fitted on the valid rows.
+    The validity bitmap and the image index are shared with the original feature store.
+
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :param codec_name: the name of the codec in feature_codec.CODEC_CLASS_DICT
+    :type codec_name: string
+    :return: the quantized copy will be saved to disk
+    :rtype: None
+    """
+
+    feature_matrix, _, validity_array = load_feature_store(
+        facial_image_extension, feature_extension)
+    codec = feature_codec.CODEC_CLASS_DICT[codec_name]().fit(
+        feature_matrix[validity_array])
+
+    prefix = get_quantized_feature_store_prefix(facial_image_extension,
+                                                feature_extension, codec_name)
+    codec.save(prefix + CODEC_PARAMETER_SUFFIX)
+
+    # Encode in chunks, so that the feature matrix is never read into memory at once
+    code_matrix = None
+    for start_index in range(0, feature_matrix.shape[0],
+                             feature_codec.ENCODING_CHUNK_SIZE):
+        end_index = min(start_index + feature_codec.ENCODING_CHUNK_SIZE,
+                        feature_matrix.shape[0])
+        code_array = codec.encode(feature_matrix[start_index:end_index])
+        if code_matrix is None:
+            code_matrix = np.lib.format.open_memmap(
+                prefix + CODE_MATRIX_SUFFIX + TEMPORARY_SUFFIX,
+                mode="w+",
+                dtype=code_array.dtype,
+                shape=(feature_matrix.shape[0], code_array.shape[1]))
+        code_matrix[start_index:end_index] = code_array
+
+    code_matrix.flush()
+    code_matrix = None
+    os.rename(prefix + CODE_MATRIX_SUFFIX + TEMPORARY_SUFFIX,
+              prefix + CODE_MATRIX_SUFFIX)
+
+
+def is_quantized_feature_store_available(facial_image_extension,
+                                         feature_extension, codec_name):
+    """Check whether the quantized copy exists and is up to date with the feature store.
+
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :param codec_name: the name of the codec in feature_codec.CODEC_CLASS_DICT
+    :type codec_name: string
+    :return: whether the quantized copy could be used
+    :rtype: boolean
+    """
+
+    if not is_feature_store_available(facial_image_extension,
+                                      feature_extension):
+        return False
+
+    feature_matrix_file_path = get_feature_store_prefix(
+        facial_image_extension, feature_extension) + FEATURE_MATRIX_SUFFIX
+    prefix = get_quantized_feature_store_prefix(facial_image_extension,
+                                                feature_extension, codec_name)
+    for suffix in [CODE_MATRIX_SUFFIX, CODEC_PARAMETER_SUFFIX]:
+        if not os.path.isfile(prefix + suffix):
+            return False
+
+        # The quantized copy is stale once the feature store is rebuilt
+        if os.path.getmtime(prefix + suffix) < os.path.getmtime(
+                feature_matrix_file_path):
+            return False
+
+    return np.load(prefix + CODE_MATRIX_SUFFIX, mmap_mode="r").shape[0] == \
+        np.load(feature_matrix_file_path, mmap_mode="r").shape[0]
+
+
+def load_quantized_feature_store(facial_image_extension, feature_extension,
+                                 codec_name):
+    """Load the quantized copy of the feature store, the rows are decoded on access.
+
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :param codec_name: the name of the codec in feature_codec.CODEC_CLASS_DICT
+    :type codec_name: string
+    :return: feature_matrix refers to the memory-mapped codes wrapped in feature_codec.Quantized_Feature_Array,
+        image_path_to_row_dict and validity_array are the same as load_feature_store.
+    :rtype: tuple
+    """
+
+    if not is_quantized_feature_store_available(
+            facial_image_extension, feature_extension, codec_name):
+        raise ValueError("The quantized copy with {} is missing or stale.".format(
+            codec_name))
+
+    prefix = get_quantized_feature_store_prefix(facial_image_extension,
+                                                feature_extension, codec_name)
+    codec = feature_codec.CODEC_CLASS_DICT[codec_name]().load(
+        prefix + CODEC_PARAMETER_SUFFIX)
+    code_matrix = np.load(prefix + CODE_MATRIX_SUFFIX, mmap_mode="r")
+
+    _, image_path_to_row_dict, validity_array = load_feature_store(
+        facial_image_extension, feature_extension)
+
+    return (feature_codec.Quantized_Feature_Array(codec, code_matrix),
+            image_path_to_row_dict, validity_array)
+
+
+def migrate_from_csv(image_paths, facial_image_extension, feature_extension):
+    """Build the feature store from the feature files which contain one feature each.
+
+    :param image_paths: the file paths of the images
+    :type image_paths: list
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :return: whether the feature store has been saved to disk
+    :rtype: boolean
+    """
+
+    print("\nMigrating feature files with facial_image_extension is {} and feature_extension is {}.".format\
+          (facial_image_extension, feature_extension))
+
+    feature_store_writer = Feature_Store_Writer(image_paths,
+                                                facial_image_extension,
+                                                feature_extension)
+
+    # Add progress bar
+    progress_bar = pyprind.ProgBar(len(image_paths), monitor=True)
+
+    for row_index, image_path in enumerate(image_paths):
+        # Update progress bar before the computation
+        progress_bar.update()
+
+        feature_file_path = image_path + facial_image_extension + feature_extension
+        if os.path.isfile(feature_file_path):
+            feature_store_writer.write([row_index],
+                                       common.read_from_file(feature_file_path))
+
+    # Report tracking information
+    print(progress_bar)
+
+    return feature_store_writer.close()
+
+
+def run():
+    import prepare_data
+
+    # Get image paths in the training and testing datasets
+    image_paths_in_training_dataset, _ = prepare_data.get_image_paths_in_training_dataset(
+    )
+    image_paths_in_testing_dataset = prepare_data.get_image_paths_in_testing_dataset(
+    )
+    image_paths = image_paths_in_training_dataset + image_paths_in_testing_dataset
+
+    # Migrate the feature files of every combination
+    for facial_image_extension in prepare_data.FACIAL_IMAGE_EXTENSION_LIST:
+        for feature_extension in prepare_data.FEATURE_EXTENSION_LIST:
+            migrate_from_csv(image_paths, facial_image_extension,
+                             feature_extension)
+
+    print("All done!")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,597 @@
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+import common
+import json
+import numpy as np
+import os
+import pairwise_metrics
+
+# The suffixes of the files which make up a gallery index
+CENTROID_SUFFIX = "_centroid.npy"
+FEATURE_SUFFIX = "_feature.npy"
+NORM_SUFFIX = "_norm.npy"
+IDENTITY_SUFFIX = "_identity.npy"
+LIST_OFFSET_SUFFIX = "_list_offset.npy"
+IDENTITY_KEY_SUFFIX = "_identity_key.npy"
+IDENTITY_OFFSET_SUFFIX = "_identity_offset.npy"
+IDENTITY_ROW_SUFFIX = "_identity_row.npy"
+METADATA_SUFFIX = "_metadata.json"
+
+# The metrics which are supported by the gallery index
+GALLERY_METRIC_LIST = ["cosine", "euclidean"]
+
+# The number of inverted lists, None means the square root of the number of gallery images
+CLUSTER_NUM = None
+
+# The number of inverted lists which are scanned for each probe
+PROBE_CLUSTER_NUM = 8
+
+# Variables related to the k-means clustering
+KMEANS_ITERATION_NUM = 10
+KMEANS_SAMPLE_NUM = 65536
+KMEANS_RANDOM_SEED = 0
+
+# The number of records which are assigned to the centroids at once
+ASSIGNMENT_CHUNK_SIZE = 4096
+
+# The port of the verification service
+SERVICE_PORT = 8000
+
+
+def assign_to_centroids(feature_array, centroid_array,
+                        chunk_size=ASSIGNMENT_CHUNK_SIZE):
+    """Assign the features to the nearest centroids.
+
+    :param feature_array: the features, one row for each image
+    :type feature_array: numpy array
+    :param centroid_array: the centroids, one row for each cluster
+    :type centroid_array: numpy array
+    :param chunk_size: the number of records which are assigned at once
+    :type chunk_size: int
+    :return: the indexes of the nearest centroids
+    :rtype: numpy array
+    """
+
+    centroid_square_norm_array = np.sum(centroid_array**2, axis=1)
+    assignment_array = np.zeros(feature_array.shape[0], dtype=np.int64)
+    for start_index in range(0, feature_array.shape[0], chunk_size):
+        end_index = min(start_index + chunk_size, feature_array.shape[0])
+
+        # The squared norms of the features do not affect the nearest centroids
+        distance_array = centroid_square_norm_array - 2 * np.asarray(
+            feature_array[start_index:end_index]).dot(centroid_array.T)
+        assignment_array[start_index:end_index] = np.argmin(distance_array,
+                                                            axis=1)
+    return assignment_array
+
+
+def perform_kmeans(feature_array,
+                   cluster_num,
+                   iteration_num=KMEANS_ITERATION_NUM,
+                   sample_num=KMEANS_SAMPLE_NUM,
+                   random_seed=KMEANS_RANDOM_SEED):
+    """Perform k-means clustering on a sample of the features.
+
+    :param feature_array: the features, one row for each image
+    :type feature_array: numpy array
+    :param cluster_num: the number of clusters
+    :type cluster_num: int
+    :param iteration_num: the number of iterations
+    :type iteration_num: int
+    :param sample_num: the number of features which are used in clustering
+    :type sample_num: int
+    :param random_seed: the seed of the random number generator
+    :type random_seed: int
+    :return: the centroids, one row for each cluster
+    :rtype: numpy array
+    """
+
+    random_state = np.random.RandomState(random_seed)
+    sample_feature_array = feature_array[np.sort(
+        random_state.choice(feature_array.shape[0],
+                            min(feature_array.shape[0], sample_num),
+                            replace=False))]
+    centroid_array = sample_feature_array[random_state.choice(
+        sample_feature_array.shape[0], cluster_num, replace=False)].copy()
+
+    for _ in range(iteration_num):
+        assignment_array = assign_to_centroids(sample_feature_array,
+                                               centroid_array)
+        count_array = np.bincount(assignment_array, minlength=cluster_num)
+        sum_array = np.zeros(centroid_array.shape)
+        np.add.at(sum_array, assignment_array, sample_feature_array)
+
+        # The centroids of the empty clusters are kept
+        valid_indexes = count_array > 0
+        centroid_array[valid_indexes] = sum_array[
+            valid_indexes] / count_array[valid_indexes][:, np.newaxis]
+
+    return centroid_array
+
+
+class Gallery_Index(object):
+    """Inverted file index over the gallery features.
+    The features are grouped by their nearest centroids, and only the lists
+    whose centroids are close to the probe are scanned.
+    """
+
+    def __init__(self, centroid_array, feature_array, norm_array,
+                 identity_array, list_offset_array, metric,
+                 identity_lookup):
+        """Init function.
+
+        :param centroid_array: the centroids, one row for each inverted list
+        :type centroid_array: numpy array
+        :param feature_array: the gallery features, sorted by the inverted lists
+        :type feature_array: numpy array
+        :param norm_array: the norms of the gallery features
+        :type norm_array: numpy array
+        :param identity_array: the identities of the gallery features
+        :type identity_array: numpy array
+        :param list_offset_array: the first row of each inverted list, followed by the number of rows
+        :type list_offset_array: numpy array
+        :param metric: the metric which is used to compare the features, either "cosine" or "euclidean"
+        :type metric: string
+        :param identity_lookup: the sorted unique identities, the first row of each identity followed by the number of rows,
+            and the rows sorted by the identities, which are returned by build_identity_lookup
+        :type identity_lookup: tuple
+        :return: the class object will be initiated based on the arguments
+        :rtype: None
+        """
+
+        assert metric in GALLERY_METRIC_LIST, "Unknown metric {}.".format(
+            metric)
+
+        self.centroid_array = centroid_array
+        self.feature_array = feature_array
+        self.norm_array = norm_array
+        self.identity_array = identity_array
+        self.list_offset_array = list_offset_array
+        self.metric = metric
+        self.identity_key_array, self.identity_offset_array, self.identity_row_array = identity_lookup
+
+    def compute_distances(self, probe_feature, row_indexes):
+        """Compute the distances between the probe and some of the gallery features.
+
+        :param probe_feature: the feature of the probe
+        :type probe_feature: numpy array
+        :param row_indexes: the rows of the gallery features
+        :type row_indexes: numpy array
+        :return: the distances
+        :rtype: numpy array
+        """
+
+        dot_product_array = np.asarray(
+            self.feature_array[row_indexes]).dot(probe_feature)
+        norm_array = np.asarray(self.norm_array[row_indexes])
+        probe_norm = np.sqrt(np.sum(probe_feature**2))
+
+        if self.metric == "cosine":
+            norm_product_array = norm_array * probe_norm
+            norm_product_array[norm_product_array == 0] = 1
+            return 1 - dot_product_array / norm_product_array
+
+        return np.sqrt(
+            np.maximum(norm_array**2 - 2 * dot_product_array + probe_norm**2,
+                       0))
+
+    def search(self, probe_feature, top_k, probe_cluster_num=PROBE_CLUSTER_NUM):
+        """Search the closest identities of the probe.
+
+        :param probe_feature: the feature of the probe
+        :type probe_feature: numpy array
+        :param top_k: the number of identities
+        :type top_k: int
+        :param probe_cluster_num: the number of inverted lists which are scanned
+        :type probe_cluster_num: int
+        :return: the identities, the distances and the rows of the closest gallery features of these identities
+        :rtype: tuple
+        """
+
+        probe_feature = np.asarray(probe_feature, dtype=np.float64).ravel()
+
+        # Find the closest inverted lists
+        query_feature = pairwise_metrics.normalize_feature_array(
+            probe_feature[np.newaxis, :]
+        )[0] if self.metric == "cosine" else probe_feature
+        centroid_distance_array = np.sum(
+            self.centroid_array**2, axis=1) - 2 * self.centroid_array.dot(
+                query_feature)
+        probe_cluster_num = min(probe_cluster_num,
+                                self.centroid_array.shape[0])
+        cluster_indexes = np.argpartition(centroid_distance_array,
+                                          probe_cluster_num - 1)[0:probe_cluster_num]
+
+        # Scan the gallery features within these lists
+        row_indexes = np.hstack([
+            np.arange(self.list_offset_array[cluster_index],
+                      self.list_offset_array[cluster_index + 1])
+            for cluster_index in cluster_indexes
+        ]).astype(np.int64)
+        distance_array = self.compute_distances(probe_feature, row_indexes)
+
+        # Keep the closest gallery feature of each identity
+        order = np.argsort(distance_array, kind="mergesort")
+        row_indexes = row_indexes[order]
+        distance_array = distance_array[order]
+        _, first_indexes = np.unique(np.asarray(
+            self.identity_array[row_indexes]),
+                                     return_index=True)
+        first_indexes = np.sort(first_indexes)[0:top_k]
+
+        row_indexes = row_indexes[first_indexes]
+        return (np.asarray(self.identity_array[row_indexes]),
+                distance_array[first_indexes], row_indexes)
+
+    def identify(self,
+                 probe_feature,
+                 top_k,
+                 probability_func=None,
+                 probe_cluster_num=PROBE_CLUSTER_NUM):
+        """Identify the probe against the gallery.
+
+        :param probe_feature: the feature of the probe
+        :type probe_feature: numpy array
+        :param top_k: the number of identities
+        :type top_k: int
+        :param probability_func: the function object which computes the probabilities of the same person
+            from the probe feature and the gallery features, None means the probabilities are not computed
+        :type probability_func: object
+        :param probe_cluster_num: the number of inverted lists which are scanned
+        :type probe_cluster_num: int
+        :return: the identities with the distances and the probabilities
+        :rtype: list
+        """
+
+        identity_array, distance_array, row_indexes = self.search(
+            probe_feature, top_k, probe_cluster_num)
+
+        probability_array = [None] * len(row_indexes)
+        if probability_func is not None and len(row_indexes) > 0:
+            probability_array = probability_func(
+                np.asarray(probe_feature, dtype=np.float64).ravel(),
+                np.asarray(self.feature_array[row_indexes]))
+
+        return [{
+            "identity": int(identity),
+            "distance": float(distance),
+            "probability": None if probability is None else float(probability)
+        } for identity, distance, probability in zip(
+            identity_array, distance_array, probability_array)]
+
+    def get_identity_row_indexes(self, identity):
+        """Get the rows of the gallery features of one identity.
+
+        :param identity: the identity
+        :type identity: int
+        :return: the rows, which are empty for an unknown identity
+        :rtype: numpy array
+        """
+
+        key_index = np.searchsorted(self.identity_key_array, identity)
+        if key_index == len(self.identity_key_array) or \
+                self.identity_key_array[key_index] != identity:
+            return np.zeros(0, dtype=np.int64)
+        return np.asarray(self.identity_row_array[
+            self.identity_offset_array[key_index]:self.
+            identity_offset_array[key_index + 1]])
+
+    def verify(self, probe_feature, identity, probability_func=None):
+        """Verify the probe against the gallery features of one identity.
+
+        :param probe_feature: the feature of the probe
+        :type probe_feature: numpy array
+        :param identity: the claimed identity
+        :type identity: int
+        :param probability_func: the function object which computes the probabilities of the same person
+            from the probe feature and the gallery features, None means the probability is not computed
+        :type probability_func: object
+        :return: the distance and the probability of the closest gallery feature of the identity,
+            None refers to an unknown identity
+        :rtype: dict
+        """
+
+        probe_feature = np.asarray(probe_feature, dtype=np.float64).ravel()
+        row_indexes = self.get_identity_row_indexes(identity)
+        if len(row_indexes) == 0:
+            return None
+
+        distance_array = self.compute_distances(probe_feature, row_indexes)
+        best_row_index = row_indexes[np.argmin(distance_array)]
+
+        probability = None
+        if probability_func is not None:
+            probability = float(
+                probability_func(
+                    probe_feature,
+                    np.asarray(self.feature_array[[best_row_index]]))[0])
+
+        return {
+            "identity": int(identity),
+            "distance": float(np.min(distance_array)),
+            "probability": probability
+        }
+
+
+def build_identity_lookup(identity_array):
+    """Build the lookup from the identities to the rows of the gallery features.
+
+    :param identity_array: the identities of the gallery features
+    :type identity_array: numpy array
+    :return: the sorted unique identities, the first row of each identity followed by the number of rows,
+        and the rows sorted by the identities
+    :rtype: tuple
+    """
+
+    identity_row_array = np.argsort(np.asarray(identity_array),
+                                    kind="mergesort").astype(np.int64)
+    identity_key_array, identity_count_array = np.unique(
+        np.asarray(identity_array)[identity_row_array], return_counts=True)
+    identity_offset_array = np.hstack(
+        ([0], np.cumsum(identity_count_array))).astype(np.int64)
+    return (identity_key_array, identity_offset_array, identity_row_array)
+
+
+def build_gallery_index(feature_list,
+                        identity_list,
+                        metric="cosine",
+                        cluster_num=CLUSTER_NUM):
+    """Build the gallery index, e.g., from the output of solution_basic.load_feature.
+
+    :param feature_list: the gallery features
+    :type feature_list: list
+    :param identity_list: the identities of the gallery features
+    :type identity_list: list
+    :param metric: the metric which is used to compare the features, either "cosine" or "euclidean"
+    :type metric: string
+    :param cluster_num: the number of inverted lists, None means the square root of the number of gallery images
+    :type cluster_num: int
+    :return: the gallery index
+    :rtype: Gallery_Index
+    """
+
+    feature_array = np.asarray(feature_list, dtype=np.float32)
+    identity_array = np.asarray(identity_list, dtype=np.int64)
+    if cluster_num is None:
+        cluster_num = int(np.sqrt(feature_array.shape[0]))
+    cluster_num = max(1, min(cluster_num, feature_array.shape[0]))
+
+    # The clustering of the cosine metric is performed on the normalized features
+    clustering_feature_array = feature_array.astype(np.float64)
+    if metric == "cosine":
+        clustering_feature_array = pairwise_metrics.normalize_feature_array(
+            clustering_feature_array)
+    centroid_array = perform_kmeans(clustering_feature_array, cluster_num)
+
+    # Sort the gallery features by the inverted lists
+    assignment_array = assign_to_centroids(clustering_feature_array,
+                                           centroid_array)
+    order = np.argsort(assignment_array, kind="mergesort")
+    list_offset_array = np.hstack(
+        ([0], np.cumsum(np.bincount(assignment_array,
+                                    minlength=cluster_num)))).astype(np.int64)
+    feature_array = feature_array[order]
+    norm_array = np.sqrt(np.sum(feature_array.astype(np.float64)**2, axis=1))
+
+    identity_array = identity_array[order]
+    return Gallery_Index(centroid_array, feature_array, norm_array,
+                         identity_array, list_offset_array, metric,
+                         build_identity_lookup(identity_array))
+
+
+def get_gallery_index_prefix(facial_image_extension, feature_extension):
+    """Get the common prefix of the files in the gallery index.
+
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :return: the common prefix of the files in the gallery index
+    :rtype: string
+    """
+
+    selected_facial_image = os.path.splitext(facial_image_extension)[0][1:]
+    selected_feature = os.path.splitext(feature_extension)[0][1:]
+    return os.path.join(common.GALLERY_INDEX_FOLDER_PATH,
+                        selected_facial_image + "_with_" + selected_feature)
+
+
+def save_gallery_index(gallery_index, prefix):
+    """Save the gallery index to disk.
+
+    :param gallery_index: the gallery index
+    :type gallery_index: Gallery_Index
+    :param prefix: the common prefix of the files in the gallery index
+    :type prefix: string
+    :return: the gallery index will be saved to disk
+    :rtype: None
+    """
+
+    folder_path = os.path.dirname(prefix)
+    if not os.path.isdir(folder_path):
+        os.makedirs(folder_path)
+
+    for suffix, array in [(CENTROID_SUFFIX, gallery_index.centroid_array),
+                          (FEATURE_SUFFIX, gallery_index.feature_array),
+                          (NORM_SUFFIX, gallery_index.norm_array),
+                          (IDENTITY_SUFFIX, gallery_index.identity_array),
+                          (LIST_OFFSET_SUFFIX, gallery_index.list_offset_array),
+                          (IDENTITY_KEY_SUFFIX, gallery_index.identity_key_array),
+                          (IDENTITY_OFFSET_SUFFIX,
+                           gallery_index.identity_offset_array),
+                          (IDENTITY_ROW_SUFFIX, gallery_index.identity_row_array)
+                         ]:
+        np.save(prefix + suffix, array)
+
+    # The metadata is written at last, which marks the gallery index as complete
+    with open(prefix + METADATA_SUFFIX, "w") as metadata_file:
+        json.dump({"metric": gallery_index.metric}, metadata_file)
+
+
+def load_gallery_index(prefix):
+    """Load the gallery index, the gallery features are memory-mapped.
+
+    :param prefix: the common prefix of the files in the gallery index
+    :type prefix: string
+    :return: the gallery index
+    :rtype: Gallery_Index
+    """
+
+    with open(prefix + METADATA_SUFFIX) as metadata_file:
+        metadata = json.load(metadata_file)
+
+    # The identity lookup is built on the fly for the gallery indexes which were saved without it
+    identity_array = np.load(prefix + IDENTITY_SUFFIX, mmap_mode="r")
+    if os.path.isfile(prefix + IDENTITY_ROW_SUFFIX):
+        identity_lookup = (np.load(prefix + IDENTITY_KEY_SUFFIX),
+                           np.load(prefix + IDENTITY_OFFSET_SUFFIX),
+                           np.load(prefix + IDENTITY_ROW_SUFFIX,
+                                   mmap_mode="r"))
+    else:
+        identity_lookup = build_identity_lookup(identity_array)
+
+    return Gallery_Index(np.load(prefix + CENTROID_SUFFIX),
+                         np.load(prefix + FEATURE_SUFFIX, mmap_mode="r"),
+                         np.load(prefix + NORM_SUFFIX, mmap_mode="r"),
+                         identity_array, np.load(prefix + LIST_OFFSET_SUFFIX),
+                         metadata["metric"], identity_lookup)
+
+
+def init_probability_func(model_path, metric_list, projection=None):
+    """Init the function which computes the probabilities of the same person with a trained model.
+
+    :param model_path: the path of the Keras or scikit-learn model file
+    :type model_path: string
+    :param metric_list: the metrics which were used in training the model
+    :type metric_list: list
+    :param projection: the projection which was fitted together with the model, None means no projection
+    :type projection: feature_projection.Feature_Projection
+    :return: the function object which takes the probe feature and the gallery features
+    :rtype: object
+    """
+
+    if model_path.endswith(common.KERAS_MODEL_EXTENSION):
+        import keras_related
+
+        # Init a keras model with specific weights
+        model = keras_related.init_model(len(metric_list))
+        model.load_weights(model_path)
+        predict_proba_func = lambda final_feature_array: model.predict_proba(
+            final_feature_array, batch_size=final_feature_array.shape[0], verbose=0)
+    elif model_path.endswith(common.SCIKIT_LEARN_EXTENSION):
+        from sklearn.externals import joblib
+
+        model = joblib.load(model_path)
+        predict_proba_func = model.predict_proba
+    else:
+        raise ValueError("Unknown model file {}.".format(model_path))
+
+    def probability_func(probe_feature, gallery_feature_array):
+        # The gallery keeps the original features, so both sides are projected here
+        if projection is not None:
+            probe_feature = projection.transform(
+                np.atleast_2d(probe_feature))[0]
+            gallery_feature_array = projection.transform(gallery_feature_array)
+        final_feature_array = pairwise_metrics.compute_pairwise_metrics(
+            np.tile(probe_feature, (gallery_feature_array.shape[0], 1)),
+            gallery_feature_array, metric_list)
+        return predict_proba_func(final_feature_array)[:, 1]
+
+    return probability_func
+
+
+def serve_gallery_index(gallery_index,
+                        probability_func=None,
+                        port=SERVICE_PORT):
+    """Expose the gallery index via a local HTTP service.
+    POST /identify with {"feature": [...], "top_k": 5} returns the closest identities,
+    while POST /verify with {"feature": [...], "identity": 0} returns the result of the claimed identity.
+
+    :param gallery_index: the gallery index
+    :type gallery_index: Gallery_Index
+    :param probability_func: the function object which computes the probabilities of the same person
+    :type probability_func: object
+    :param port: the port of the service
+    :type port: int
+    :return: the service runs until it is interrupted
+    :rtype: None
+    """
+
+    class Request_Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, status_code, content):
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            try:
+                content_length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(
+                    self.rfile.read(content_length).decode("utf-8"))
+                probe_feature = np.array(request["feature"], dtype=np.float64)
+
+                if self.path == "/identify":
+                    result = gallery_index.identify(probe_feature,
+                                                    int(request.get("top_k", 5)),
+                                                    probability_func)
+                elif self.path == "/verify":
+                    result = gallery_index.verify(probe_feature,
+                                                  int(request["identity"]),
+                                                  probability_func)
+                else:
+                    self.send_json(404, {"error": "Unknown path {}.".format(
+                        self.path)})
+                    return
+            except (KeyError, TypeError, ValueError) as exception:
+                self.send_json(400, {"error": str(exception)})
+                return
+
+            self.send_json(200, {"result": result})
+
+    server = HTTPServer(("localhost", port), Request_Handler)
+    print("Serving the gallery index at http://localhost:{:d} ...".format(port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def run(facial_image_extension="_bbox.jpg",
+        feature_extension="_open_face.csv",
+        model_path=None):
+    import solution_basic
+
+    # Build the gallery index from the training images if necessary
+    prefix = get_gallery_index_prefix(facial_image_extension,
+                                      feature_extension)
+    if not os.path.isfile(prefix + METADATA_SUFFIX):
+        training_image_feature_list, training_image_index_list, _ = \
+            solution_basic.load_feature(facial_image_extension, feature_extension)
+        save_gallery_index(
+            build_gallery_index(training_image_feature_list,
+                                training_image_index_list), prefix)
+
+    gallery_index = load_gallery_index(prefix)
+    probability_func = None
+    if model_path is not None:
+        import feature_projection
+        import solution_keras
+
+        # The model may be trained on the projected features with fewer metrics
+        projection = feature_projection.load_projection(model_path)
+        metric_list = solution_basic.get_metric_list(
+            solution_keras.METRIC_LIST_DICT[feature_extension],
+            projection is not None)
+        probability_func = init_probability_func(model_path, metric_list,
+                                                 projection)
+    serve_gallery_index(gallery_index, probability_func)
+
+
+if __name__ == "__main__":
+    run()
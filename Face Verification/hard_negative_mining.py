@@ -0,0 +1,222 @@
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import numpy as np
+import pairwise_metrics
+
+# The number of anchors whose neighbours are searched at once
+ANCHOR_CHUNK_SIZE = 256
+
+# The number of threads which search the neighbours in parallel
+MINING_THREAD_NUM = multiprocessing.cpu_count()
+
+
+def search_nearest_negatives_within_chunk(normalized_feature_array,
+                                          index_array, anchor_indexes,
+                                          neighbor_num):
+    """Search the nearest neighbours from other persons for the anchors within one chunk.
+
+    :param normalized_feature_array: the normalized features of all images
+    :type normalized_feature_array: numpy array
+    :param index_array: the indexes of the images
+    :type index_array: numpy array
+    :param anchor_indexes: the rows of the anchors
+    :type anchor_indexes: numpy array
+    :param neighbor_num: the number of neighbours of each anchor
+    :type neighbor_num: int
+    :return: the rows of the anchors, the rows of the neighbours and the similarities
+    :rtype: tuple
+    """
+
+    # The similarity between the images from the same person is omitted
+    similarity_array = normalized_feature_array[anchor_indexes].dot(
+        normalized_feature_array.T)
+    similarity_array[index_array[anchor_indexes][:, np.newaxis] ==
+                     index_array[np.newaxis, :]] = -np.inf
+
+    neighbor_num = min(neighbor_num, similarity_array.shape[1] - 1)
+    neighbor_index_array = np.argpartition(-similarity_array,
+                                           neighbor_num - 1,
+                                           axis=1)[:, 0:neighbor_num]
+    neighbor_similarity_array = similarity_array[np.arange(
+        len(anchor_indexes))[:, np.newaxis], neighbor_index_array]
+    anchor_index_array = np.repeat(anchor_indexes, neighbor_num)
+
+    valid_flag_array = np.isfinite(neighbor_similarity_array.ravel())
+    return (anchor_index_array[valid_flag_array],
+            neighbor_index_array.ravel()[valid_flag_array],
+            neighbor_similarity_array.ravel()[valid_flag_array])
+
+
+def search_nearest_negatives(feature_array,
+                             index_array,
+                             neighbor_num,
+                             chunk_size=ANCHOR_CHUNK_SIZE,
+                             thread_num=MINING_THREAD_NUM):
+    """Search the nearest neighbours from other persons for all images.
+    The anchors are divided into chunks, and the chunks are processed by several threads.
+
+    :param feature_array: the features, one row for each image
+    :type feature_array: numpy array
+    :param index_array: the indexes of the images
+    :type index_array: numpy array
+    :param neighbor_num: the number of neighbours of each anchor
+    :type neighbor_num: int
+    :param chunk_size: the number of anchors which are processed at once
+    :type chunk_size: int
+    :param thread_num: the number of threads
+    :type thread_num: int
+    :return: the keys of the unique pairs, encoded as record_index_1 * record_num + record_index_2
+        with record_index_1 < record_index_2, and their similarities
+    :rtype: tuple
+    """
+
+    normalized_feature_array = pairwise_metrics.normalize_feature_array(
+        feature_array, np.float32)
+    index_array = np.asarray(index_array)
+    record_num = index_array.size
+
+    anchor_indexes_list = [
+        np.arange(start_index, min(start_index + chunk_size, record_num))
+        for start_index in range(0, record_num, chunk_size)
+    ]
+
+    # The matrix multiplication releases the GIL, so the threads run in parallel
+    pool = ThreadPool(processes=thread_num)
+    try:
+        result_list = pool.map(
+            lambda anchor_indexes: search_nearest_negatives_within_chunk(
+                normalized_feature_array, index_array, anchor_indexes,
+                neighbor_num), anchor_indexes_list)
+    finally:
+        pool.close()
+        pool.join()
+
+    anchor_index_array = np.hstack([result[0] for result in result_list])
+    neighbor_index_array = np.hstack([result[1] for result in result_list])
+    similarity_array = np.hstack([result[2] for result in result_list])
+
+    # The same pair may be found from both images, keep the unique ones
+    pair_key_array = np.minimum(anchor_index_array, neighbor_index_array).astype(np.int64) * record_num + \
+        np.maximum(anchor_index_array, neighbor_index_array)
+    pair_key_array, unique_indexes = np.unique(pair_key_array,
+                                               return_index=True)
+    return (pair_key_array, similarity_array[unique_indexes])
+
+
+def mine_hard_negative_record_index_pair_array(feature_array,
+                                               index_array,
+                                               sample_num,
+                                               excluded_pair_key_array=None):
+    """Mine the indexes of the image pairs which represent different persons but look similar.
+    The neighbours of each image are searched, and the most similar pairs are selected.
+
+    :param feature_array: the features, one row for each image
+    :type feature_array: numpy array
+    :param index_array: the indexes of the images
+    :type index_array: numpy array
+    :param sample_num: the number of pairs which will be mined
+    :type sample_num: int
+    :param excluded_pair_key_array: the keys of the pairs which should not be selected
+    :type excluded_pair_key_array: numpy array
+    :return: the indexes of the image pairs, without duplicates
+    :rtype: numpy array
+    """
+
+    record_num = np.asarray(index_array).size
+    if excluded_pair_key_array is None:
+        excluded_pair_key_array = np.zeros(0, dtype=np.int64)
+    excluded_pair_key_array = np.sort(excluded_pair_key_array)
+
+    # Each pair could be found from both images, so twice the average number of neighbours is searched at first
+    neighbor_num = int(np.ceil(2.0 *
+                               (sample_num + excluded_pair_key_array.size) /
+                               max(record_num, 1))) + 1
+    while True:
+        pair_key_array, similarity_array = search_nearest_negatives(
+            feature_array, index_array, neighbor_num)
+        valid_flag_array = np.ones(pair_key_array.size, dtype=bool)
+        if excluded_pair_key_array.size > 0:
+            position_array = np.minimum(
+                np.searchsorted(excluded_pair_key_array, pair_key_array),
+                excluded_pair_key_array.size - 1)
+            valid_flag_array = excluded_pair_key_array[
+                position_array] != pair_key_array
+        pair_key_array = pair_key_array[valid_flag_array]
+        similarity_array = similarity_array[valid_flag_array]
+
+        if pair_key_array.size >= sample_num or neighbor_num >= record_num - 1:
+            break
+        neighbor_num = min(2 * neighbor_num, record_num - 1)
+
+    if pair_key_array.size < sample_num:
+        raise ValueError("Cannot mine {:d} pairs out of {:d} candidates.".format(
+            sample_num, pair_key_array.size))
+
+    # Select the most similar pairs
+    selected_indexes = np.argsort(-similarity_array, kind="mergesort")[0:sample_num]
+    selected_pair_key_array = np.sort(pair_key_array[selected_indexes])
+    return np.vstack((selected_pair_key_array // record_num,
+                      selected_pair_key_array % record_num)).T
+
+
+def replace_with_hard_negatives(feature_array,
+                                index_array,
+                                record_map,
+                                hard_negative_proportion,
+                                random_seed=None):
+    """Replace a proportion of the sampled negative pairs with hard negative pairs.
+    The number of pairs stays the same.
+
+    :param feature_array: the features, one row for each image
+    :type feature_array: numpy array
+    :param index_array: the indexes of the images
+    :type index_array: numpy array
+    :param record_map: the indexes of the image pairs and whether these two images represent the same person
+    :type record_map: tuple
+    :param hard_negative_proportion: the proportion of the negative pairs which are replaced
+    :type hard_negative_proportion: float
+    :param random_seed: the seed of the random number generator, None means the global one is used
+    :type random_seed: int
+    :return: record_index_pair_array refers to the indexes of the image pairs,
+        while record_index_pair_label_array refers to whether these two images represent the same person.
+    :rtype: tuple
+    """
+
+    record_index_pair_array, record_index_pair_label_array = record_map
+    positive_record_index_pair_array = record_index_pair_array[
+        record_index_pair_label_array]
+    negative_record_index_pair_array = record_index_pair_array[
+        ~record_index_pair_label_array]
+
+    # Keep some of the sampled negative pairs at random
+    random_state = np.random if random_seed is None else np.random.RandomState(
+        random_seed)
+    hard_negative_num = int(
+        round(negative_record_index_pair_array.shape[0] *
+              hard_negative_proportion))
+    if hard_negative_num == 0:
+        return record_map
+    kept_indexes = np.sort(
+        random_state.choice(negative_record_index_pair_array.shape[0],
+                            negative_record_index_pair_array.shape[0] -
+                            hard_negative_num,
+                            replace=False))
+    negative_record_index_pair_array = negative_record_index_pair_array[
+        kept_indexes]
+
+    # Mine the hard negative pairs which are not kept
+    record_num = np.asarray(index_array).size
+    kept_pair_key_array = np.minimum(negative_record_index_pair_array[:, 0], negative_record_index_pair_array[:, 1]).astype(np.int64) * record_num + \
+        np.maximum(negative_record_index_pair_array[:, 0], negative_record_index_pair_array[:, 1])
+    hard_negative_record_index_pair_array = mine_hard_negative_record_index_pair_array(
+        feature_array, index_array, hard_negative_num, kept_pair_key_array)
+
+    record_index_pair_array = np.vstack(
+        (positive_record_index_pair_array, negative_record_index_pair_array,
+         hard_negative_record_index_pair_array))
+    record_index_pair_label_array = np.hstack(
+        (np.ones(positive_record_index_pair_array.shape[0], dtype=bool),
+         np.zeros(negative_record_index_pair_array.shape[0] +
+                  hard_negative_record_index_pair_array.shape[0],
+                  dtype=bool)))
+    return (record_index_pair_array, record_index_pair_label_array)
@@ -1,3 +1,4 @@
+from keras import backend as K
 from keras.callbacks import Callback
 from keras.layers.advanced_activations import PReLU
 from keras.layers.core import Dense, Dropout, Activation
@@ -5,8 +6,34 @@ from keras.layers.normalization import BatchNormalization
 from keras.models import Sequential
 from keras.utils import np_utils
 import evaluation
+import hard_negative_mining
 import numpy as np
 import os
+import pairwise_metrics
+import solution_basic
+import threading
+
+# Sequence is only available in recent versions of Keras
+try:
+    from keras.utils import Sequence
+except ImportError:
+    Sequence = object
+
+# The number of pairs in each batch
+BATCH_SIZE = 32
+
+# Variables related to the evaluation in Customized_Callback.
+# The model is evaluated every EVALUATION_INTERVAL epochs and after the last epoch,
+# on a stratified subsample of EVALUATION_SAMPLE_NUM pairs (None means all pairs),
+# and in a background thread on a snapshot of the weights if EVALUATE_ASYNCHRONOUSLY is True.
+EVALUATION_INTERVAL = 1
+EVALUATION_SAMPLE_NUM = None
+EVALUATE_ASYNCHRONOUSLY = False
+EVALUATION_RANDOM_SEED = 0
+
+# Variables related to the confidence interval of the score on the subsample
+BOOTSTRAP_NUM = 30
+CONFIDENCE_LEVEL = 0.95
 
 
 def init_model(dimension, unique_label_num=2):
@@ -45,12 +72,154 @@ def init_model(dimension, unique_label_num=2):
     return model
 
 
+class Pair_Batch_Generator(Sequence):
+    """Generate the batches of the final data set on the fly.
+    Only the features of the images and the indexes of the pairs are kept in memory,
+    and the negative pairs are sampled again at the end of each epoch.
+    """
+
+    def __init__(self,
+                 feature_array,
+                 index_array,
+                 metric_list,
+                 true_false_ratio,
+                 random_seed=None,
+                 batch_size=BATCH_SIZE,
+                 hard_negative_proportion=0):
+        """Init function.
+
+        :param feature_array: the features of the images, one row for each image
+        :type feature_array: numpy array
+        :param index_array: the indexes of the images
+        :type index_array: numpy array
+        :param metric_list: the metrics which will be used to compare two feature vectors
+        :type metric_list: list
+        :param true_false_ratio: the number of occurrences of true cases over the number of occurrences of false cases
+        :type true_false_ratio: int or float
+        :param random_seed: the seed of the random number generator in sampling, None means the global one is used
+        :type random_seed: int
+        :param batch_size: the number of pairs in each batch
+        :type batch_size: int
+        :param hard_negative_proportion: the proportion of the negative pairs which are replaced with hard negative pairs
+        :type hard_negative_proportion: float
+        :return: the class object will be initiated based on the arguments
+        :rtype: None
+        """
+
+        self.feature_array = feature_array
+        self.index_array = np.asarray(index_array)
+        self.metric_list = metric_list
+        self.random_seed = random_seed
+        self.batch_size = batch_size
+        self.hard_negative_proportion = hard_negative_proportion
+
+        # The positive pairs are the same in all epochs
+        self.positive_record_index_pair_array = solution_basic.get_positive_record_index_pair_array(
+            self.index_array)
+        self.negative_pair_num = int(
+            1.0 * self.positive_record_index_pair_array.shape[0] /
+            true_false_ratio)
+
+        self.epoch_index = 0
+        self.sample_record_map()
+
+    def sample_record_map(self):
+        """Sample the negative pairs, optionally replace some of them with hard negative pairs, and shuffle all pairs.
+
+        :return: the pairs of the current epoch will be updated
+        :rtype: None
+        """
+
+        random_seed = None if self.random_seed is None else self.random_seed + self.epoch_index
+        random_state = np.random if random_seed is None else np.random.RandomState(
+            random_seed)
+
+        negative_record_index_pair_array = solution_basic.sample_negative_record_index_pair_array(
+            self.index_array, self.negative_pair_num, random_seed)
+        record_index_pair_array = np.vstack(
+            (self.positive_record_index_pair_array,
+             negative_record_index_pair_array))
+        record_index_pair_label_array = np.hstack(
+            (np.ones(self.positive_record_index_pair_array.shape[0],
+                     dtype=bool), np.zeros(self.negative_pair_num,
+                                           dtype=bool)))
+        if self.hard_negative_proportion > 0:
+            record_index_pair_array, record_index_pair_label_array = hard_negative_mining.replace_with_hard_negatives(
+                self.feature_array, self.index_array,
+                (record_index_pair_array, record_index_pair_label_array),
+                self.hard_negative_proportion, random_seed)
+
+        order = random_state.permutation(record_index_pair_array.shape[0])
+        self.record_index_pair_array = record_index_pair_array[order]
+        self.record_index_pair_label_array = record_index_pair_label_array[
+            order]
+
+    def get_dimension(self):
+        """Get the dimension of the final features.
+
+        :return: the dimension of the final features
+        :rtype: int
+        """
+
+        if self.metric_list is None:
+            return self.feature_array.shape[1]
+        return len(self.metric_list)
+
+    def get_sample_num(self):
+        """Get the number of pairs in each epoch.
+
+        :return: the number of pairs
+        :rtype: int
+        """
+
+        return self.record_index_pair_array.shape[0]
+
+    def __len__(self):
+        return int(np.ceil(1.0 * self.get_sample_num() / self.batch_size))
+
+    def __getitem__(self, batch_index):
+        start_index = batch_index * self.batch_size
+        end_index = min(start_index + self.batch_size, self.get_sample_num())
+        record_index_pair_array = self.record_index_pair_array[
+            start_index:end_index]
+
+        X_batch = pairwise_metrics.compute_pairwise_metrics_by_index(
+            self.feature_array, record_index_pair_array[:, 0],
+            record_index_pair_array[:, 1], self.metric_list)
+        Y_batch = np_utils.to_categorical(
+            self.record_index_pair_label_array[start_index:end_index], 2)
+        return (X_batch, Y_batch)
+
+    def on_epoch_end(self):
+        self.epoch_index += 1
+        self.sample_record_map()
+
+    def generate(self):
+        """Generate the batches endlessly, which is what fit_generator of Keras 1 expects.
+
+        :return: the final features and the categorical labels of each batch
+        :rtype: generator
+        """
+
+        while True:
+            for batch_index in range(len(self)):
+                yield self[batch_index]
+            self.on_epoch_end()
+
+
 class Customized_Callback(Callback):
     """Customized Callback. The code is inspired by the definition of ModelCheckpoint.
     The model file will be updated only if the new coefficients achieve higher score.
     """
 
-    def __init__(self, model_path, X_test, Y_test, monitor="score"):
+    def __init__(self,
+                 model_path,
+                 X_test,
+                 Y_test,
+                 monitor="score",
+                 evaluation_interval=EVALUATION_INTERVAL,
+                 evaluation_sample_num=EVALUATION_SAMPLE_NUM,
+                 evaluate_asynchronously=EVALUATE_ASYNCHRONOUSLY):
         """Init function.
         
         :param model_path: the path of the model file
@@ -61,6 +230,12 @@ class Customized_Callback(Callback):
         :type Y_test: numpy array
         :param monitor: the name of the error metric
         :type monitor: string
+        :param evaluation_interval: the number of epochs between two evaluations
+        :type evaluation_interval: int
+        :param evaluation_sample_num: the number of pairs in the stratified subsample, None means all pairs
+        :type evaluation_sample_num: int
+        :param evaluate_asynchronously: whether the evaluation runs in a background thread on a snapshot of the weights
+        :type evaluate_asynchronously: boolean
         :return: the class object will be initiated based on the arguments
         :rtype: None
         """
@@ -70,35 +245,213 @@ class Customized_Callback(Callback):
         self.model_path = model_path
         self.best_score_index = None
         self.best_score = -np.Inf
+        self.evaluation_interval = evaluation_interval
+        self.evaluate_asynchronously = evaluate_asynchronously
+        self.last_epoch = None
+        self.last_logs = {}
+        self.last_evaluated_epoch = None
+        self.evaluation_thread = None
+        self.model_snapshot = None
+        self.session = None
+
+        # Select a fixed subsample which keeps the proportion of each label
+        self.use_subsample = evaluation_sample_num is not None and evaluation_sample_num < len(
+            Y_test)
+        if self.use_subsample:
+            random_state = np.random.RandomState(EVALUATION_RANDOM_SEED)
+            selected_indexes_list = []
+            for label in np.unique(Y_test):
+                label_indexes = np.flatnonzero(Y_test == label)
+                label_sample_num = max(
+                    int(round(1.0 * evaluation_sample_num *
+                              label_indexes.size / len(Y_test))), 1)
+                selected_indexes_list.append(
+                    random_state.choice(label_indexes,
+                                        label_sample_num,
+                                        replace=False))
+            selected_indexes = np.sort(np.hstack(selected_indexes_list))
+            X_test = X_test[selected_indexes]
+            Y_test = Y_test[selected_indexes]
         self.X_test = X_test
         self.Y_test = Y_test
 
-    def on_epoch_end(self, epoch, logs={}):
-        """This function will be called after each epoch.
-        
+    def compute_confidence_interval(self, prediction):
+        """Compute the bootstrap confidence interval of the score on the subsample.
+
+        :param prediction: the prediction of the subsample
+        :type prediction: numpy array
+        :return: the lower and upper bounds of the score
+        :rtype: tuple
+        """
+
+        random_state = np.random.RandomState(EVALUATION_RANDOM_SEED)
+        score_list = []
+        for _ in range(BOOTSTRAP_NUM):
+            selected_indexes = random_state.randint(0, len(self.Y_test),
+                                                    len(self.Y_test))
+            if np.unique(self.Y_test[selected_indexes]).size < 2:
+                continue
+            score_list.append(
+                evaluation.compute_Weighted_AUC(self.Y_test[selected_indexes],
+                                                prediction[selected_indexes]))
+        if len(score_list) == 0:
+            return (np.nan, np.nan)
+
+        tail_proportion = (1 - CONFIDENCE_LEVEL) / 2
+        return tuple(
+            np.percentile(score_list,
+                          [100 * tail_proportion, 100 * (1 - tail_proportion)]))
+
+    def evaluate(self, model, epoch, model_path):
+        """Evaluate the model, and save the weights if they achieve higher score.
+
+        :param model: the model, or the snapshot of it
+        :type model: object
         :param epoch: the index of the epoch
         :type epoch: int
-        :param logs: contain keys for quantities relevant to the current batch or epoch
-        :type logs: dict
+        :param model_path: the path of the model file
+        :type model_path: string
         :return: the model file will be updated if necessary
         :rtype: None
         """
 
-        model_path = self.model_path.format(epoch=epoch, **logs)
-
-        probability_estimates = self.model.predict_proba(self.X_test, verbose=0)
+        probability_estimates = model.predict_proba(self.X_test, verbose=0)
         prediction = probability_estimates[:, 1]
         score = evaluation.compute_Weighted_AUC(self.Y_test, prediction)
 
+        confidence_interval_description = ""
+        if self.use_subsample:
+            lower_bound, upper_bound = self.compute_confidence_interval(
+                prediction)
+            confidence_interval_description = " ({:.0f}% CI [{:.4f}, {:.4f}] on {:d} pairs)".format(
+                100 * CONFIDENCE_LEVEL, lower_bound, upper_bound,
+                len(self.Y_test))
+
         if self.best_score < 0 or score > self.best_score:
-            print("In epoch {:05d}: {} improved from {:.4f} to {:.4f}, saving model to {}.".format(\
-                    epoch + 1, self.monitor, self.best_score, score, os.path.basename(model_path)))
+            print("In epoch {:05d}: {} improved from {:.4f} to {:.4f}{}, saving model to {}.".format(\
+                    epoch + 1, self.monitor, self.best_score, score,
+                    confidence_interval_description, os.path.basename(model_path)))
             self.best_score_index = epoch + 1
             self.best_score = score
-            self.model.save_weights(model_path, overwrite=True)
+            model.save_weights(model_path, overwrite=True)
         else:
             pass
 
+    def wait_for_evaluation(self):
+        """Wait until the pending evaluation in the background thread finishes.
+
+        :return: the pending evaluation will be finished
+        :rtype: None
+        """
+
+        if self.evaluation_thread is not None:
+            self.evaluation_thread.join()
+            self.evaluation_thread = None
+
+    def schedule_evaluation(self, epoch, model_path):
+        """Evaluate the current weights, either at once or in a background thread.
+
+        :param epoch: the index of the epoch
+        :type epoch: int
+        :param model_path: the path of the model file
+        :type model_path: string
+        :return: the evaluation will be performed
+        :rtype: None
+        """
+
+        self.last_evaluated_epoch = epoch
+        if not self.evaluate_asynchronously:
+            self.evaluate(self.model, epoch, model_path)
+            return
+
+        # The evaluations are performed in order, at most one of them is pending
+        self.wait_for_evaluation()
+
+        # Evaluate a copy of the current weights, so that the training goes on meanwhile
+        if self.model_snapshot is None:
+            self.init_model_snapshot()
+        self.model_snapshot.set_weights(self.model.get_weights())
+        self.evaluation_thread = threading.Thread(
+            target=self.evaluate_in_background,
+            args=(self.model_snapshot, epoch, model_path))
+        self.evaluation_thread.start()
+
+    def init_model_snapshot(self):
+        """Init the model which holds the snapshots of the weights.
+        It is built once, and its predict function is compiled in the main thread.
+
+        :return: the model snapshot will be set
+        :rtype: None
+        """
+
+        self.model_snapshot = init_model(self.X_test.shape[1],
+                                         self.model.get_weights()[-1].size)
+
+        # The predict function is created lazily, and Sequential wraps the inner model in Keras 1
+        inner_model = getattr(self.model_snapshot, "model",
+                              self.model_snapshot)
+        if hasattr(inner_model, "_make_predict_function"):
+            inner_model._make_predict_function()
+
+        # The graph and the session of TensorFlow are only set in the main thread
+        if K.backend() == "tensorflow":
+            self.session = K.get_session()
+
+    def evaluate_in_background(self, model, epoch, model_path):
+        """Evaluate the model in the background thread within the graph and the session of the main thread.
+
+        :param model: the snapshot of the model
+        :type model: object
+        :param epoch: the index of the epoch
+        :type epoch: int
+        :param model_path: the path of the model file
+        :type model_path: string
+        :return: the model file will be updated if necessary
+        :rtype: None
+        """
+
+        if self.session is None:
+            self.evaluate(model, epoch, model_path)
+            return
+
+        with self.session.graph.as_default(), self.session.as_default():
+            self.evaluate(model, epoch, model_path)
+
+    def on_epoch_end(self, epoch, logs={}):
+        """This function will be called after each epoch.
+        
+        :param epoch: the index of the epoch
+        :type epoch: int
+        :param logs: contain keys for quantities relevant to the current batch or epoch
+        :type logs: dict
+        :return: the model file will be updated if necessary
+        :rtype: None
+        """
+
+        self.last_epoch = epoch
+        self.last_logs = logs
+        if (epoch + 1) % self.evaluation_interval == 0:
+            self.schedule_evaluation(epoch,
+                                     self.model_path.format(epoch=epoch,
+                                                            **logs))
+
+    def on_train_end(self, logs={}):
+        """This function will be called at the end of the training phase.
+        The last epoch is always evaluated, since it may be skipped by the evaluation interval.
+
+        :param logs: contain keys for quantities relevant to the training phase
+        :type logs: dict
+        :return: the model file will be updated if necessary
+        :rtype: None
+        """
+
+        if self.last_epoch is not None and self.last_evaluated_epoch != self.last_epoch:
+            self.schedule_evaluation(
+                self.last_epoch,
+                self.model_path.format(epoch=self.last_epoch,
+                                       **self.last_logs))
+        self.wait_for_evaluation()
+
     def inspect_details(self):
         """Inspect the details of the training phase.
         
@@ -107,15 +460,16 @@ class Customized_Callback(Callback):
         :rtype: tuple
         """
 
+        self.wait_for_evaluation()
         return (self.best_score_index, self.best_score)
 
 
 def train_model(X_train, Y_train, X_test, Y_test, model_path, nb_epoch):
     """Training phase.
     
-    :param X_train: the training attributes
-    :type X_train: numpy array
-    :param Y_train: the training labels
+    :param X_train: the training attributes, or the generator which yields the batches of them
+    :type X_train: numpy array or Pair_Batch_Generator
+    :param Y_train: the training labels, which are omitted if X_train is a generator
     :type Y_train: numpy array
     :param X_test: the testing attributes
     :type X_test: numpy array
@@ -131,20 +485,32 @@ def train_model(X_train, Y_train, X_test, Y_test, model_path, nb_epoch):
     """
 
     # Init a keras model
-    dimension = X_train.shape[1]
-    unique_label_num = np.size(np.unique(Y_train))
+    if isinstance(X_train, Pair_Batch_Generator):
+        dimension = X_train.get_dimension()
+        unique_label_num = 2
+    else:
+        dimension = X_train.shape[1]
+        unique_label_num = np.size(np.unique(Y_train))
     model = init_model(dimension, unique_label_num)
 
     # Start the training phase
     customized_callback = Customized_Callback(model_path=model_path,
                                               X_test=X_test,
                                               Y_test=Y_test)
-    categorical_Y_train = np_utils.to_categorical(Y_train, unique_label_num)
-    model.fit(X_train,
-              categorical_Y_train,
-              batch_size=32,
-              nb_epoch=nb_epoch,
-              verbose=0,
-              callbacks=[customized_callback])
+    if isinstance(X_train, Pair_Batch_Generator):
+        model.fit_generator(X_train.generate(),
+                            samples_per_epoch=X_train.get_sample_num(),
+                            nb_epoch=nb_epoch,
+                            verbose=0,
+                            callbacks=[customized_callback])
+    else:
+        categorical_Y_train = np_utils.to_categorical(Y_train,
+                                                      unique_label_num)
+        model.fit(X_train,
+                  categorical_Y_train,
+                  batch_size=BATCH_SIZE,
+                  nb_epoch=nb_epoch,
+                  verbose=0,
+                  callbacks=[customized_callback])
 
     return customized_callback.inspect_details()
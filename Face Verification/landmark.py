@@ -2,28 +2,25 @@ import common
 import cv2
 
 
-def retrieve_facial_image_by_bbox(full_image_path, force_continue=True):
-    """Retrieve the facial image by using bbox coordinates.
+def crop_facial_image_by_bbox(full_image, bbox):
+    """Crop the facial image from a decoded full image by using bbox coordinates.
     
-    :param full_image_path: the path of the full image
-    :type full_image_path: string
-    :param force_continue: unused argument, for consistency with other functions
-    :type force_continue: boolean
-    :return: the facial image
+    :param full_image: the full image
+    :type full_image: numpy array
+    :param bbox: the content of the bbox file
+    :type bbox: numpy array
+    :return: the facial image, None refers to a failure
     :rtype: numpy array
     """
 
     try:
-        # Read the coordinates of facial image from the bbox file
-        bbox_file_path = full_image_path + common.BBOX_EXTENSION
-        y, x, w, h = common.read_from_file(bbox_file_path)
+        y, x, w, h = bbox
         x_start = int(x)
         x_end = int(x + h)
         y_start = int(y)
         y_end = int(y + w)
 
         # Generate the resized facial image
-        full_image = cv2.imread(full_image_path)
         facial_image = full_image[x_start:x_end, y_start:y_end, :]
         facial_image = cv2.resize(facial_image,
                                   dsize=(common.FACIAL_IMAGE_SIZE,
@@ -35,3 +32,45 @@ def retrieve_facial_image_by_bbox(full_image_path, force_continue=True):
     except:
         # Failure case
         return None
+
+
+def crop_facial_images_by_bbox(full_image_list, bbox_list,
+                               force_continue=True):
+    """Crop the facial images from decoded full images by using bbox coordinates.
+    
+    :param full_image_list: the full images
+    :type full_image_list: list
+    :param bbox_list: the contents of the bbox files
+    :type bbox_list: list
+    :param force_continue: unused argument, for consistency with other functions
+    :type force_continue: boolean
+    :return: the facial images, None refers to a failure
+    :rtype: list
+    """
+
+    return [
+        crop_facial_image_by_bbox(full_image, bbox)
+        for full_image, bbox in zip(full_image_list, bbox_list)
+    ]
+
+
+def retrieve_facial_image_by_bbox(full_image_path, force_continue=True):
+    """Retrieve the facial image by using bbox coordinates.
+    
+    :param full_image_path: the path of the full image
+    :type full_image_path: string
+    :param force_continue: unused argument, for consistency with other functions
+    :type force_continue: boolean
+    :return: the facial image
+    :rtype: numpy array
+    """
+
+    try:
+        # Read the coordinates of facial image from the bbox file
+        bbox_file_path = full_image_path + common.BBOX_EXTENSION
+        bbox = common.read_from_file(bbox_file_path)
+        full_image = cv2.imread(full_image_path)
+        return crop_facial_image_by_bbox(full_image, bbox)
+    except:
+        # Failure case
+        return None
@@ -1,17 +1,24 @@
-from landmark import retrieve_facial_image_by_bbox
+from landmark import crop_facial_image_by_bbox
 import argparse
 import common
 import cv2
-import openface
+import numpy as np
 import os
 
+# The objects which are initiated on first use
+args = None
+align = None
+net = None
 
-def init_open_face_module():
-    """Initiate the open face module."""
 
+def init_open_face_alignment():
+    """Initiate the face alignment of the open face module."""
+
+    global openface
     global args
     global align
-    global net
+
+    import openface
 
     openface_path = common.OPENFACE_PATH
     modelDir = os.path.join(openface_path, "models")
@@ -38,22 +45,44 @@ def init_open_face_module():
     args = parser.parse_args()
 
     align = openface.AlignDlib(args.dlibFacePredictor)
-    net = openface.TorchNeuralNet(args.networkModel, args.imgDim, cuda=True)
 
 
-def retrieve_facial_image_by_open_face(full_image_path, force_continue=True):
-    """Retrieve the facial image by using open face.
+def init_open_face_module(use_gpu=True):
+    """Initiate the open face module.
     
-    :param full_image_path: the path of the full image
-    :type full_image_path: string
+    :param use_gpu: whether run the Torch network on GPU
+    :type use_gpu: boolean
+    """
+
+    global net
+
+    if align is None:
+        init_open_face_alignment()
+
+    net = openface.TorchNeuralNet(args.networkModel,
+                                  args.imgDim,
+                                  cuda=use_gpu)
+
+
+def crop_facial_image_by_open_face(full_image_in_BGR,
+                                   bbox,
+                                   force_continue=True):
+    """Crop the facial image from a decoded full image by using open face.
+    
+    :param full_image_in_BGR: the full image
+    :type full_image_in_BGR: numpy array
+    :param bbox: the content of the bbox file, which is used when open face fails
+    :type bbox: numpy array
     :param force_continue: whether crop facial images by using bbox coordinates
     :type force_continue: boolean
     :return: the facial image
     :rtype: numpy array
     """
 
+    if align is None:
+        init_open_face_alignment()
+
     try:
-        full_image_in_BGR = cv2.imread(full_image_path)
         full_image_in_RGB = cv2.cvtColor(full_image_in_BGR, cv2.COLOR_BGR2RGB)
         bounding_box = align.getLargestFaceBoundingBox(full_image_in_RGB)
         facial_image_in_RGB = align.align(common.FACIAL_IMAGE_SIZE, full_image_in_RGB, bounding_box, \
@@ -65,11 +94,104 @@ def retrieve_facial_image_by_open_face(full_image_path, force_continue=True):
     except:
         # Failure case
         if force_continue:
-            return retrieve_facial_image_by_bbox(full_image_path)
+            return crop_facial_image_by_bbox(full_image_in_BGR, bbox)
         else:
             return None
 
 
+def crop_facial_images_by_open_face(full_image_list,
+                                    bbox_list,
+                                    force_continue=True):
+    """Crop the facial images from decoded full images by using open face.
+    
+    :param full_image_list: the full images
+    :type full_image_list: list
+    :param bbox_list: the contents of the bbox files
+    :type bbox_list: list
+    :param force_continue: whether crop facial images by using bbox coordinates
+    :type force_continue: boolean
+    :return: the facial images, None refers to a failure
+    :rtype: list
+    """
+
+    return [
+        crop_facial_image_by_open_face(full_image_in_BGR, bbox, force_continue)
+        for full_image_in_BGR, bbox in zip(full_image_list, bbox_list)
+    ]
+
+
+def retrieve_facial_image_by_open_face(full_image_path, force_continue=True):
+    """Retrieve the facial image by using open face.
+    
+    :param full_image_path: the path of the full image
+    :type full_image_path: string
+    :param force_continue: whether crop facial images by using bbox coordinates
+    :type force_continue: boolean
+    :return: the facial image
+    :rtype: numpy array
+    """
+
+    # Read the full image and the coordinates of facial image from the bbox file
+    full_image_in_BGR = cv2.imread(full_image_path)
+    try:
+        bbox = common.read_from_file(full_image_path + common.BBOX_EXTENSION)
+    except:
+        bbox = None
+
+    return crop_facial_image_by_open_face(full_image_in_BGR, bbox,
+                                          force_continue)
+
+
+def convert_facial_image_for_open_face(facial_image_in_BGR):
+    """Convert the facial image to the input of open face.
+    
+    :param facial_image_in_BGR: the facial image
+    :type facial_image_in_BGR: numpy array
+    :return: the resized facial image in RGB, None refers to a failure
+    :rtype: numpy array
+    """
+
+    try:
+        facial_image_in_BGR = cv2.resize(facial_image_in_BGR,
+                                         dsize=(args.imgDim, args.imgDim))
+        return cv2.cvtColor(facial_image_in_BGR, cv2.COLOR_BGR2RGB)
+    except:
+        return None
+
+
+def load_facial_image_for_open_face(facial_image_path):
+    """Load the facial image and convert it to the input of open face.
+    
+    :param facial_image_path: the path of the facial image
+    :type facial_image_path: string
+    :return: the resized facial image in RGB, None refers to a failure
+    :rtype: numpy array
+    """
+
+    try:
+        assert os.path.isfile(facial_image_path)
+        return convert_facial_image_for_open_face(cv2.imread(facial_image_path))
+    except:
+        return None
+
+
+def retrieve_features_by_open_face(facial_image_list):
+    """Retrieve the deep features of a batch of facial images by using open face.
+    The Torch network of OpenFace only accepts one image per forward pass,
+    so the images within the batch are fed one after another.
+    
+    :param facial_image_list: the facial images returned by load_facial_image_for_open_face
+    :type facial_image_list: list
+    :return: the deep features, one row for each facial image
+    :rtype: numpy array
+    """
+
+    return np.array([
+        net.forward(facial_image_in_RGB)
+        for facial_image_in_RGB in facial_image_list
+    ])
+
+
 def retrieve_feature_by_open_face(facial_image_path, feature_file_path):
     """Retrieve the deep feature by using open face.
     
@@ -88,12 +210,9 @@ def retrieve_feature_by_open_face(facial_image_path, feature_file_path):
             return feature
 
         # Retrieve feature
-        assert os.path.isfile(facial_image_path)
-        facial_image_in_BGR = cv2.imread(facial_image_path)
-        facial_image_in_BGR = cv2.resize(facial_image_in_BGR,
-                                         dsize=(args.imgDim, args.imgDim))
-        facial_image_in_RGB = cv2.cvtColor(facial_image_in_BGR,
-                                           cv2.COLOR_BGR2RGB)
+        facial_image_in_RGB = load_facial_image_for_open_face(
+            facial_image_path)
+        assert facial_image_in_RGB is not None
         feature = net.forward(facial_image_in_RGB)
 
         # Successful case. Save feature to file.
@@ -0,0 +1,153 @@
+import common
+import hashlib
+import numpy as np
+import os
+import tempfile
+
+# The extension of the cached final data sets
+CACHE_FILE_EXTENSION = ".npz"
+
+# Increase it whenever the final data sets are computed differently
+CACHE_VERSION = 1
+
+
+def get_cache_key(selected_feature_array,
+                  selected_index_array,
+                  true_false_ratio,
+                  metric_list,
+                  random_seed,
+                  hard_negative_proportion=0):
+    """Get the key of the final data set, which is the digest of everything it depends on.
+
+    :param selected_feature_array: the features of the selected records
+    :type selected_feature_array: numpy array
+    :param selected_index_array: the indexes of the selected records
+    :type selected_index_array: numpy array
+    :param true_false_ratio: the number of occurrences of true cases over the number of occurrences of false cases
+    :type true_false_ratio: int or float
+    :param metric_list: the metrics which will be used to compare two feature vectors
+    :type metric_list: list
+    :param random_seed: the seed of the random number generator in sampling
+    :type random_seed: int
+    :param hard_negative_proportion: the proportion of the sampled negative pairs which are replaced with hard negative pairs
+    :type hard_negative_proportion: float
+    :return: the key of the final data set
+    :rtype: string
+    """
+
+    digest = hashlib.sha1()
+    for array in [selected_feature_array, selected_index_array]:
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.dtype.str, array.shape)).encode("utf-8"))
+        digest.update(array.data)
+    digest.update(
+        repr((CACHE_VERSION, true_false_ratio, metric_list, random_seed,
+              hard_negative_proportion)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_cache_file_path(cache_key):
+    """Get the path of the cache file.
+
+    :param cache_key: the key of the final data set
+    :type cache_key: string
+    :return: the path of the cache file
+    :rtype: string
+    """
+
+    return os.path.join(common.PAIR_FEATURE_CACHE_FOLDER_PATH,
+                        cache_key + CACHE_FILE_EXTENSION)
+
+
+def load_from_cache(cache_key):
+    """Load the final data set from the cache.
+
+    :param cache_key: the key of the final data set
+    :type cache_key: string
+    :return: the feature array and the label array, None refers to a cache miss
+    :rtype: tuple
+    """
+
+    cache_file_path = get_cache_file_path(cache_key)
+    try:
+        with np.load(cache_file_path) as cache_file_content:
+            final_data_set = (cache_file_content["feature_array"],
+                              cache_file_content["label_array"])
+
+        # Mark the cache file as recently used
+        os.utime(cache_file_path, None)
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+    return final_data_set
+
+
+def save_to_cache(cache_key, feature_array, label_array):
+    """Save the final data set to the cache, and evict the least recently used ones if necessary.
+
+    :param cache_key: the key of the final data set
+    :type cache_key: string
+    :param feature_array: the feature array
+    :type feature_array: numpy array
+    :param label_array: the label array
+    :type label_array: numpy array
+    :return: the cache file will be saved to disk
+    :rtype: None
+    """
+
+    if not os.path.isdir(common.PAIR_FEATURE_CACHE_FOLDER_PATH):
+        try:
+            os.makedirs(common.PAIR_FEATURE_CACHE_FOLDER_PATH)
+        except OSError:
+            # The folder may be created by another process concurrently
+            pass
+
+    # Write into a temporary file, so that incomplete cache files are never visible
+    file_descriptor, temporary_file_path = tempfile.mkstemp(
+        suffix=".tmp", dir=common.PAIR_FEATURE_CACHE_FOLDER_PATH)
+    try:
+        with os.fdopen(file_descriptor, "wb") as temporary_file:
+            np.savez_compressed(temporary_file,
+                                feature_array=feature_array,
+                                label_array=label_array)
+        os.rename(temporary_file_path, get_cache_file_path(cache_key))
+    finally:
+        if os.path.isfile(temporary_file_path):
+            os.remove(temporary_file_path)
+
+    evict_cache_files(common.PAIR_FEATURE_CACHE_MAX_SIZE)
+
+
+def evict_cache_files(max_size):
+    """Remove the least recently used cache files until the total size does not exceed the limit.
+
+    :param max_size: the maximum total size of the cache files in bytes
+    :type max_size: int
+    :return: the cache files will be removed
+    :rtype: None
+    """
+
+    cache_file_record_list = []
+    for cache_file_name in os.listdir(common.PAIR_FEATURE_CACHE_FOLDER_PATH):
+        if not cache_file_name.endswith(CACHE_FILE_EXTENSION):
+            continue
+        cache_file_path = os.path.join(common.PAIR_FEATURE_CACHE_FOLDER_PATH,
+                                       cache_file_name)
+        try:
+            cache_file_stat = os.stat(cache_file_path)
+        except OSError:
+            continue
+        cache_file_record_list.append((cache_file_stat.st_mtime,
+                                       cache_file_stat.st_size,
+                                       cache_file_path))
+
+    total_size = np.sum([record[1] for record in cache_file_record_list])
+    for _, cache_file_size, cache_file_path in sorted(cache_file_record_list):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(cache_file_path)
+        except OSError:
+            # The file may be removed by another process concurrently
+            pass
+        total_size -= cache_file_size
@@ -0,0 +1,103 @@
+import common
+import hashlib
+import numpy as np
+import os
+import tempfile
+
+# The extension of the pair manifests
+MANIFEST_FILE_EXTENSION = ".npy"
+
+# Increase it whenever the pairs are sampled differently
+MANIFEST_VERSION = 1
+
+
+def get_manifest_key(index_array, true_false_ratio, random_seed):
+    """Get the key of the pair manifest, which is the digest of everything the sampling depends on.
+    The features are not involved, so that the manifest is shared by all features.
+
+    :param index_array: the indexes of the images
+    :type index_array: numpy array
+    :param true_false_ratio: the number of occurrences of true cases over the number of occurrences of false cases
+    :type true_false_ratio: int or float
+    :param random_seed: the seed of the random number generator in sampling
+    :type random_seed: int
+    :return: the key of the pair manifest
+    :rtype: string
+    """
+
+    index_array = np.ascontiguousarray(index_array, dtype=np.int64)
+    digest = hashlib.sha1()
+    digest.update(index_array.data)
+    digest.update(
+        repr((MANIFEST_VERSION, index_array.shape, float(true_false_ratio),
+              int(random_seed))).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_manifest_file_path(manifest_key):
+    """Get the path of the pair manifest.
+
+    :param manifest_key: the key of the pair manifest
+    :type manifest_key: string
+    :return: the path of the pair manifest
+    :rtype: string
+    """
+
+    return os.path.join(common.PAIR_MANIFEST_FOLDER_PATH,
+                        manifest_key + MANIFEST_FILE_EXTENSION)
+
+
+def load_pair_manifest(manifest_key):
+    """Load the pair manifest.
+
+    :param manifest_key: the key of the pair manifest
+    :type manifest_key: string
+    :return: record_index_pair_array refers to the indexes of the image pairs,
+        while record_index_pair_label_array refers to whether these two images represent the same person.
+        None refers to a missing manifest.
+    :rtype: tuple
+    """
+
+    try:
+        manifest = np.load(get_manifest_file_path(manifest_key))
+    except (IOError, OSError, ValueError):
+        return None
+
+    return (manifest[:, 0:2].astype(np.int64), manifest[:, 2].astype(bool))
+
+
+def save_pair_manifest(manifest_key, record_index_pair_array,
+                       record_index_pair_label_array):
+    """Save the pair manifest as (i, j, label) triples in int32.
+
+    :param manifest_key: the key of the pair manifest
+    :type manifest_key: string
+    :param record_index_pair_array: the indexes of the image pairs
+    :type record_index_pair_array: numpy array
+    :param record_index_pair_label_array: whether these two images represent the same person
+    :type record_index_pair_label_array: numpy array
+    :return: the pair manifest will be saved to disk
+    :rtype: None
+    """
+
+    if not os.path.isdir(common.PAIR_MANIFEST_FOLDER_PATH):
+        try:
+            os.makedirs(common.PAIR_MANIFEST_FOLDER_PATH)
+        except OSError:
+            # The folder may be created by another process concurrently
+            pass
+
+    manifest = np.column_stack(
+        (record_index_pair_array,
+         record_index_pair_label_array)).astype(np.int32)
+
+    # Write into a temporary file, so that incomplete manifests are never visible
+    file_descriptor, temporary_file_path = tempfile.mkstemp(
+        suffix=".tmp", dir=common.PAIR_MANIFEST_FOLDER_PATH)
+    try:
+        with os.fdopen(file_descriptor, "wb") as temporary_file:
+            np.save(temporary_file, manifest)
+        os.rename(temporary_file_path, get_manifest_file_path(manifest_key))
+    finally:
+        if os.path.isfile(temporary_file_path):
+            os.remove(temporary_file_path)
@@ -0,0 +1,251 @@
+import numpy as np
+
+# The metrics which are computed on the boolean version of the features
+BOOLEAN_METRIC_LIST = [
+    "dice", "kulsinski", "matching", "rogerstanimoto", "russellrao",
+    "sokalmichener", "sokalsneath"
+]
+
+# The number of pairs which are processed at once
+CHUNK_SIZE = 4096
+
+
+def normalize_feature_array(feature_array, dtype=None):
+    """Normalize the features to unit length, so that the dot product equals the cosine similarity.
+
+    :param feature_array: the features, one row for each image
+    :type feature_array: numpy array
+    :param dtype: the data type of the normalized features, None means the data type of the features is kept
+    :type dtype: numpy dtype
+    :return: the normalized features
+    :rtype: numpy array
+    """
+
+    feature_array = np.asarray(feature_array, dtype=dtype)
+    norm_array = np.sqrt(np.sum(feature_array**2, axis=1, keepdims=True))
+    norm_array[norm_array == 0] = 1
+    return feature_array / norm_array
+
+
+def compute_real_metric(metric, feature_array_1, feature_array_2):
+    """Compute a real-valued metric between the features of the pairs.
+
+    :param metric: the name of the metric
+    :type metric: string
+    :param feature_array_1: the first features of the pairs
+    :type feature_array_1: numpy array
+    :param feature_array_2: the second features of the pairs
+    :type feature_array_2: numpy array
+    :return: the distances of the pairs
+    :rtype: numpy array
+    """
+
+    if metric in ["euclidean", "l2", "minkowski"]:
+        return np.sqrt(np.sum((feature_array_1 - feature_array_2)**2, axis=1))
+
+    if metric == "sqeuclidean":
+        return np.sum((feature_array_1 - feature_array_2)**2, axis=1)
+
+    if metric in ["l1", "manhattan", "cityblock"]:
+        return np.sum(np.abs(feature_array_1 - feature_array_2), axis=1)
+
+    if metric == "chebyshev":
+        return np.max(np.abs(feature_array_1 - feature_array_2), axis=1)
+
+    if metric == "braycurtis":
+        return np.sum(np.abs(feature_array_1 - feature_array_2), axis=1) / \
+            np.sum(np.abs(feature_array_1 + feature_array_2), axis=1)
+
+    if metric == "canberra":
+        numerator = np.abs(feature_array_1 - feature_array_2)
+        denominator = np.abs(feature_array_1) + np.abs(feature_array_2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            quotient = numerator / denominator
+        # Omit the terms where both features are zero
+        quotient[denominator == 0] = 0
+        return np.sum(quotient, axis=1)
+
+    if metric == "cosine":
+        norm_product = np.sqrt(np.sum(feature_array_1**2, axis=1)) * \
+            np.sqrt(np.sum(feature_array_2**2, axis=1))
+        distance = 1 - np.sum(feature_array_1 * feature_array_2,
+                              axis=1) / norm_product
+        return np.clip(distance, 0, 2)
+
+    if metric == "correlation":
+        centered_feature_array_1 = feature_array_1 - np.mean(
+            feature_array_1, axis=1, keepdims=True)
+        centered_feature_array_2 = feature_array_2 - np.mean(
+            feature_array_2, axis=1, keepdims=True)
+        norm_product = np.sqrt(np.sum(centered_feature_array_1**2, axis=1)) * \
+            np.sqrt(np.sum(centered_feature_array_2**2, axis=1))
+        return 1 - np.sum(centered_feature_array_1 * centered_feature_array_2,
+                          axis=1) / norm_product
+
+    raise ValueError("Unknown metric {}.".format(metric))
+
+
+def compute_boolean_metric(metric, ntt, ntf, nft, nff):
+    """Compute a boolean metric from the contingency counts of the pairs.
+
+    :param metric: the name of the metric
+    :type metric: string
+    :param ntt: the number of dimensions which are nonzero in both features
+    :type ntt: numpy array
+    :param ntf: the number of dimensions which are only nonzero in the first feature
+    :type ntf: numpy array
+    :param nft: the number of dimensions which are only nonzero in the second feature
+    :type nft: numpy array
+    :param nff: the number of dimensions which are zero in both features
+    :type nff: numpy array
+    :return: the distances of the pairs
+    :rtype: numpy array
+    """
+
+    dimension = ntt + ntf + nft + nff
+    mismatch_num = ntf + nft
+
+    if metric == "dice":
+        return mismatch_num / (2 * ntt + mismatch_num)
+
+    if metric == "kulsinski":
+        return (mismatch_num - ntt + dimension) / (mismatch_num + dimension)
+
+    if metric == "matching":
+        return mismatch_num / dimension
+
+    if metric in ["rogerstanimoto", "sokalmichener"]:
+        return 2 * mismatch_num / (ntt + nff + 2 * mismatch_num)
+
+    if metric == "russellrao":
+        return (dimension - ntt) / dimension
+
+    if metric == "sokalsneath":
+        return 2 * mismatch_num / (ntt + 2 * mismatch_num)
+
+    raise ValueError("Unknown metric {}.".format(metric))
+
+
+def compute_metrics_within_chunk(feature_array_1, feature_array_2,
+                                 metric_list):
+    """Compute the metrics between the features of the pairs within one chunk.
+
+    :param feature_array_1: the first features of the pairs
+    :type feature_array_1: numpy array
+    :param feature_array_2: the second features of the pairs
+    :type feature_array_2: numpy array
+    :param metric_list: the metrics which will be used to compare two feature vectors
+    :type metric_list: list
+    :return: the distances of the pairs, one column for each metric
+    :rtype: numpy array
+    """
+
+    feature_array_1 = feature_array_1.astype(np.float64)
+    feature_array_2 = feature_array_2.astype(np.float64)
+
+    # The contingency counts are shared by all boolean metrics
+    contingency_counts = None
+
+    distance_array = np.zeros((feature_array_1.shape[0], len(metric_list)))
+    for metric_index, metric in enumerate(metric_list):
+        if metric in BOOLEAN_METRIC_LIST:
+            if contingency_counts is None:
+                boolean_feature_array_1 = feature_array_1 != 0
+                boolean_feature_array_2 = feature_array_2 != 0
+                ntt = np.sum(boolean_feature_array_1 & boolean_feature_array_2,
+                             axis=1)
+                ntf = np.sum(boolean_feature_array_1 & ~boolean_feature_array_2,
+                             axis=1)
+                nft = np.sum(~boolean_feature_array_1 & boolean_feature_array_2,
+                             axis=1)
+                nff = feature_array_1.shape[1] - ntt - ntf - nft
+                contingency_counts = [
+                    count.astype(np.float64) for count in [ntt, ntf, nft, nff]
+                ]
+            distance_array[:, metric_index] = compute_boolean_metric(
+                metric, *contingency_counts)
+        else:
+            distance_array[:, metric_index] = compute_real_metric(
+                metric, feature_array_1, feature_array_2)
+
+    return distance_array
+
+
+def compute_pairwise_metrics(feature_array_1,
+                             feature_array_2,
+                             metric_list,
+                             chunk_size=CHUNK_SIZE):
+    """Compute the metrics between the features of the pairs.
+
+    :param feature_array_1: the first features of the pairs, one row for each pair
+    :type feature_array_1: numpy array
+    :param feature_array_2: the second features of the pairs, one row for each pair
+    :type feature_array_2: numpy array
+    :param metric_list: the metrics which will be used to compare two feature vectors.
+        If it is None, the absolute difference between two features will be returned.
+    :type metric_list: list
+    :param chunk_size: the number of pairs which are processed at once
+    :type chunk_size: int
+    :return: the distances of the pairs, one column for each metric
+    :rtype: numpy array
+    """
+
+    return compute_pairwise_metrics_by_index(
+        feature_array_1,
+        np.arange(feature_array_1.shape[0]),
+        np.arange(feature_array_2.shape[0]),
+        metric_list,
+        chunk_size=chunk_size,
+        second_feature_array=feature_array_2)
+
+
+def compute_pairwise_metrics_by_index(feature_array,
+                                      index_array_1,
+                                      index_array_2,
+                                      metric_list,
+                                      chunk_size=CHUNK_SIZE,
+                                      second_feature_array=None):
+    """Compute the metrics between the features of the pairs which are given by row indexes.
+    Only the features within the current chunk are gathered at once.
+
+    :param feature_array: the features of the images, one row for each image
+    :type feature_array: numpy array
+    :param index_array_1: the rows of the first images in the pairs
+    :type index_array_1: numpy array
+    :param index_array_2: the rows of the second images in the pairs
+    :type index_array_2: numpy array
+    :param metric_list: the metrics which will be used to compare two feature vectors.
+        If it is None, the absolute difference between two features will be returned.
+    :type metric_list: list
+    :param chunk_size: the number of pairs which are processed at once
+    :type chunk_size: int
+    :param second_feature_array: the features which index_array_2 refers to, feature_array is used if it is None
+    :type second_feature_array: numpy array
+    :return: the distances of the pairs, one column for each metric
+    :rtype: numpy array
+    """
+
+    if second_feature_array is None:
+        second_feature_array = feature_array
+
+    pair_num = len(index_array_1)
+    if metric_list is None:
+        final_feature_array = np.zeros((pair_num, feature_array.shape[1]))
+    else:
+        final_feature_array = np.zeros((pair_num, len(metric_list)))
+
+    for start_index in range(0, pair_num, chunk_size):
+        end_index = min(start_index + chunk_size, pair_num)
+        feature_array_1 = np.asarray(
+            feature_array[index_array_1[start_index:end_index]])
+        feature_array_2 = np.asarray(
+            second_feature_array[index_array_2[start_index:end_index]])
+
+        if metric_list is None:
+            final_feature_array[start_index:end_index] = np.abs(
+                feature_array_1.astype(np.float64) - feature_array_2)
+        else:
+            final_feature_array[start_index:end_index] = \
+                compute_metrics_within_chunk(feature_array_1, feature_array_2, metric_list)
+
+    return final_feature_array
@@ -1,13 +1,19 @@
+from multiprocessing.pool import ThreadPool
 import common
+import contextlib
 import congealingcomplex
 import cv2
+import feature_extractor
+import feature_store
 import glob
+import json
 import landmark
+import multiprocessing
 import numpy as np
 import open_face
 import os
 import pyprind
-import vgg_face
+import time
 
 # The extensions of the facial images
 FACIAL_IMAGE_EXTENSION_LIST = [
@@ -23,17 +29,119 @@ RETRIEVE_FACIAL_IMAGE_FUNC_LIST = [\
                                    getattr(open_face, "retrieve_facial_image_by_open_face"), \
                                    getattr(congealingcomplex, "retrieve_facial_image_by_congealingcomplex")]
 
+# The function objects that could crop faces in one batch, indexed by their counterparts above
+RETRIEVE_FACIAL_IMAGES_FUNC_DICT = {\
+                                    getattr(congealingcomplex, "retrieve_facial_image_by_congealingcomplex"): \
+                                    getattr(congealingcomplex, "retrieve_facial_images_by_congealingcomplex")}
+
+# The function objects that could crop faces from decoded full images in one batch
+CROP_FACIAL_IMAGES_FUNC_LIST = [\
+                                getattr(landmark, "crop_facial_images_by_bbox"), \
+                                getattr(open_face, "crop_facial_images_by_open_face"), \
+                                getattr(congealingcomplex, "crop_facial_images_by_congealingcomplex")]
+
+# The number of worker processes which crop facial images, 1 means cropping serially
+CROPPING_WORKER_NUM = 1
+
+# The number of images within each shard, which is cropped in one batch when possible
+CROPPING_SHARD_SIZE = 64
+
+# The manifest entries which have been loaded within current process
+manifest_memo_dict = {}
+
 # The extensions of the feature files
 FEATURE_EXTENSION_LIST = ["_open_face.csv", "_vgg_face.csv"]
 
+# The feature extractors which are initiated on first use
+FEATURE_EXTRACTOR_LIST = [\
+                          feature_extractor.init_feature_extractor("open_face"), \
+                          feature_extractor.init_feature_extractor("vgg_face")]
+
 # The function objects that could retrieve feature
-RETRIEVE_FEATURE_FUNC_LIST = [\
-                              getattr(open_face, "retrieve_feature_by_open_face"), \
-                              getattr(vgg_face, "retrieve_feature_by_vgg_face")]
+RETRIEVE_FEATURE_FUNC_LIST = [
+    extractor.retrieve_feature for extractor in FEATURE_EXTRACTOR_LIST
+]
 
+# The function objects that could load facial images for the feature extractors above
+LOAD_FACIAL_IMAGE_FUNC_LIST = [
+    extractor.load_facial_image for extractor in FEATURE_EXTRACTOR_LIST
+]
 
-def get_image_paths_in_training_dataset():
-    """Get image paths in the training data set.
+# The function objects that could retrieve features in one batch
+RETRIEVE_FEATURES_FUNC_LIST = [
+    extractor.retrieve_features for extractor in FEATURE_EXTRACTOR_LIST
+]
+
+# The function objects that could initiate the backends of the feature extractors in the calling thread
+INIT_BACKEND_FUNC_LIST = [
+    extractor.get_backend for extractor in FEATURE_EXTRACTOR_LIST
+]
+
+# Whether compute features in batches and save them to the feature store directly.
+# Otherwise, the features are computed one image at a time and saved to separate files.
+COMPUTE_FEATURES_IN_BATCH = False
+
+# The number of facial images which are fed to the feature extractors at once in the batched mode
+FEATURE_BATCH_SIZE = 64
+
+# The number of threads which decode and resize facial images in the batched mode
+DECODING_THREAD_NUM = 4
+
+# Whether crop facial images and compute features in a single pass over the original images
+USE_FUSED_PIPELINE = False
+
+
+class Stage_Timer(object):
+    """Accumulate the wall-clock time of the stages in a pipeline."""
+
+    def __init__(self):
+        """Init function.
+        
+        :return: the class object will be initiated
+        :rtype: None
+        """
+
+        self.stage_name_list = []
+        self.elapsed_time_dict = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage_name):
+        """Measure the wall-clock time of the code within the with statement.
+        
+        :param stage_name: the name of the stage
+        :type stage_name: string
+        :return: the elapsed time will be added to the stage
+        :rtype: generator
+        """
+
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            if stage_name not in self.elapsed_time_dict:
+                self.stage_name_list.append(stage_name)
+                self.elapsed_time_dict[stage_name] = 0.0
+            self.elapsed_time_dict[stage_name] += time.time() - start_time
+
+    def report(self):
+        """Report the wall-clock time of each stage.
+        
+        :return: the report will be printed
+        :rtype: None
+        """
+
+        total_elapsed_time = max(np.sum(list(self.elapsed_time_dict.values())),
+                                 1e-8)
+        print("\nThe wall-clock time of each stage is as follows:")
+        for stage_name in self.stage_name_list:
+            elapsed_time = self.elapsed_time_dict[stage_name]
+            print("{}\t{:.2f}s\t{:.1f}%".format(
+                stage_name, elapsed_time,
+                100.0 * elapsed_time / total_elapsed_time))
+
+
+def scan_training_dataset():
+    """Scan the training data set for image paths.
     
     :return: original_image_path_list refers to the image path, 
         while training_image_index_list refers to the image index.
@@ -70,8 +178,8 @@ def get_image_paths_in_training_dataset():
     return (original_image_path_list, training_image_index_list)
 
 
-def get_image_paths_in_testing_dataset():
-    """Get image paths in the testing data set.
+def scan_testing_dataset():
+    """Scan the testing data set for image paths.
     
     :return: the image paths in the testing data set
     :rtype: list
@@ -96,22 +204,159 @@ def get_image_paths_in_testing_dataset():
 
     return original_image_path_list
 
-def crop_facial_images_within_single_dataset(image_paths, facial_image_extension, \
-                                             mean_image_name, retrieve_facial_image_func, force_continue):
-    """Crop facial images within single dataset.
+
+def get_directory_mtime_dict(dataset_name):
+    """Get the modification time of the dataset folder and its subfolders.
+    
+    :param dataset_name: the name of the data set
+    :type dataset_name: string
+    :return: the modification time, indexed by the folder paths relative to DATA_PATH
+    :rtype: dict
+    """
+
+    dataset_path = os.path.join(common.DATA_PATH, dataset_name)
+    directory_mtime_dict = {dataset_name: os.stat(dataset_path).st_mtime}
+    for folder_name in os.listdir(dataset_path):
+        folder_path = os.path.join(dataset_path, folder_name)
+        if os.path.isdir(folder_path):
+            directory_mtime_dict[os.path.join(
+                dataset_name, folder_name)] = os.stat(folder_path).st_mtime
+    return directory_mtime_dict
+
+
+def is_manifest_entry_valid(manifest_entry):
+    """Check whether the folders in the manifest entry have not been modified.
+    
+    :param manifest_entry: the manifest entry of one data set
+    :type manifest_entry: dict
+    :return: whether the manifest entry is still valid
+    :rtype: boolean
+    """
+
+    for relative_folder_path, mtime in manifest_entry[
+            "directory_mtime_dict"].items():
+        folder_path = os.path.join(common.DATA_PATH, relative_folder_path)
+        if not os.path.isdir(folder_path) or os.stat(
+                folder_path).st_mtime != mtime:
+            return False
+    return True
+
+
+def get_manifest_entry(dataset_name, scan_dataset_func):
+    """Get the manifest entry of one data set.
+    The entry is memorized within current process, and it is persisted in the manifest file.
+    The data set is scanned again only when the dataset folder or any of its subfolders is modified.
+    
+    :param dataset_name: the name of the data set
+    :type dataset_name: string
+    :param scan_dataset_func: the function object that could scan the data set
+    :type scan_dataset_func: object
+    :return: the manifest entry of the data set
+    :rtype: dict
+    """
+
+    if dataset_name in manifest_memo_dict:
+        return manifest_memo_dict[dataset_name]
+
+    # Load the manifest file
+    manifest_file_path = os.path.join(common.DATA_PATH,
+                                      common.MANIFEST_FILE_NAME)
+    manifest = {}
+    if os.path.isfile(manifest_file_path):
+        try:
+            with open(manifest_file_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except ValueError:
+            manifest = {}
+
+    manifest_entry = manifest.get(dataset_name)
+    if manifest_entry is None or not is_manifest_entry_valid(manifest_entry):
+        print("Scanning the {} data set ...".format(dataset_name))
+
+        # The modification time is retrieved before scanning, so that concurrent changes invalidate the entry
+        directory_mtime_dict = get_directory_mtime_dict(dataset_name)
+        scan_result = scan_dataset_func()
+        if isinstance(scan_result, tuple):
+            original_image_path_list, image_index_list = scan_result
+        else:
+            original_image_path_list, image_index_list = scan_result, None
+
+        manifest_entry = {
+            "directory_mtime_dict":
+                directory_mtime_dict,
+            "image_path_list": [
+                os.path.relpath(original_image_path, common.DATA_PATH)
+                for original_image_path in original_image_path_list
+            ],
+            "image_index_list":
+                image_index_list
+        }
+
+        # Save the manifest file
+        manifest[dataset_name] = manifest_entry
+        temporary_manifest_file_path = manifest_file_path + ".tmp"
+        with open(temporary_manifest_file_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.rename(temporary_manifest_file_path, manifest_file_path)
+
+    manifest_memo_dict[dataset_name] = manifest_entry
+    return manifest_entry
+
+
+def get_image_paths_in_training_dataset():
+    """Get image paths in the training data set.
+    
+    :return: original_image_path_list refers to the image path, 
+        while training_image_index_list refers to the image index.
+    :rtype: tuple
+    """
+
+    manifest_entry = get_manifest_entry(common.TRAINING_DATASET_NAME,
+                                        scan_training_dataset)
+    original_image_path_list = [
+        os.path.join(common.DATA_PATH, relative_image_path)
+        for relative_image_path in manifest_entry["image_path_list"]
+    ]
+    training_image_index_list = list(manifest_entry["image_index_list"])
+    return (original_image_path_list, training_image_index_list)
+
+
+def get_image_paths_in_testing_dataset():
+    """Get image paths in the testing data set.
+    
+    :return: the image paths in the testing data set
+    :rtype: list
+    """
+
+    manifest_entry = get_manifest_entry(common.TESTING_DATASET_NAME,
+                                        scan_testing_dataset)
+    return [
+        os.path.join(common.DATA_PATH, relative_image_path)
+        for relative_image_path in manifest_entry["image_path_list"]
+    ]
+
+
+def crop_facial_images_within_image_shard(image_paths,
+                                          facial_image_extension,
+                                          retrieve_facial_image_func,
+                                          force_continue,
+                                          progress_bar=None):
+    """Crop facial images within one shard of images.
     
     :param image_paths: the file paths of the images
     :type image_paths: list
     :param facial_image_extension: the extension of the facial images
     :type facial_image_extension: string
-    :param mean_image_name: the file name of the mean facial image
-    :type mean_image_name: string
     :param retrieve_facial_image_func: the function object that could crop faces
     :type retrieve_facial_image_func: object
     :param force_continue: whether crop facial images by using bbox coordinates
     :type force_continue: boolean
-    :return: the facial images will be saved to disk
-    :rtype: None
+    :param progress_bar: the progress bar which will be updated after each image
+    :type progress_bar: object
+    :return: image_sum refers to the sum of the new facial images,
+        image_num refers to the number of the new facial images,
+        while error_num refers to the number of failures.
+    :rtype: tuple
     """
 
     # The sum of all images
@@ -120,20 +365,35 @@ def crop_facial_images_within_single_dataset(image_paths, facial_image_extension
     image_num = 0
     error_num = 0
 
-    # Add progress bar
-    progress_bar = pyprind.ProgBar(len(image_paths), monitor=True)
+    # Skip when the resized facial image file already exists
+    pending_image_paths = [image_path for image_path in image_paths \
+                           if not os.path.isfile(image_path + facial_image_extension)]
+    if progress_bar is not None and len(pending_image_paths) < len(
+            image_paths):
+        progress_bar.update(len(image_paths) - len(pending_image_paths))
 
-    for image_path in image_paths:
-        # Update progress bar before the computation
-        progress_bar.update()
+    # Crop the pending images in one batch when possible
+    retrieve_facial_images_func = RETRIEVE_FACIAL_IMAGES_FUNC_DICT.get(
+        retrieve_facial_image_func)
+    if retrieve_facial_images_func is not None and len(
+            pending_image_paths) > 0:
+        facial_image_list = retrieve_facial_images_func(
+            pending_image_paths, force_continue)
+    else:
+        facial_image_list = None
 
-        # Skip when the resized facial image file already exists
-        facial_image_path = image_path + facial_image_extension
-        if os.path.isfile(facial_image_path):
-            continue
+    for pending_image_index, image_path in enumerate(pending_image_paths):
+        # Update progress bar before the computation
+        if progress_bar is not None:
+            progress_bar.update()
 
         # Retrieve facial image
-        facial_image = retrieve_facial_image_func(image_path, force_continue)
+        facial_image_path = image_path + facial_image_extension
+        if facial_image_list is None:
+            facial_image = retrieve_facial_image_func(image_path,
+                                                      force_continue)
+        else:
+            facial_image = facial_image_list[pending_image_index]
         if facial_image is None:
             error_num = error_num + 1
             continue
@@ -146,6 +406,78 @@ def crop_facial_images_within_single_dataset(image_paths, facial_image_extension
         # Save the resized facial image
         cv2.imwrite(facial_image_path, facial_image)
 
+    return (image_sum, image_num, error_num)
+
+
+def crop_facial_images_within_image_shard_wrapper(arguments):
+    """Unpack the arguments for crop_facial_images_within_image_shard in the worker processes."""
+
+    return crop_facial_images_within_image_shard(*arguments)
+
+
+def crop_facial_images_within_single_dataset(image_paths, facial_image_extension, \
+                                             mean_image_name, retrieve_facial_image_func, force_continue, \
+                                             worker_num=CROPPING_WORKER_NUM, shard_size=CROPPING_SHARD_SIZE):
+    """Crop facial images within single dataset.
+    
+    :param image_paths: the file paths of the images
+    :type image_paths: list
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param mean_image_name: the file name of the mean facial image
+    :type mean_image_name: string
+    :param retrieve_facial_image_func: the function object that could crop faces
+    :type retrieve_facial_image_func: object
+    :param force_continue: whether crop facial images by using bbox coordinates
+    :type force_continue: boolean
+    :param worker_num: the number of worker processes, the images are cropped serially if it is 1
+    :type worker_num: int
+    :param shard_size: the number of images within each shard, which is handled in one batch
+    :type shard_size: int
+    :return: the facial images will be saved to disk
+    :rtype: None
+    """
+
+    # Split the images into shards
+    argument_list = [(image_paths[start_index:start_index + shard_size], facial_image_extension, \
+                      retrieve_facial_image_func, force_continue) \
+                     for start_index in range(0, len(image_paths), shard_size)]
+
+    # Reduce the partial image sums and counts from the shards
+    image_sum = np.zeros(
+        (common.FACIAL_IMAGE_SIZE, common.FACIAL_IMAGE_SIZE, 3))
+    image_num = 0
+    error_num = 0
+
+    if worker_num == 1:
+        # Add progress bar
+        progress_bar = pyprind.ProgBar(len(image_paths), monitor=True)
+
+        for arguments in argument_list:
+            shard_image_sum, shard_image_num, shard_error_num = crop_facial_images_within_image_shard(
+                *(arguments + (progress_bar,)))
+            image_sum += shard_image_sum
+            image_num = image_num + shard_image_num
+            error_num = error_num + shard_error_num
+    else:
+        # Add progress bar
+        progress_bar = pyprind.ProgBar(len(argument_list), monitor=True)
+
+        pool = multiprocessing.Pool(processes=worker_num)
+        try:
+            for shard_image_sum, shard_image_num, shard_error_num in pool.imap_unordered(
+                    crop_facial_images_within_image_shard_wrapper,
+                    argument_list):
+                image_sum += shard_image_sum
+                image_num = image_num + shard_image_num
+                error_num = error_num + shard_error_num
+
+                # Update progress bar
+                progress_bar.update()
+        finally:
+            pool.close()
+            pool.join()
+
     # Report tracking information
     print(progress_bar)
 
@@ -163,8 +495,10 @@ def crop_facial_images_within_single_dataset(image_paths, facial_image_extension
             print("Mean image saved.")
 
 
-def crop_facial_images(facial_image_extension, mean_image_name,
-                       retrieve_facial_image_func):
+def crop_facial_images(facial_image_extension,
+                       mean_image_name,
+                       retrieve_facial_image_func,
+                       worker_num=CROPPING_WORKER_NUM):
     """Crop facial images.
     
     :param facial_image_extension: the extension of the facial images
@@ -173,6 +507,8 @@ def crop_facial_images(facial_image_extension, mean_image_name,
     :type mean_image_name: string
     :param retrieve_facial_image_func: the function object that could crop faces
     :type retrieve_facial_image_func: object
+    :param worker_num: the number of worker processes, the images are cropped serially if it is 1
+    :type worker_num: int
     :return: the facial images will be saved to disk
     :rtype: None
     """
@@ -187,11 +523,11 @@ def crop_facial_images(facial_image_extension, mean_image_name,
     # Crop facial images in the training and testing datasets
     print("\nWorking on the training data set ...")
     crop_facial_images_within_single_dataset(image_paths_in_training_dataset, facial_image_extension, \
-                           mean_image_name, retrieve_facial_image_func, False)
+                           mean_image_name, retrieve_facial_image_func, False, worker_num)
 
     print("\nWorking on the testing data set ...")
     crop_facial_images_within_single_dataset(image_paths_in_testing_dataset, facial_image_extension, \
-                           None, retrieve_facial_image_func, True)
+                           None, retrieve_facial_image_func, True, worker_num)
 
 
 def compute_features(facial_image_extension, feature_extension,
@@ -225,6 +561,7 @@ def compute_features(facial_image_extension, feature_extension,
     ]
 
     error_num = 0
+    computed_num = 0
 
     # Add progress bar
     progress_bar = pyprind.ProgBar(len(facial_image_path_list), monitor=True)
@@ -234,10 +571,16 @@ def compute_features(facial_image_extension, feature_extension,
         # Update progress bar before the computation
         progress_bar.update()
 
+        # Skip when the feature file already exists
+        if os.path.isfile(feature_file_path):
+            continue
+
         # Retrieve feature
         feature = retrieve_feature_func(facial_image_path, feature_file_path)
         if feature is None:
             error_num = error_num + 1
+        else:
+            computed_num = computed_num + 1
 
     # Report tracking information
     print(progress_bar)
@@ -246,13 +589,421 @@ def compute_features(facial_image_extension, feature_extension,
     print("Can't retrieve feature from {:d}/{:d} images.".format(
         error_num, len(facial_image_path_list)))
 
+    # Pack the feature files into the feature store
+    if computed_num > 0 or not feature_store.is_feature_store_available(
+            facial_image_extension, feature_extension):
+        feature_store.migrate_from_csv(image_paths, facial_image_extension,
+                                       feature_extension)
 
-def run():
-    # Initiate OpenFace Module
-    open_face.init_open_face_module()
 
-    # Initiate VGG Face Module
-    vgg_face.init_vgg_face_module()
+def compute_features_in_batch(facial_image_extension,
+                              feature_extension,
+                              load_facial_image_func,
+                              retrieve_features_func,
+                              batch_size=FEATURE_BATCH_SIZE,
+                              thread_num=DECODING_THREAD_NUM,
+                              init_backend_func=None):
+    """Compute features in batches and save them to the feature store.
+    The next batch is decoded and resized in a thread pool while the current batch is in the network.
+    
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :param load_facial_image_func: the function object that could load facial images
+    :type load_facial_image_func: object
+    :param retrieve_features_func: the function object that could retrieve features in one batch
+    :type retrieve_features_func: object
+    :param batch_size: the number of facial images which are fed to the feature extractor at once
+    :type batch_size: int
+    :param thread_num: the number of threads which decode and resize facial images
+    :type thread_num: int
+    :param init_backend_func: the function object that could initiate the backend of the feature extractor,
+        it is called in the current thread before the thread pool starts, None means the backend is initiated on first use
+    :type init_backend_func: object
+    :return: the features will be saved to the feature store
+    :rtype: None
+    """
+
+    print("\nComputing features in batches with facial_image_extension is {} and feature_extension is {}.".format\
+          (facial_image_extension, feature_extension))
+
+    # Get image paths in the training and testing datasets
+    image_paths_in_training_dataset, _ = get_image_paths_in_training_dataset()
+    image_paths_in_testing_dataset = get_image_paths_in_testing_dataset()
+    image_paths = image_paths_in_training_dataset + image_paths_in_testing_dataset
+
+    # Reuse the features in the existing feature store
+    if feature_store.is_feature_store_available(facial_image_extension,
+                                                feature_extension):
+        existing_feature_list = feature_store.load_feature_from_store(
+            image_paths, facial_image_extension, feature_extension)
+    else:
+        existing_feature_list = [None] * len(image_paths)
+    pending_row_indexes = [row_index for row_index, existing_feature in \
+                           enumerate(existing_feature_list) if existing_feature is None]
+    if len(pending_row_indexes) == 0:
+        print("All features already exist in the feature store.")
+        return
+
+    feature_store_writer = feature_store.Feature_Store_Writer(
+        image_paths, facial_image_extension, feature_extension)
+    existing_row_indexes = [row_index for row_index, existing_feature in \
+                            enumerate(existing_feature_list) if existing_feature is not None]
+    for start_index in range(0, len(existing_row_indexes), batch_size):
+        selected_row_indexes = existing_row_indexes[start_index:start_index +
+                                                    batch_size]
+        feature_store_writer.write(
+            selected_row_indexes,
+            np.array([
+                existing_feature_list[row_index]
+                for row_index in selected_row_indexes
+            ]))
+
+    # Split the pending images into batches
+    batch_row_indexes_list = [pending_row_indexes[start_index:start_index + batch_size] \
+                              for start_index in range(0, len(pending_row_indexes), batch_size)]
+
+    # Initiate the backend in the thread which retrieves features, rather than in a worker of the thread pool
+    if init_backend_func is not None:
+        init_backend_func()
+
+    error_num = 0
+    thread_pool = ThreadPool(processes=thread_num)
+
+    # Add progress bar
+    progress_bar = pyprind.ProgBar(len(batch_row_indexes_list), monitor=True)
+
+    def load_batch(batch_row_indexes):
+        facial_image_paths = [
+            image_paths[row_index] + facial_image_extension
+            for row_index in batch_row_indexes
+        ]
+        return thread_pool.map_async(load_facial_image_func,
+                                     facial_image_paths)
+
+    try:
+        pending_result = load_batch(batch_row_indexes_list[0])
+        for batch_index, batch_row_indexes in enumerate(
+                batch_row_indexes_list):
+            facial_image_list = pending_result.get()
+
+            # Decode the next batch in the background
+            if batch_index + 1 < len(batch_row_indexes_list):
+                pending_result = load_batch(
+                    batch_row_indexes_list[batch_index + 1])
+
+            # Omit the facial images which could not be loaded
+            valid_row_indexes = [row_index for row_index, facial_image in \
+                                 zip(batch_row_indexes, facial_image_list) if facial_image is not None]
+            valid_facial_image_list = [
+                facial_image for facial_image in facial_image_list
+                if facial_image is not None
+            ]
+            error_num = error_num + len(batch_row_indexes) - len(
+                valid_row_indexes)
+
+            # Retrieve features and write them in bulk
+            if len(valid_row_indexes) > 0:
+                try:
+                    feature_array = retrieve_features_func(
+                        valid_facial_image_list)
+                    feature_store_writer.write(valid_row_indexes,
+                                               feature_array)
+                except:
+                    error_num = error_num + len(valid_row_indexes)
+
+            # Update progress bar
+            progress_bar.update()
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+    # Report tracking information
+    print(progress_bar)
+
+    # Report the percentage of failures
+    print("Can't retrieve feature from {:d}/{:d} images.".format(
+        error_num, len(pending_row_indexes)))
+
+    feature_store_writer.close()
+
+
+def load_full_image_and_bbox(image_path):
+    """Load the full image and the coordinates of facial image from the bbox file.
+    
+    :param image_path: the path of the full image
+    :type image_path: string
+    :return: full_image refers to the full image, while bbox refers to the content of the bbox file.
+        None refers to a failure.
+    :rtype: tuple
+    """
+
+    full_image = cv2.imread(image_path)
+    try:
+        bbox = common.read_from_file(image_path + common.BBOX_EXTENSION)
+    except:
+        bbox = None
+    return (full_image, bbox)
+
+
+def run_fused_pipeline(batch_size=FEATURE_BATCH_SIZE,
+                       thread_num=DECODING_THREAD_NUM):
+    """Crop facial images and compute features in a single pass over the original images.
+    Each original image and its bbox file are decoded once, every crop is saved to disk,
+    and it goes straight to all feature extractors while it is still in memory.
+    The existing facial images and the features in the existing feature stores are reused.
+    
+    :param batch_size: the number of original images which are processed at once
+    :type batch_size: int
+    :param thread_num: the number of threads which decode and convert images
+    :type thread_num: int
+    :return: the facial images and the feature stores will be saved to disk
+    :rtype: None
+    """
+
+    print("\nRunning the fused pipeline ...")
+
+    stage_timer = Stage_Timer()
+
+    # Get image paths in the training and testing datasets
+    with stage_timer.measure("Scanning datasets"):
+        image_paths_in_training_dataset, _ = get_image_paths_in_training_dataset(
+        )
+        image_paths_in_testing_dataset = get_image_paths_in_testing_dataset()
+    image_paths = image_paths_in_training_dataset + image_paths_in_testing_dataset
+
+    # Reuse the features in the existing feature stores, and only init writers for the combinations with pending rows
+    feature_store_writer_dict = {}
+    pending_flag_array_dict = {}
+    for facial_image_extension in FACIAL_IMAGE_EXTENSION_LIST:
+        for feature_extension in FEATURE_EXTENSION_LIST:
+            if feature_store.is_feature_store_available(
+                    facial_image_extension, feature_extension):
+                existing_feature_list = feature_store.load_feature_from_store(
+                    image_paths, facial_image_extension, feature_extension)
+            else:
+                existing_feature_list = [None] * len(image_paths)
+            pending_flag_array = np.array([
+                existing_feature is None
+                for existing_feature in existing_feature_list
+            ], dtype=bool)
+            pending_flag_array_dict[(facial_image_extension,
+                                     feature_extension)] = pending_flag_array
+            if not np.any(pending_flag_array):
+                continue
+
+            feature_store_writer = feature_store.Feature_Store_Writer(
+                image_paths, facial_image_extension, feature_extension)
+            existing_row_indexes = np.flatnonzero(~pending_flag_array)
+            for start_index in range(0, len(existing_row_indexes), batch_size):
+                selected_row_indexes = existing_row_indexes[
+                    start_index:start_index + batch_size]
+                feature_store_writer.write(
+                    selected_row_indexes,
+                    np.array([
+                        existing_feature_list[row_index]
+                        for row_index in selected_row_indexes
+                    ]))
+            feature_store_writer_dict[(facial_image_extension,
+                                       feature_extension)] = feature_store_writer
+
+    # The sums of the new facial images in the training dataset
+    image_sum_list = [
+        np.zeros((common.FACIAL_IMAGE_SIZE, common.FACIAL_IMAGE_SIZE, 3))
+        for _ in FACIAL_IMAGE_EXTENSION_LIST
+    ]
+    image_num_list = [0] * len(FACIAL_IMAGE_EXTENSION_LIST)
+    crop_error_num_list = [0] * len(FACIAL_IMAGE_EXTENSION_LIST)
+    feature_error_num = 0
+
+    # The facial images in the training dataset are not cropped by using bbox coordinates
+    batch_list = []
+    for start_index, end_index, force_continue in [(0, len(image_paths_in_training_dataset), False), \
+                                                   (len(image_paths_in_training_dataset), len(image_paths), True)]:
+        for batch_start_index in range(start_index, end_index, batch_size):
+            batch_list.append((list(range(batch_start_index, min(batch_start_index + batch_size, end_index))), \
+                               force_continue))
+
+    # Initiate the backends with pending features in the thread which retrieves features,
+    # rather than in a worker of the thread pool
+    for feature_extension, extractor in zip(FEATURE_EXTENSION_LIST,
+                                            FEATURE_EXTRACTOR_LIST):
+        if any(
+                np.any(pending_flag_array_dict[(facial_image_extension,
+                                                feature_extension)])
+                for facial_image_extension in FACIAL_IMAGE_EXTENSION_LIST):
+            with stage_timer.measure("Initiating {}".format(
+                    extractor.backend_name)):
+                extractor.get_backend()
+
+    thread_pool = ThreadPool(processes=thread_num)
+
+    # Add progress bar
+    progress_bar = pyprind.ProgBar(len(batch_list), monitor=True)
+
+    try:
+        for row_indexes, force_continue in batch_list:
+            # Skip the facial images which already exist, and the features which are already in the feature stores
+            missing_row_indexes_list = [[row_index for row_index in row_indexes \
+                                         if not os.path.isfile(image_paths[row_index] + facial_image_extension)] \
+                                        for facial_image_extension in FACIAL_IMAGE_EXTENSION_LIST]
+            feature_row_indexes_list = [[row_index for row_index in row_indexes \
+                                         if any(pending_flag_array_dict[(facial_image_extension, feature_extension)][row_index] \
+                                                for feature_extension in FEATURE_EXTENSION_LIST)] \
+                                        for facial_image_extension in FACIAL_IMAGE_EXTENSION_LIST]
+
+            # Decode the original images and the bbox files once, only if some facial images are missing
+            decoding_row_indexes = sorted(
+                set([
+                    row_index
+                    for missing_row_indexes in missing_row_indexes_list
+                    for row_index in missing_row_indexes
+                ]))
+            with stage_timer.measure("Decoding original images"):
+                full_image_and_bbox_dict = dict(
+                    zip(
+                        decoding_row_indexes,
+                        thread_pool.map(load_full_image_and_bbox, [
+                            image_paths[row_index]
+                            for row_index in decoding_row_indexes
+                        ])))
+
+            for crop_index, (facial_image_extension, crop_facial_images_func) in \
+                enumerate(zip(FACIAL_IMAGE_EXTENSION_LIST, CROP_FACIAL_IMAGES_FUNC_LIST)):
+                selected_facial_image = os.path.splitext(
+                    facial_image_extension)[0][1:]
+                missing_row_indexes = missing_row_indexes_list[crop_index]
+                feature_row_indexes = feature_row_indexes_list[crop_index]
+                facial_image_dict = {}
+
+                # Crop the missing facial images
+                if len(missing_row_indexes) > 0:
+                    with stage_timer.measure(
+                            "Cropping by {}".format(selected_facial_image)):
+                        facial_image_list = crop_facial_images_func(
+                            [full_image_and_bbox_dict[row_index][0] for row_index in missing_row_indexes], \
+                            [full_image_and_bbox_dict[row_index][1] for row_index in missing_row_indexes], \
+                            force_continue)
+
+                    # Save the facial images and update the image sum
+                    with stage_timer.measure("Writing facial images"):
+                        for row_index, facial_image in zip(
+                                missing_row_indexes, facial_image_list):
+                            if facial_image is None:
+                                crop_error_num_list[
+                                    crop_index] = crop_error_num_list[crop_index] + 1
+                                continue
+                            if not force_continue:
+                                image_sum_list[crop_index] += facial_image
+                                image_num_list[
+                                    crop_index] = image_num_list[crop_index] + 1
+                            cv2.imwrite(
+                                image_paths[row_index] + facial_image_extension,
+                                facial_image)
+                            facial_image_dict[row_index] = facial_image
+
+                # Load the existing facial images whose features are pending
+                existing_row_indexes = [
+                    row_index for row_index in feature_row_indexes
+                    if row_index not in missing_row_indexes
+                ]
+                if len(existing_row_indexes) > 0:
+                    with stage_timer.measure("Loading facial images"):
+                        for row_index, facial_image in zip(
+                                existing_row_indexes,
+                                thread_pool.map(cv2.imread, [
+                                    image_paths[row_index] +
+                                    facial_image_extension
+                                    for row_index in existing_row_indexes
+                                ])):
+                            if facial_image is not None:
+                                facial_image_dict[row_index] = facial_image
+
+                for feature_extension, extractor in zip(
+                        FEATURE_EXTENSION_LIST, FEATURE_EXTRACTOR_LIST):
+                    pending_flag_array = pending_flag_array_dict[(
+                        facial_image_extension, feature_extension)]
+                    valid_row_indexes = [row_index for row_index in feature_row_indexes \
+                                         if pending_flag_array[row_index] and row_index in facial_image_dict]
+                    if len(valid_row_indexes) == 0:
+                        continue
+
+                    # Convert the facial images in memory
+                    with stage_timer.measure("Converting for {}".format(
+                            extractor.backend_name)):
+                        converted_facial_image_list = thread_pool.map(
+                            extractor.convert_facial_image, [
+                                facial_image_dict[row_index]
+                                for row_index in valid_row_indexes
+                            ])
+
+                    # Retrieve features and write them in bulk
+                    with stage_timer.measure("Extracting {}".format(
+                            extractor.backend_name)):
+                        converted_row_indexes = [row_index for row_index, converted_facial_image in \
+                                                 zip(valid_row_indexes, converted_facial_image_list) \
+                                                 if converted_facial_image is not None]
+                        converted_facial_image_list = [
+                            converted_facial_image for converted_facial_image
+                            in converted_facial_image_list
+                            if converted_facial_image is not None
+                        ]
+                        feature_error_num = feature_error_num + len(
+                            valid_row_indexes) - len(converted_row_indexes)
+                        if len(converted_row_indexes) == 0:
+                            continue
+                        try:
+                            feature_array = extractor.retrieve_features(
+                                converted_facial_image_list)
+                            feature_store_writer_dict[(facial_image_extension, feature_extension)].write(\
+                                converted_row_indexes, feature_array)
+                        except:
+                            feature_error_num = feature_error_num + len(
+                                converted_row_indexes)
+
+            # Update progress bar
+            progress_bar.update()
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+    # Report tracking information
+    print(progress_bar)
+
+    with stage_timer.measure("Saving feature stores"):
+        for feature_store_writer in feature_store_writer_dict.values():
+            feature_store_writer.close()
+
+    # Report the percentage of failures
+    for facial_image_extension, crop_error_num in zip(
+            FACIAL_IMAGE_EXTENSION_LIST, crop_error_num_list):
+        print("Can't crop out faces from {:d}/{:d} images with facial_image_extension is {}.".format(\
+              crop_error_num, len(image_paths), facial_image_extension))
+    print("Can't retrieve feature from {:d} facial images.".format(
+        feature_error_num))
+
+    # Save the mean facial images when necessary
+    for mean_image_name, image_sum, image_num in zip(MEAN_IMAGE_NAME_LIST,
+                                                     image_sum_list,
+                                                     image_num_list):
+        if image_num != 0:
+            mean_image = image_sum / image_num
+            mean_image = mean_image.astype(np.uint8)
+            mean_image_path = os.path.join(common.DATA_PATH, mean_image_name)
+            if not os.path.isfile(mean_image_path):
+                cv2.imwrite(mean_image_path, mean_image)
+                print("Mean image saved.")
+
+    # Report the wall-clock time of each stage
+    stage_timer.report()
+
+
+def run():
+    # Crop facial images and compute features in a single pass
+    if USE_FUSED_PIPELINE:
+        run_fused_pipeline()
+        return
 
     # Generate facial images
     for facial_image_extension, mean_image_name, retrieve_facial_image_func in \
@@ -260,12 +1011,21 @@ def run():
         crop_facial_images(facial_image_extension, mean_image_name,
                            retrieve_facial_image_func)
 
-    # Generate features
+    # Generate features. The feature extractors are initiated on first use.
     for facial_image_extension in FACIAL_IMAGE_EXTENSION_LIST:
-        for feature_extension, retrieve_feature_func in \
-            zip(FEATURE_EXTENSION_LIST, RETRIEVE_FEATURE_FUNC_LIST):
-            compute_features(facial_image_extension, feature_extension,
-                             retrieve_feature_func)
+        for feature_extension, retrieve_feature_func, load_facial_image_func, retrieve_features_func, init_backend_func in \
+            zip(FEATURE_EXTENSION_LIST, RETRIEVE_FEATURE_FUNC_LIST, LOAD_FACIAL_IMAGE_FUNC_LIST, RETRIEVE_FEATURES_FUNC_LIST, \
+                INIT_BACKEND_FUNC_LIST):
+            if not COMPUTE_FEATURES_IN_BATCH:
+                compute_features(facial_image_extension, feature_extension,
+                                 retrieve_feature_func)
+            else:
+                compute_features_in_batch(facial_image_extension,
+                                          feature_extension,
+                                          load_facial_image_func,
+                                          retrieve_features_func,
+                                          FEATURE_BATCH_SIZE,
+                                          init_backend_func=init_backend_func)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,146 @@
 from sklearn.externals import joblib
 from sklearn.grid_search import ParameterGrid
+from sklearn.metrics.pairwise import pairwise_kernels
 from sklearn.svm import SVC
 import evaluation
+import multiprocessing
 import numpy as np
 import os
+import shutil
+import tempfile
 
+# The number of processes which fit the classifiers in parallel
+GRID_SEARCH_WORKER_NUM = multiprocessing.cpu_count()
 
-def train_model(X_train, Y_train, X_test, Y_test, model_path):
+# Whether rank the classifiers by decision_function, and only calibrate the probabilities of the best one.
+# It is always the case when the kernel matrices are precomputed, since the best one is refitted anyway.
+RANK_BY_DECISION_FUNCTION = False
+
+# The maximum number of bytes of all precomputed kernel matrices, including the ones between the testing and training records
+PRECOMPUTED_KERNEL_MAX_BYTE_NUM = 2 * 1024**3
+
+# The data which is shared by the tasks within the worker
+shared_data = None
+
+
+def get_parameters_combinations():
+    """Get the parameters combinations of SVC.
+    
+    :return: the parameters combinations
+    :rtype: list
+    """
+
+    # Set the parameters for SVC
+    param_grid = [{"C": [1, 10, 100, 1000], "gamma": ["auto"], "kernel": ["linear"]}, \
+                  {"C": [1, 10, 100, 1000], "gamma": [0.001, 0.0001], "kernel": ["rbf"]}]
+    return list(ParameterGrid(param_grid))
+
+
+def get_kernel_key(parameters):
+    """Get the key of the kernel matrix, which is shared by the parameters combinations with different C values.
+    
+    :param parameters: the parameters combination
+    :type parameters: dict
+    :return: the kernel and the gamma value which is used by the kernel
+    :rtype: tuple
+    """
+
+    if parameters["kernel"] == "linear":
+        return (parameters["kernel"], None)
+    return (parameters["kernel"], parameters["gamma"])
+
+
+def compute_kernel_matrix(X_1, X_2, kernel_key):
+    """Compute the kernel matrix.
+    
+    :param X_1: the first attributes
+    :type X_1: numpy array
+    :param X_2: the second attributes
+    :type X_2: numpy array
+    :param kernel_key: the kernel and the gamma value
+    :type kernel_key: tuple
+    :return: the kernel matrix
+    :rtype: numpy array
+    """
+
+    kernel, gamma = kernel_key
+    if kernel == "linear":
+        return pairwise_kernels(X_1, X_2, metric=kernel)
+
+    if gamma == "auto":
+        gamma = 1.0 / X_1.shape[1]
+    return pairwise_kernels(X_1, X_2, metric=kernel, gamma=gamma)
+
+
+def init_grid_search_worker(current_shared_data):
+    """Init the worker which fits the classifiers.
+    
+    :param current_shared_data: X_train, Y_train, X_test, Y_test, the kernel matrices indexed by the kernel keys,
+        and whether rank the classifiers by decision_function
+    :type current_shared_data: tuple
+    :return: the shared data will be set
+    :rtype: None
+    """
+
+    global shared_data
+    shared_data = current_shared_data
+
+
+def fit_and_score(grid_search_task):
+    """Fit one classifier and score it on the testing data set.
+    
+    :param grid_search_task: the index of the classifier and the parameters combination
+    :type grid_search_task: tuple
+    :return: the score of the classifier, and the classifier itself if it could be saved directly,
+        i.e., it is fitted on the attributes with probability estimates, otherwise None.
+        The classifiers are always ranked by decision_function when the kernel matrices are precomputed.
+    :rtype: tuple
+    """
+
+    _, parameters = grid_search_task
+    X_train, Y_train, X_test, Y_test, kernel_matrix_dict, rank_by_decision_function = shared_data
+
+    if kernel_matrix_dict is None:
+        classifier = SVC(C=parameters["C"],
+                         kernel=parameters["kernel"],
+                         gamma=parameters["gamma"],
+                         probability=not rank_by_decision_function)
+        fitting_data, scoring_data = X_train, X_test
+    else:
+        # The kernel matrices are either saved in files or kept in memory
+        fitting_data, scoring_data = [
+            np.load(kernel_matrix, mmap_mode="r")
+            if isinstance(kernel_matrix, str) else kernel_matrix
+            for kernel_matrix in kernel_matrix_dict[get_kernel_key(parameters)]
+        ]
+        classifier = SVC(C=parameters["C"],
+                         kernel="precomputed",
+                         probability=not rank_by_decision_function)
+
+    classifier.fit(fitting_data, Y_train)
+    if rank_by_decision_function:
+        prediction = classifier.decision_function(scoring_data)
+    else:
+        probability_estimates = classifier.predict_proba(scoring_data)
+        prediction = probability_estimates[:, 1]
+    score = evaluation.compute_Weighted_AUC(Y_test, prediction)
+
+    if rank_by_decision_function:
+        return (score, None)
+    return (score, classifier)
+
+
+def train_model(X_train,
+                Y_train,
+                X_test,
+                Y_test,
+                model_path,
+                worker_num=GRID_SEARCH_WORKER_NUM,
+                rank_by_decision_function=RANK_BY_DECISION_FUNCTION):
     """Training phase.
+    The kernel matrices are precomputed once for the classifiers which share the same kernel and gamma value
+    if they fit in PRECOMPUTED_KERNEL_MAX_BYTE_NUM. In that case, the classifiers are ranked by decision_function,
+    and the best classifier is refitted with its own kernel and probability estimates before it is saved.
     
     :param X_train: the training attributes
     :type X_train: numpy array
@@ -19,38 +152,107 @@ def train_model(X_train, Y_train, X_test, Y_test, model_path):
     :type Y_test: numpy array
     :param model_path: the path of the model file
     :type model_path: string
+    :param worker_num: the number of processes which fit the classifiers in parallel
+    :type worker_num: int
+    :param rank_by_decision_function: whether rank the classifiers by decision_function
+    :type rank_by_decision_function: boolean
     :return: best_score refers to the highest score
     :rtype: float
     """
 
-    # Set the parameters for SVC
-    param_grid = [{"C": [1, 10, 100, 1000], "gamma": ["auto"], "kernel": ["linear"]}, \
-                  {"C": [1, 10, 100, 1000], "gamma": [0.001, 0.0001], "kernel": ["rbf"]}]
-    parameters_combinations = ParameterGrid(param_grid)
-
-    # Get a list of different classifiers
-    unique_classifier_list = []
-    for current_parameters in parameters_combinations:
-        current_classifier = SVC(C=current_parameters["C"],
-                                 kernel=current_parameters["kernel"],
-                                 gamma=current_parameters["gamma"],
-                                 probability=True)
-        unique_classifier_list.append(current_classifier)
-
-    # Loop through the classifiers
+    parameters_combinations = get_parameters_combinations()
+    grid_search_task_list = list(enumerate(parameters_combinations))
+
+    # Daemonic processes, e.g., the fold workers, are not allowed to have children
+    use_pool = worker_num > 1 and not multiprocessing.current_process().daemon
+    kernel_key_list = sorted(set([
+        get_kernel_key(parameters) for parameters in parameters_combinations
+    ]),
+                             key=str)
+
+    # The kernel matrices of all kernel keys are kept at the same time
+    kernel_matrix_byte_num = len(kernel_key_list) * X_train.shape[0] * (
+        X_train.shape[0] + X_test.shape[0]) * np.dtype(np.float64).itemsize
+    use_precomputed_kernel = kernel_matrix_byte_num <= PRECOMPUTED_KERNEL_MAX_BYTE_NUM
+
+    # The best classifier is refitted with probability estimates anyway, so the probabilities are not calibrated here
+    rank_by_decision_function = rank_by_decision_function or use_precomputed_kernel
+
+    working_directory = tempfile.mkdtemp(prefix="grid_search_")
+    try:
+        # Precompute the kernel matrices
+        kernel_matrix_dict = None
+        if use_precomputed_kernel:
+            kernel_matrix_dict = {}
+            for kernel_key in kernel_key_list:
+                kernel_matrix_list = [
+                    compute_kernel_matrix(X_train, X_train, kernel_key),
+                    compute_kernel_matrix(X_test, X_train, kernel_key)
+                ]
+                if use_pool:
+                    # Share the kernel matrices with the workers via files
+                    for kernel_matrix_index, kernel_matrix in enumerate(
+                            kernel_matrix_list):
+                        kernel_matrix_path = os.path.join(
+                            working_directory, "kernel_{:d}_{:d}.npy".format(
+                                len(kernel_matrix_dict), kernel_matrix_index))
+                        np.save(kernel_matrix_path, kernel_matrix)
+                        kernel_matrix_list[kernel_matrix_index] = str(
+                            kernel_matrix_path)
+                kernel_matrix_dict[kernel_key] = kernel_matrix_list
+
+        # Fit and score the classifiers
+        current_shared_data = (X_train, Y_train, X_test, Y_test,
+                               kernel_matrix_dict, rank_by_decision_function)
+        if use_pool:
+            pool = multiprocessing.Pool(
+                processes=min(worker_num, len(grid_search_task_list)),
+                initializer=init_grid_search_worker,
+                initargs=(current_shared_data,))
+            try:
+                result_list = pool.map(fit_and_score, grid_search_task_list)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            init_grid_search_worker(current_shared_data)
+            result_list = [
+                fit_and_score(grid_search_task)
+                for grid_search_task in grid_search_task_list
+            ]
+            init_grid_search_worker(None)
+    finally:
+        shutil.rmtree(working_directory, ignore_errors=True)
+
+    # Loop through the scores
     best_score = -np.Inf
-    for classifier_index, classifier in enumerate(unique_classifier_list):
-        classifier.fit(X_train, Y_train)
-        probability_estimates = classifier.predict_proba(X_test)
-        prediction = probability_estimates[:, 1]
-        score = evaluation.compute_Weighted_AUC(Y_test, prediction)
+    best_classifier_index = None
+    for classifier_index, (score, _) in enumerate(result_list):
         print("Classifier {:d} achieved {:.4f}.".format(classifier_index,
                                                         score))
 
         if best_score < 0 or score > best_score:
-            print("Score improved from {:.4f} to {:.4f}, saving model to {}.".format(\
-                    best_score, score, os.path.basename(model_path)))
+            print("Score improved from {:.4f} to {:.4f}.".format(
+                best_score, score))
             best_score = score
-            joblib.dump(classifier, model_path)
+            best_classifier_index = classifier_index
+
+    # Refit the best classifier with probability estimates if necessary
+    classifier = result_list[best_classifier_index][1]
+    if classifier is None:
+        best_parameters = parameters_combinations[best_classifier_index]
+        classifier = SVC(C=best_parameters["C"],
+                         kernel=best_parameters["kernel"],
+                         gamma=best_parameters["gamma"],
+                         probability=True)
+        classifier.fit(X_train, Y_train)
+        probability_estimates = classifier.predict_proba(X_test)
+        best_score = evaluation.compute_Weighted_AUC(
+            Y_test, probability_estimates[:, 1])
+        print("Classifier {:d} achieved {:.4f} after refitting.".format(
+            best_classifier_index, best_score))
+    print("Saving classifier {:d} to {}.".format(best_classifier_index,
+                                                 os.path.basename(model_path)))
+    joblib.dump(classifier, model_path)
 
     return best_score
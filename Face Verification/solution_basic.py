@@ -1,10 +1,57 @@
-from sklearn.metrics.pairwise import pairwise_distances
 import common
-import itertools
+import feature_codec
+import feature_projection
+import feature_store
+import hard_negative_mining
+import multiprocessing
 import numpy as np
 import os
+import pair_feature_cache
+import pair_manifest
+import pairwise_metrics
 import pandas as pd
 import prepare_data
+import pyprind
+import shutil
+import tempfile
+
+# The number of pairs which are generated at once in the full enumeration mode
+RECORD_MAP_CHUNK_SIZE = 1000000
+
+# The number of pairs which are predicted at once
+PREDICTION_BATCH_SIZE = 8192
+
+# Whether cache the final data sets of the folds on disk
+USE_PAIR_FEATURE_CACHE = True
+
+# Whether save the sampled pairs as pair manifests, and reuse them when sampling with the same seed
+USE_PAIR_MANIFEST = True
+
+# The proportion of the sampled negative pairs which are replaced with hard negative pairs, 0 means no mining
+HARD_NEGATIVE_PROPORTION = 0
+
+# The seed of the random number generator in sampling the training pairs of the first fold,
+# the following folds use the subsequent seeds
+SAMPLING_SEED = 0
+
+# The number of processes which train the folds in parallel, 1 means the folds are trained one after another
+FOLD_WORKER_NUM = 1
+
+# The number of threads of the numerical libraries within each fold worker
+FOLD_WORKER_THREAD_NUM = 1
+
+# The codec of the quantized copy of the feature store which is loaded, None means the features are loaded in float32
+FEATURE_STORE_CODEC_NAME = None
+
+# Whether the features are projected with the feature_projection.Feature_Projection which is fitted in each fold
+USE_FEATURE_PROJECTION = False
+
+# The folder where the features are shared with the fold workers, the default temporary folder is used if it does not exist
+SHARED_MEMORY_FOLDER_PATH = "/dev/shm"
+
+# The shared features and image indexes within the fold worker
+shared_feature_array = None
+shared_image_index_list = None
 
 
 def load_feature_from_file(image_paths, facial_image_extension,
@@ -57,11 +104,39 @@ def load_feature(facial_image_extension, feature_extension):
     image_paths_in_testing_dataset = prepare_data.get_image_paths_in_testing_dataset(
     )
 
-    # Load feature from file
-    training_image_feature_list = load_feature_from_file(image_paths_in_training_dataset, \
-                                                        facial_image_extension, feature_extension)
-    testing_image_feature_list = load_feature_from_file(image_paths_in_testing_dataset, \
-                                                        facial_image_extension, feature_extension)
+    # Build the feature store from the feature files when necessary
+    image_paths = image_paths_in_training_dataset + image_paths_in_testing_dataset
+    if not feature_store.is_feature_store_available(facial_image_extension,
+                                                    feature_extension):
+        feature_store.migrate_from_csv(image_paths, facial_image_extension,
+                                       feature_extension)
+
+    # Load feature from the quantized copy of the feature store, the feature store, or from file as a fallback
+    if FEATURE_STORE_CODEC_NAME is not None and feature_store.is_feature_store_available(
+            facial_image_extension, feature_extension):
+        if not feature_store.is_quantized_feature_store_available(
+                facial_image_extension, feature_extension,
+                FEATURE_STORE_CODEC_NAME):
+            feature_store.quantize_feature_store(facial_image_extension,
+                                                 feature_extension,
+                                                 FEATURE_STORE_CODEC_NAME)
+        return load_quantized_feature(image_paths_in_training_dataset,
+                                      training_image_index_list,
+                                      image_paths_in_testing_dataset,
+                                      facial_image_extension,
+                                      feature_extension)
+    elif feature_store.is_feature_store_available(facial_image_extension,
+                                                  feature_extension):
+        image_feature_list = feature_store.load_feature_from_store(
+            image_paths, facial_image_extension, feature_extension)
+    else:
+        image_feature_list = load_feature_from_file(image_paths,
+                                                    facial_image_extension,
+                                                    feature_extension)
+    training_image_feature_list = image_feature_list[
+        0:len(image_paths_in_training_dataset)]
+    testing_image_feature_list = image_feature_list[
+        len(image_paths_in_training_dataset):]
 
     # Omit possible None element in training image feature list
     valid_training_image_feature_list = []
@@ -84,43 +159,309 @@ def load_feature(facial_image_extension, feature_extension):
             testing_image_feature_dict)
 
 
-def get_record_map(index_array, true_false_ratio):
+def load_quantized_feature(image_paths_in_training_dataset,
+                           training_image_index_list,
+                           image_paths_in_testing_dataset,
+                           facial_image_extension, feature_extension):
+    """Load feature from the quantized copy of the feature store.
+    The features of the training images are kept as codes, and only decoded when they are selected.
+    
+    :param image_paths_in_training_dataset: the file paths of the training images
+    :type image_paths_in_training_dataset: list
+    :param training_image_index_list: the indexes of the training images
+    :type training_image_index_list: list
+    :param image_paths_in_testing_dataset: the file paths of the testing images
+    :type image_paths_in_testing_dataset: list
+    :param facial_image_extension: the extension of the facial images
+    :type facial_image_extension: string
+    :param feature_extension: the extension of the feature files
+    :type feature_extension: string
+    :return: the same as load_feature, while the training features are saved in feature_codec.Quantized_Feature_Array
+    :rtype: tuple
+    """
+
+    quantized_feature_array, image_path_to_row_dict, validity_array = feature_store.load_quantized_feature_store(
+        facial_image_extension, feature_extension, FEATURE_STORE_CODEC_NAME)
+
+    def get_valid_row_index(image_path):
+        row_index = image_path_to_row_dict.get(image_path)
+        if row_index is not None and validity_array[row_index]:
+            return row_index
+        return None
+
+    # Omit the training images without valid features
+    valid_row_index_list = []
+    valid_training_image_index_list = []
+    for image_path, training_image_index in zip(
+            image_paths_in_training_dataset, training_image_index_list):
+        row_index = get_valid_row_index(image_path)
+        if row_index is not None:
+            valid_row_index_list.append(row_index)
+            valid_training_image_index_list.append(training_image_index)
+    valid_training_image_feature_list = quantized_feature_array.select(
+        np.array(valid_row_index_list, dtype=np.int64))
+
+    # Generate a dictionary to save the testing image feature
+    testing_image_feature_dict = {}
+    for testing_image_path in image_paths_in_testing_dataset:
+        row_index = get_valid_row_index(testing_image_path)
+        testing_image_name = os.path.basename(testing_image_path)
+        testing_image_feature_dict[testing_image_name] = None if row_index is None \
+            else quantized_feature_array[row_index]
+
+    print("Feature loaded successfully.\n")
+    return (valid_training_image_feature_list, valid_training_image_index_list,
+            testing_image_feature_dict)
+
+
+def fit_projection(image_feature_list, selected_indexes):
+    """Fit the projection on the selected records if USE_FEATURE_PROJECTION is True.
+    It should only be fitted on the training records of a fold, so that the testing identities are held out.
+    
+    :param image_feature_list: the features of the images
+    :type image_feature_list: list or feature_codec.Quantized_Feature_Array
+    :param selected_indexes: the indexes of the selected records
+    :type selected_indexes: numpy array
+    :return: the fitted projection, None means the features are not projected
+    :rtype: feature_projection.Feature_Projection
+    """
+
+    if not USE_FEATURE_PROJECTION:
+        return None
+    return feature_projection.Feature_Projection().fit(
+        select_feature(image_feature_list, selected_indexes))
+
+
+def get_metric_list(metric_list, use_feature_projection=None):
+    """Get the metrics which are meaningful for the features in use.
+    The projected features are dense, so the boolean metrics would be constant and they are omitted.
+
+    :param metric_list: the metrics which will be used to compare two feature vectors
+    :type metric_list: list
+    :param use_feature_projection: whether the features are projected, None means USE_FEATURE_PROJECTION is used
+    :type use_feature_projection: boolean
+    :return: the selected metrics
+    :rtype: list
+    """
+
+    if use_feature_projection is None:
+        use_feature_projection = USE_FEATURE_PROJECTION
+    if not use_feature_projection:
+        return metric_list
+    return [
+        metric for metric in metric_list
+        if metric not in pairwise_metrics.BOOLEAN_METRIC_LIST
+    ]
+
+
+def generate_record_map_chunks(index_array, chunk_size=RECORD_MAP_CHUNK_SIZE):
+    """Generate the record map of all image pairs chunk by chunk.
+    The pairs follow the order of itertools.combinations.
+    
+    :param index_array: the indexes of the images
+    :type index_array: numpy array
+    :param chunk_size: the approximate number of pairs within each chunk
+    :type chunk_size: int
+    :return: record_index_pair_array refers to the indexes of the image pairs, 
+        while record_index_pair_label_array refers to whether these two images represent the same person.
+    :rtype: generator
+    """
+
+    record_num = index_array.size
+    if record_num < 2:
+        return
+
+    # The number of pairs which start with each record
+    pair_num_array = np.arange(record_num - 1, 0, -1)
+    pair_num_cumsum = np.cumsum(pair_num_array)
+
+    start_record_index = 0
+    while start_record_index < record_num - 1:
+        # Find the records whose pairs fit into current chunk
+        previous_pair_num = 0 if start_record_index == 0 else pair_num_cumsum[
+            start_record_index - 1]
+        end_record_index = np.searchsorted(pair_num_cumsum,
+                                           previous_pair_num + chunk_size,
+                                           side="right")
+        end_record_index = min(max(end_record_index, start_record_index + 1),
+                               record_num - 1)
+
+        # Generate the pairs which start with the selected records
+        selected_pair_num_array = pair_num_array[
+            start_record_index:end_record_index]
+        record_index_1_array = np.repeat(
+            np.arange(start_record_index, end_record_index),
+            selected_pair_num_array)
+        offset_array = np.arange(record_index_1_array.size) - np.repeat(
+            np.cumsum(selected_pair_num_array) - selected_pair_num_array,
+            selected_pair_num_array)
+        record_index_2_array = record_index_1_array + 1 + offset_array
+
+        record_index_pair_array = np.vstack(
+            (record_index_1_array, record_index_2_array)).T
+        record_index_pair_label_array = index_array[
+            record_index_1_array] == index_array[record_index_2_array]
+        yield (record_index_pair_array, record_index_pair_label_array)
+
+        start_record_index = end_record_index
+
+
+def get_positive_record_index_pair_array(index_array):
+    """Get the indexes of the image pairs which represent the same person.
+    
+    :param index_array: the indexes of the images
+    :type index_array: numpy array
+    :return: the indexes of the image pairs, sorted in the order of itertools.combinations
+    :rtype: numpy array
+    """
+
+    # Group the records which share the same index
+    sorted_record_indexes = np.argsort(index_array, kind="mergesort")
+    sorted_index_array = index_array[sorted_record_indexes]
+    group_start_array = np.flatnonzero(
+        np.hstack(([True], sorted_index_array[1:] != sorted_index_array[:-1])))
+    group_size_array = np.diff(np.hstack(
+        (group_start_array, [index_array.size])))
+
+    # Groups with the same size share the same local pair offsets
+    record_index_1_list = []
+    record_index_2_list = []
+    for group_size in np.unique(group_size_array[group_size_array > 1]):
+        selected_group_start_array = group_start_array[group_size_array ==
+                                                       group_size]
+        local_index_1_array, local_index_2_array = np.triu_indices(
+            group_size, 1)
+        record_index_1_list.append(sorted_record_indexes[(
+            selected_group_start_array[:, np.newaxis] +
+            local_index_1_array).ravel()])
+        record_index_2_list.append(sorted_record_indexes[(
+            selected_group_start_array[:, np.newaxis] +
+            local_index_2_array).ravel()])
+
+    if len(record_index_1_list) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    # Sort the pairs in the order of itertools.combinations
+    record_index_1_array = np.hstack(record_index_1_list)
+    record_index_2_array = np.hstack(record_index_2_list)
+    record_index_pair_array = np.vstack(
+        (np.minimum(record_index_1_array, record_index_2_array),
+         np.maximum(record_index_1_array, record_index_2_array))).T
+    order = np.lexsort(
+        (record_index_pair_array[:, 1], record_index_pair_array[:, 0]))
+    return record_index_pair_array[order]
+
+
+def sample_negative_record_index_pair_array(index_array,
+                                            sample_num,
+                                            random_seed=None):
+    """Sample the indexes of the image pairs which represent different persons.
+    The candidates are drawn by index arithmetic, so the full combination list is never materialised.
+    
+    :param index_array: the indexes of the images
+    :type index_array: numpy array
+    :param sample_num: the number of pairs which will be sampled
+    :type sample_num: int
+    :param random_seed: the seed of the random number generator, None means the global one is used
+    :type random_seed: int
+    :return: the indexes of the image pairs, without duplicates
+    :rtype: numpy array
+    """
+
+    record_num = index_array.size
+    unique_index_count_array = np.unique(index_array, return_counts=True)[1]
+    negative_pair_num = record_num * (record_num - 1) // 2 - np.sum(
+        unique_index_count_array * (unique_index_count_array - 1) // 2)
+    if sample_num > negative_pair_num:
+        raise ValueError(
+            "Cannot sample {:d} pairs out of {:d} negative pairs.".format(
+                sample_num, negative_pair_num))
+
+    random_state = np.random if random_seed is None else np.random.RandomState(
+        random_seed)
+
+    # Each pair is encoded as record_index_1 * record_num + record_index_2
+    selected_pair_key_array = np.zeros(0, dtype=np.int64)
+    while selected_pair_key_array.size < sample_num:
+        candidate_num = 2 * (sample_num - selected_pair_key_array.size) + 16
+        record_index_1_array = random_state.randint(0, record_num, candidate_num)
+        record_index_2_array = random_state.randint(0, record_num, candidate_num)
+
+        # Omit the pairs which represent the same person
+        valid_flag_array = index_array[record_index_1_array] != index_array[
+            record_index_2_array]
+        record_index_1_array = record_index_1_array[valid_flag_array]
+        record_index_2_array = record_index_2_array[valid_flag_array]
+
+        candidate_pair_key_array = np.minimum(record_index_1_array, record_index_2_array).astype(np.int64) * record_num + \
+            np.maximum(record_index_1_array, record_index_2_array)
+        selected_pair_key_array = np.union1d(selected_pair_key_array,
+                                             candidate_pair_key_array)
+
+    # Drop the surplus pairs at random
+    if selected_pair_key_array.size > sample_num:
+        selected_pair_key_array = random_state.choice(selected_pair_key_array,
+                                                      sample_num,
+                                                      replace=False)
+
+    return np.vstack((selected_pair_key_array // record_num,
+                      selected_pair_key_array % record_num)).T
+
+
+def get_record_map(index_array, true_false_ratio, random_seed=None):
     """Get record map.
     
     :param index_array: the indexes of the images
     :type index_array: numpy array
     :param true_false_ratio: the number of occurrences of true cases over the number of occurrences of false cases
     :type true_false_ratio: int or float
+    :param random_seed: the seed of the random number generator in sampling, None means the global one is used.
+        The sampled pairs with a given seed are saved as a pair manifest, and reused afterwards.
+    :type random_seed: int
     :return: record_index_pair_array refers to the indexes of the image pairs, 
         while record_index_pair_label_array refers to whether these two images represent the same person.
     :rtype: tuple
     """
 
-    # Generate record_index_pair_array and record_index_pair_label_array
-    record_index_pair_list = []
-    record_index_pair_label_list = []
-    for record_index_1, record_index_2 in itertools.combinations(
-            range(index_array.size), 2):
-        record_index_pair_list.append((record_index_1, record_index_2))
-        record_index_pair_label_list.append(
-            index_array[record_index_1] == index_array[record_index_2])
-    record_index_pair_array = np.array(record_index_pair_list)
-    record_index_pair_label_array = np.array(record_index_pair_label_list)
-
     # Do not need sampling
     if true_false_ratio is None:
+        record_map_chunks = list(generate_record_map_chunks(index_array))
+        if len(record_map_chunks) == 0:
+            return (np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=bool))
+        record_index_pair_array = np.vstack(
+            [chunk[0] for chunk in record_map_chunks])
+        record_index_pair_label_array = np.hstack(
+            [chunk[1] for chunk in record_map_chunks])
         return (record_index_pair_array, record_index_pair_label_array)
 
+    # Reuse the pair manifest which has been sampled with the same seed
+    manifest_key = None
+    if USE_PAIR_MANIFEST and random_seed is not None:
+        manifest_key = pair_manifest.get_manifest_key(index_array,
+                                                      true_false_ratio,
+                                                      random_seed)
+        record_map = pair_manifest.load_pair_manifest(manifest_key)
+        if record_map is not None:
+            return record_map
+
     # Perform sampling based on the true_false_ratio
-    pair_label_true_indexes = np.where(record_index_pair_label_array)[0]
-    pair_label_false_indexes = np.where(~record_index_pair_label_array)[0]
-    selected_pair_label_false_indexes = np.random.choice(pair_label_false_indexes, \
-                                                         1.0 * pair_label_true_indexes.size / true_false_ratio, \
-                                                         replace=False)
-    selected_pair_label_indexes = np.hstack(
-        (pair_label_true_indexes, selected_pair_label_false_indexes))
-    return (record_index_pair_array[selected_pair_label_indexes, :],
-            record_index_pair_label_array[selected_pair_label_indexes])
+    positive_record_index_pair_array = get_positive_record_index_pair_array(
+        index_array)
+    negative_record_index_pair_array = sample_negative_record_index_pair_array(
+        index_array,
+        int(1.0 * positive_record_index_pair_array.shape[0] /
+            true_false_ratio), random_seed)
+    record_index_pair_array = np.vstack(
+        (positive_record_index_pair_array, negative_record_index_pair_array))
+    record_index_pair_label_array = np.hstack(
+        (np.ones(positive_record_index_pair_array.shape[0], dtype=bool),
+         np.zeros(negative_record_index_pair_array.shape[0], dtype=bool)))
+
+    if manifest_key is not None:
+        pair_manifest.save_pair_manifest(manifest_key, record_index_pair_array,
+                                         record_index_pair_label_array)
+
+    return (record_index_pair_array, record_index_pair_label_array)
 
 
 def get_final_feature(feature_1, feature_2, metric_list):
@@ -139,21 +480,36 @@ def get_final_feature(feature_1, feature_2, metric_list):
     if feature_1 is None or feature_2 is None:
         return None
 
-    if metric_list is None:
-        return np.abs(feature_1 - feature_2)
+    final_feature_array = pairwise_metrics.compute_pairwise_metrics(
+        np.atleast_2d(feature_1), np.atleast_2d(feature_2), metric_list)
+    return final_feature_array[0]
 
-    final_feature_list = []
-    for metric in metric_list:
-        distance_matrix = pairwise_distances(np.vstack((feature_1, feature_2)),
-                                             metric=metric)
-        final_feature_list.append(distance_matrix[0, 1])
 
-    return np.array(final_feature_list)
+def select_feature(image_feature_list, selected_indexes):
+    """Select the features of some records, the quantized features are decoded on selection.
+    
+    :param image_feature_list: the features of the images
+    :type image_feature_list: list or feature_codec.Quantized_Feature_Array
+    :param selected_indexes: the indexes of the selected records
+    :type selected_indexes: numpy array
+    :return: the selected features, one row for each record
+    :rtype: numpy array
+    """
+
+    if isinstance(image_feature_list, feature_codec.Quantized_Feature_Array):
+        return image_feature_list[selected_indexes]
+    return np.asarray(image_feature_list)[selected_indexes, :]
 
 
-def convert_to_final_data_set(image_feature_list, image_index_list,
-                              selected_indexes, true_false_ratio, metric_list):
+def convert_to_final_data_set(image_feature_list,
+                              image_index_list,
+                              selected_indexes,
+                              true_false_ratio,
+                              metric_list,
+                              random_seed=None,
+                              projection=None):
     """Convert to final data set.
+    The deterministic data sets, i.e., either without sampling or with a given random_seed, are cached on disk.
     
     :param image_feature_list: the features of the images
     :type image_feature_list: list
@@ -165,50 +521,309 @@ def convert_to_final_data_set(image_feature_list, image_index_list,
     :type true_false_ratio: int or float
     :param metric_list: the metrics which will be used to compare two feature vectors
     :type metric_list: list
+    :param random_seed: the seed of the random number generator in sampling, None means the global one is used
+    :type random_seed: int
+    :param projection: the projection which is applied to the selected features, None means no projection
+    :type projection: feature_projection.Feature_Projection
     :return: feature_array refers to the feature difference between two images, 
         while label_array refers to whether these two images represent the same person.
     :rtype: tuple
     """
 
     # Retrieve the selected records
-    selected_feature_array = np.array(image_feature_list)[selected_indexes, :]
+    selected_feature_array = select_feature(image_feature_list,
+                                            selected_indexes)
+    if projection is not None:
+        selected_feature_array = projection.transform(selected_feature_array)
     selected_index_array = np.array(image_index_list)[selected_indexes]
 
-    # Get record map
-    pair_array, pair_label_array = get_record_map(selected_index_array,
-                                                  true_false_ratio)
+    # Load the final data set from the cache
+    cache_key = None
+    if USE_PAIR_FEATURE_CACHE and (true_false_ratio is None or
+                                   random_seed is not None):
+        cache_key = pair_feature_cache.get_cache_key(
+            selected_feature_array, selected_index_array, true_false_ratio,
+            metric_list, random_seed, HARD_NEGATIVE_PROPORTION)
+        final_data_set = pair_feature_cache.load_from_cache(cache_key)
+        if final_data_set is not None:
+            return final_data_set
+
+    # Get record map. All pairs are enumerated lazily when there is no sampling.
+    if true_false_ratio is None:
+        record_map_chunks = generate_record_map_chunks(selected_index_array)
+    else:
+        record_map = get_record_map(selected_index_array, true_false_ratio,
+                                    random_seed)
+        if HARD_NEGATIVE_PROPORTION > 0:
+            record_map = hard_negative_mining.replace_with_hard_negatives(
+                selected_feature_array, selected_index_array, record_map,
+                HARD_NEGATIVE_PROPORTION, random_seed)
+        record_map_chunks = [record_map]
 
     # Retrieve the final feature
     final_feature_list = []
-    for single_pair in pair_array:
-        final_feature = get_final_feature(\
-                                          selected_feature_array[single_pair[0], :], \
-                                          selected_feature_array[single_pair[1], :], \
-                                          metric_list)
-        final_feature_list.append(final_feature)
+    pair_label_list = []
+    for pair_array, pair_label_array in record_map_chunks:
+        final_feature_list.append(
+            pairwise_metrics.compute_pairwise_metrics_by_index(
+                selected_feature_array, pair_array[:, 0], pair_array[:, 1],
+                metric_list))
+        pair_label_list.append(pair_label_array)
+
+    # No chunk is generated if there are fewer than two records
+    if len(final_feature_list) == 0:
+        empty_index_array = np.zeros(0, dtype=np.int64)
+        final_feature_list.append(
+            pairwise_metrics.compute_pairwise_metrics_by_index(
+                selected_feature_array, empty_index_array, empty_index_array,
+                metric_list))
+        pair_label_list.append(np.zeros(0, dtype=bool))
+    final_data_set = (np.vstack(final_feature_list), np.hstack(pair_label_list))
+
+    # Save the final data set to the cache
+    if cache_key is not None:
+        pair_feature_cache.save_to_cache(cache_key, *final_data_set)
+
+    return final_data_set
+
+
+def init_fold_worker(feature_file_path,
+                     image_index_list,
+                     thread_num,
+                     codec=None):
+    """Init the worker process which trains the folds.
+    
+    :param feature_file_path: the path of the shared feature file
+    :type feature_file_path: string
+    :param image_index_list: the indexes of the images
+    :type image_index_list: list
+    :param thread_num: the number of threads of the numerical libraries
+    :type thread_num: int
+    :param codec: the codec if the shared feature file contains codes, otherwise None
+    :type codec: feature_codec.Feature_Codec
+    :return: the shared features and image indexes will be set
+    :rtype: None
+    """
+
+    global shared_feature_array, shared_image_index_list
+
+    common.limit_thread_num(thread_num)
+    shared_feature_array = np.load(feature_file_path, mmap_mode="r")
+    if codec is not None:
+        shared_feature_array = feature_codec.Quantized_Feature_Array(
+            codec, shared_feature_array)
+    shared_image_index_list = image_index_list
 
-    return (np.array(final_feature_list), pair_label_array)
 
+def perform_fold(fold_task):
+    """Train one fold with the shared features of the worker.
+    
+    :param fold_task: the function which trains one fold, the index of the fold, 
+        the indexes of the training and testing records, and the extra arguments of the function
+    :type fold_task: tuple
+    :return: the result of the function
+    :rtype: object
+    """
+
+    train_fold_func, fold_index, fold_item, fold_arguments = fold_task
+    return train_fold_func(shared_feature_array, shared_image_index_list,
+                           fold_index, fold_item, *fold_arguments)
+
+
+def perform_cross_validation(image_feature_list,
+                             image_index_list,
+                             fold_item_list,
+                             train_fold_func,
+                             fold_arguments=(),
+                             worker_num=FOLD_WORKER_NUM,
+                             thread_num=FOLD_WORKER_THREAD_NUM):
+    """Perform cross validation. The feature matrix is built once, and shared with the workers
+    via a memory-mapped file when the folds are trained in parallel.
+    
+    :param image_feature_list: the features of the images
+    :type image_feature_list: list or feature_codec.Quantized_Feature_Array
+    :param image_index_list: the indexes of the images
+    :type image_index_list: list
+    :param fold_item_list: the indexes of the training and testing records in each fold
+    :type fold_item_list: list
+    :param train_fold_func: the module-level function which trains one fold,
+        it is called with the feature matrix, image_index_list, the index of the fold, the fold item and fold_arguments
+    :type train_fold_func: object
+    :param fold_arguments: the extra arguments of train_fold_func
+    :type fold_arguments: tuple
+    :param worker_num: the number of processes which train the folds in parallel
+    :type worker_num: int
+    :param thread_num: the number of threads of the numerical libraries within each worker
+    :type thread_num: int
+    :return: the results of train_fold_func in the order of the folds
+    :rtype: list
+    """
+
+    # The quantized features are shared as codes
+    codec = None
+    if isinstance(image_feature_list, feature_codec.Quantized_Feature_Array):
+        feature_array = image_feature_list
+        codec = image_feature_list.codec
+    else:
+        feature_array = np.array(image_feature_list)
+    fold_task_list = [(train_fold_func, fold_index, fold_item, fold_arguments) \
+                      for fold_index, fold_item in enumerate(fold_item_list)]
+
+    # Add progress bar
+    progress_bar = pyprind.ProgBar(len(fold_task_list), monitor=True)
+
+    result_list = []
+    if worker_num == 1:
+        for _, fold_index, fold_item, _ in fold_task_list:
+            result_list.append(
+                train_fold_func(feature_array, image_index_list, fold_index,
+                                fold_item, *fold_arguments))
+
+            # Update progress bar
+            progress_bar.update()
+    else:
+        shared_folder_path = SHARED_MEMORY_FOLDER_PATH if os.path.isdir(
+            SHARED_MEMORY_FOLDER_PATH) else None
+        working_directory = tempfile.mkdtemp(prefix="cross_validation_",
+                                             dir=shared_folder_path)
+        try:
+            feature_file_path = os.path.join(working_directory, "feature.npy")
+            np.save(feature_file_path, feature_array
+                    if codec is None else feature_array.code_array)
+            del feature_array
+
+            # Start the workers from scratch rather than forking the parent which may hold a Keras session.
+            # The environment variables are inherited, so the numerical libraries start with the limited threads.
+            context = multiprocessing.get_context(
+                "spawn") if hasattr(multiprocessing,
+                                    "get_context") else multiprocessing
+            original_environment_dict = {
+                variable_name: os.environ.get(variable_name)
+                for variable_name in common.THREAD_NUM_VARIABLE_NAME_LIST
+            }
+            try:
+                for variable_name in common.THREAD_NUM_VARIABLE_NAME_LIST:
+                    os.environ[variable_name] = str(thread_num)
+                pool = context.Pool(
+                    processes=min(worker_num, len(fold_task_list)),
+                    initializer=init_fold_worker,
+                    initargs=(feature_file_path, image_index_list, thread_num,
+                              codec))
+            finally:
+                for variable_name, variable_value in original_environment_dict.items(
+                ):
+                    if variable_value is None:
+                        os.environ.pop(variable_name, None)
+                    else:
+                        os.environ[variable_name] = variable_value
+            try:
+                for result in pool.imap(perform_fold, fold_task_list):
+                    result_list.append(result)
+
+                    # Update progress bar
+                    progress_bar.update()
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(working_directory, ignore_errors=True)
+
+    # Report tracking information
+    print(progress_bar)
+
+    return result_list
+
+
+def get_testing_final_feature(testing_file_content,
+                              testing_image_feature_dict,
+                              metric_list,
+                              projection=None):
+    """Get the final feature of all pairs in the testing file.
+    
+    :param testing_file_content: the content in the testing file
+    :type testing_file_content: numpy array
+    :param testing_image_feature_dict: the features of the testing images which is saved in a dict
+    :type testing_image_feature_dict: dict
+    :param metric_list: the metrics which will be used to compare two feature vectors
+    :type metric_list: list
+    :param projection: the projection which is applied to the testing features, None means no projection
+    :type projection: feature_projection.Feature_Projection
+    :return: the final feature, one row for each pair
+    :rtype: numpy array
+    """
 
-def write_prediction(testing_file_content, prediction, prediction_file_name):
-    """Write prediction file to disk.
+    # Stack the testing image features and map the file names to rows
+    testing_image_name_list = sorted(testing_image_feature_dict.keys())
+    testing_image_feature_array = np.array([
+        testing_image_feature_dict[testing_image_name]
+        for testing_image_name in testing_image_name_list
+    ])
+    if projection is not None:
+        testing_image_feature_array = projection.transform(
+            testing_image_feature_array)
+    testing_image_name_to_row_dict = dict(
+        zip(testing_image_name_list, range(len(testing_image_name_list))))
+
+    index_array_1 = np.array([
+        testing_image_name_to_row_dict[file_1_name]
+        for file_1_name in testing_file_content[:, 1]
+    ])
+    index_array_2 = np.array([
+        testing_image_name_to_row_dict[file_2_name]
+        for file_2_name in testing_file_content[:, 2]
+    ])
+
+    return pairwise_metrics.compute_pairwise_metrics_by_index(
+        testing_image_feature_array, index_array_1, index_array_2, metric_list)
+
+
+def generate_prediction_in_batch(testing_file_content,
+                                 testing_final_feature_array,
+                                 predict_func,
+                                 prediction_file_name,
+                                 batch_size=PREDICTION_BATCH_SIZE):
+    """Generate prediction batch by batch and stream it to the prediction file.
     
     :param testing_file_content: the content in the testing file
     :type testing_file_content: numpy array
-    :param prediction: the prediction
-    :type prediction: numpy array
+    :param testing_final_feature_array: the final feature of all pairs in the testing file
+    :type testing_final_feature_array: numpy array
+    :param predict_func: the function object which returns the probability estimates of the positive class
+    :type predict_func: object
     :param prediction_file_name: the name of the prediciton file
     :type prediction_file_name: string
+    :param batch_size: the number of pairs which are predicted at once
+    :type batch_size: int
     :return: the prediction file will be saved to disk
     :rtype: None
     """
 
+    pair_num = testing_final_feature_array.shape[0]
+    batch_num = int(np.ceil(1.0 * pair_num / batch_size))
+
+    # Add progress bar
+    progress_bar = pyprind.ProgBar(batch_num, monitor=True)
+
     prediction_file_path = os.path.join(common.SUBMISSIONS_FOLDER_PATH,
                                         prediction_file_name)
-    prediction_file_content = pd.DataFrame({
-        "Id": testing_file_content[:, 0],
-        "Prediction": prediction
-    })
-    prediction_file_content.to_csv(prediction_file_path,
-                                   index=False,
-                                   header=True)
+    with open(prediction_file_path, "w") as prediction_file:
+        for start_index in range(0, pair_num, batch_size):
+            end_index = min(start_index + batch_size, pair_num)
+            prediction = predict_func(
+                testing_final_feature_array[start_index:end_index])
+
+            prediction_file_content = pd.DataFrame(
+                {
+                    "Id": testing_file_content[start_index:end_index, 0],
+                    "Prediction": prediction
+                },
+                columns=["Id", "Prediction"])
+            prediction_file_content.to_csv(prediction_file,
+                                           index=False,
+                                           header=start_index == 0)
+
+            # Update progress bar
+            progress_bar.update()
+
+    # Report tracking information
+    print(progress_bar)
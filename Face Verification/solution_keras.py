@@ -1,5 +1,6 @@
 from sklearn.cross_validation import LabelKFold
 import common
+import feature_projection
 import glob
 import itertools
 import keras_related
@@ -7,7 +8,6 @@ import numpy as np
 import os
 import pandas as pd
 import prepare_data
-import pyprind
 import solution_basic
 import time
 
@@ -19,6 +19,71 @@ METRIC_LIST_DICT = {
 
 NB_EPOCH_DICT = {"_open_face.csv": 5, "_vgg_face.csv": 5}
 
+# Whether the training pairs are generated batch by batch, so that the final data set is never materialised
+USE_PAIR_BATCH_GENERATOR = False
+
+
+def train_fold(feature_array, image_index_list, fold_index, fold_item,
+               working_directory, metric_list, nb_epoch):
+    """Train the Keras model of one fold.
+    
+    :param feature_array: the features of the images
+    :type feature_array: numpy array
+    :param image_index_list: the indexes of the images
+    :type image_index_list: list
+    :param fold_index: the index of the fold
+    :type fold_index: int
+    :param fold_item: the indexes of the training and testing records
+    :type fold_item: tuple
+    :param working_directory: the path of the working directory
+    :type working_directory: string
+    :param metric_list: the metrics which will be used to compare two feature vectors
+    :type metric_list: list
+    :param nb_epoch: the maximum number of epochs
+    :type nb_epoch: int
+    :return: best_score_index refers to the index of the best epoch, while best_score refers to the highest score
+    :rtype: tuple
+    """
+
+    print("\nWorking on the {:d} fold ...".format(fold_index + 1))
+
+    # Fit the projection on the training records only, so that the testing identities are held out
+    projection = solution_basic.fit_projection(feature_array, fold_item[0])
+
+    # Generate final data set. The negative pairs of the generator are sampled again in each epoch,
+    # so the pairs are never materialised and the pair feature cache does not apply.
+    if USE_PAIR_BATCH_GENERATOR:
+        selected_feature_array = solution_basic.select_feature(
+            feature_array, fold_item[0])
+        if projection is not None:
+            selected_feature_array = projection.transform(
+                selected_feature_array)
+        X_train = keras_related.Pair_Batch_Generator(
+            selected_feature_array,
+            np.array(image_index_list)[fold_item[0]],
+            metric_list,
+            1,
+            solution_basic.SAMPLING_SEED + fold_index,
+            hard_negative_proportion=solution_basic.HARD_NEGATIVE_PROPORTION)
+        Y_train = None
+    else:
+        X_train, Y_train = solution_basic.convert_to_final_data_set(
+            feature_array, image_index_list, fold_item[0], 1, metric_list,
+            solution_basic.SAMPLING_SEED + fold_index, projection)
+    X_test, Y_test = solution_basic.convert_to_final_data_set(
+        feature_array, image_index_list, fold_item[1], None, metric_list,
+        projection=projection)
+
+    # Perform training
+    model_name = "Model_{:d}".format(fold_index +
+                                     1) + common.KERAS_MODEL_EXTENSION
+    model_path = os.path.join(working_directory, model_name)
+    if projection is not None:
+        projection.save(
+            feature_projection.get_projection_file_path(model_path))
+    return keras_related.train_model(X_train, Y_train, X_test, Y_test,
+                                     model_path, nb_epoch)
+
 
 def perform_training(image_feature_list, image_index_list, description,
                      feature_extension, nb_epoch):
@@ -50,27 +115,13 @@ def perform_training(image_feature_list, image_index_list, description,
     best_score_index_array = np.zeros(fold_num)
     label_kfold = LabelKFold(image_index_list, n_folds=fold_num)
 
-    # Add progress bar
-    progress_bar = pyprind.ProgBar(fold_num, monitor=True)
-
-    metric_list = METRIC_LIST_DICT[feature_extension]
-    for fold_index, fold_item in enumerate(label_kfold):
-        print("\nWorking on the {:d}/{:d} fold ...".format(
-            fold_index + 1, fold_num))
+    metric_list = solution_basic.get_metric_list(
+        METRIC_LIST_DICT[feature_extension])
+    result_list = solution_basic.perform_cross_validation(
+        image_feature_list, image_index_list, list(label_kfold), train_fold,
+        (working_directory, metric_list, nb_epoch))
 
-        # Generate final data set
-        X_train, Y_train = solution_basic.convert_to_final_data_set(
-            image_feature_list, image_index_list, fold_item[0], 1, metric_list)
-        X_test, Y_test = solution_basic.convert_to_final_data_set(
-            image_feature_list, image_index_list, fold_item[1], None,
-            metric_list)
-
-        # Perform training
-        model_name = "Model_{:d}".format(fold_index +
-                                         1) + common.KERAS_MODEL_EXTENSION
-        model_path = os.path.join(working_directory, model_name)
-        best_score_index, best_score = keras_related.train_model(
-            X_train, Y_train, X_test, Y_test, model_path, nb_epoch)
+    for fold_index, (best_score_index, best_score) in enumerate(result_list):
         best_score_array[fold_index] = best_score
         best_score_index_array[fold_index] = best_score_index
 
@@ -78,12 +129,6 @@ def perform_training(image_feature_list, image_index_list, description,
             "For the {:d} fold, the Keras model achieved the score {:.4f} at the {:d} epoch."
             .format(fold_index + 1, best_score, best_score_index))
 
-        # Update progress bar
-        progress_bar.update()
-
-    # Report tracking information
-    print(progress_bar)
-
     print("\nThe best score is {:.4f} and the highest epoch is {:d}.".format(
         np.max(best_score_array),
         np.max(best_score_index_array).astype(np.int)))
@@ -91,7 +136,8 @@ def perform_training(image_feature_list, image_index_list, description,
 
 def generate_prediction(description, testing_file_content,
                         testing_image_feature_dict, prediction_file_prefix,
-                        feature_extension):
+                        feature_extension,
+                        batch_size=solution_basic.PREDICTION_BATCH_SIZE):
     """Generate prediction.
     
     :param description: the folder name of the working directory
@@ -104,6 +150,8 @@ def generate_prediction(description, testing_file_content,
     :type prediction_file_prefix: string
     :param feature_extension: the extension of the feature files
     :type feature_extension: string
+    :param batch_size: the number of pairs which are predicted at once
+    :type batch_size: int
     :return: the prediction file will be saved to disk
     :rtype: None
     """
@@ -113,49 +161,46 @@ def generate_prediction(description, testing_file_content,
     working_directory = common.get_working_directory(description)
     model_path_rule = os.path.join(working_directory,
                                    "*" + common.KERAS_MODEL_EXTENSION)
-    metric_list = METRIC_LIST_DICT[feature_extension]
+    # The final feature of all pairs is computed once for the models without projection
+    testing_final_feature_array = None
+
     for model_path in sorted(glob.glob(model_path_rule)):
         model_name = os.path.basename(os.path.splitext(model_path)[0])
         print("\nWorking on {} ...".format(model_name))
 
+        # Apply the projection which was fitted together with the model
+        projection = feature_projection.load_projection(model_path)
+        metric_list = solution_basic.get_metric_list(
+            METRIC_LIST_DICT[feature_extension], projection is not None)
+        if projection is not None:
+            model_testing_final_feature_array = solution_basic.get_testing_final_feature(
+                testing_file_content, testing_image_feature_dict, metric_list,
+                projection)
+        else:
+            if testing_final_feature_array is None:
+                testing_final_feature_array = solution_basic.get_testing_final_feature(
+                    testing_file_content, testing_image_feature_dict,
+                    metric_list)
+            model_testing_final_feature_array = testing_final_feature_array
+
         # Init a keras model with specific weights
-        final_feature = solution_basic.get_final_feature(
-            testing_image_feature_dict.values()[0],
-            testing_image_feature_dict.values()[0], metric_list)
-        dimension = final_feature.size
-        model = keras_related.init_model(dimension)
+        model = keras_related.init_model(
+            model_testing_final_feature_array.shape[1])
         model.load_weights(model_path)
 
-        # Add progress bar
-        progress_bar = pyprind.ProgBar(testing_file_content.shape[0],
-                                       monitor=True)
-
         # Generate prediction
-        prediction_list = []
-        for _, file_1_name, file_2_name in testing_file_content:
-            file_1_feature = testing_image_feature_dict[file_1_name]
-            file_2_feature = testing_image_feature_dict[file_2_name]
-            final_feature = solution_basic.get_final_feature(
-                file_1_feature, file_2_feature, metric_list)
-            final_feature = final_feature.reshape(1, -1)
-
-            probability_estimates = model.predict_proba(final_feature,
-                                                        verbose=0)
-            prediction = probability_estimates[0, 1]
-            prediction_list.append(prediction)
-
-            # Update progress bar
-            progress_bar.update()
-
-        # Report tracking information
-        print(progress_bar)
-
-        # Write prediction
+        def predict_func(final_feature_array):
+            probability_estimates = model.predict_proba(
+                final_feature_array,
+                batch_size=final_feature_array.shape[0],
+                verbose=0)
+            return probability_estimates[:, 1]
+
         prediction_file_name = prediction_file_prefix + model_name + "_" + str(
             int(time.time())) + ".csv"
-        solution_basic.write_prediction(testing_file_content,
-                                        np.array(prediction_list),
-                                        prediction_file_name)
+        solution_basic.generate_prediction_in_batch(
+            testing_file_content, model_testing_final_feature_array,
+            predict_func, prediction_file_name, batch_size)
 
 
 def make_prediction(facial_image_extension, feature_extension):
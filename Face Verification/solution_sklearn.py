@@ -1,13 +1,13 @@
 from sklearn.cross_validation import LabelKFold
 from sklearn.externals import joblib
 import common
+import feature_projection
 import glob
 import itertools
 import numpy as np
 import os
 import pandas as pd
 import prepare_data
-import pyprind
 import sklearn_related
 import solution_basic
 import time
@@ -19,6 +19,50 @@ METRIC_LIST_DICT = {
                     "correlation", "russellrao", "matching", "sokalmichener", "rogerstanimoto"]}
 
 
+def train_fold(feature_array, image_index_list, fold_index, fold_item,
+               working_directory, metric_list):
+    """Train the scikit-learn model of one fold.
+    
+    :param feature_array: the features of the images
+    :type feature_array: numpy array
+    :param image_index_list: the indexes of the images
+    :type image_index_list: list
+    :param fold_index: the index of the fold
+    :type fold_index: int
+    :param fold_item: the indexes of the training and testing records
+    :type fold_item: tuple
+    :param working_directory: the path of the working directory
+    :type working_directory: string
+    :param metric_list: the metrics which will be used to compare two feature vectors
+    :type metric_list: list
+    :return: the highest score
+    :rtype: float
+    """
+
+    print("\nWorking on the {:d} fold ...".format(fold_index + 1))
+
+    # Fit the projection on the training records only, so that the testing identities are held out
+    projection = solution_basic.fit_projection(feature_array, fold_item[0])
+
+    # Generate final data set
+    X_train, Y_train = solution_basic.convert_to_final_data_set(
+        feature_array, image_index_list, fold_item[0], 1, metric_list,
+        solution_basic.SAMPLING_SEED + fold_index, projection)
+    X_test, Y_test = solution_basic.convert_to_final_data_set(
+        feature_array, image_index_list, fold_item[1], None, metric_list,
+        projection=projection)
+
+    # Perform training
+    model_name = "Model_{:d}".format(fold_index +
+                                     1) + common.SCIKIT_LEARN_EXTENSION
+    model_path = os.path.join(working_directory, model_name)
+    if projection is not None:
+        projection.save(
+            feature_projection.get_projection_file_path(model_path))
+    return sklearn_related.train_model(X_train, Y_train, X_test, Y_test,
+                                       model_path)
+
+
 def perform_training(image_feature_list, image_index_list, description,
                      feature_extension):
     """Perform training phase.
@@ -46,44 +90,25 @@ def perform_training(image_feature_list, image_index_list, description,
     best_score_array = np.zeros(fold_num)
     label_kfold = LabelKFold(image_index_list, n_folds=fold_num)
 
-    # Add progress bar
-    progress_bar = pyprind.ProgBar(fold_num, monitor=True)
-
-    metric_list = METRIC_LIST_DICT[feature_extension]
-    for fold_index, fold_item in enumerate(label_kfold):
-        print("\nWorking on the {:d}/{:d} fold ...".format(
-            fold_index + 1, fold_num))
-
-        # Generate final data set
-        X_train, Y_train = solution_basic.convert_to_final_data_set(
-            image_feature_list, image_index_list, fold_item[0], 1, metric_list)
-        X_test, Y_test = solution_basic.convert_to_final_data_set(
-            image_feature_list, image_index_list, fold_item[1], None,
-            metric_list)
-
-        # Perform training
-        model_name = "Model_{:d}".format(fold_index +
-                                         1) + common.SCIKIT_LEARN_EXTENSION
-        model_path = os.path.join(working_directory, model_name)
-        best_score = sklearn_related.train_model(X_train, Y_train, X_test,
-                                                 Y_test, model_path)
+    metric_list = solution_basic.get_metric_list(
+        METRIC_LIST_DICT[feature_extension])
+    result_list = solution_basic.perform_cross_validation(
+        image_feature_list, image_index_list, list(label_kfold), train_fold,
+        (working_directory, metric_list))
+
+    for fold_index, best_score in enumerate(result_list):
         best_score_array[fold_index] = best_score
 
         print("For the {:d} fold, the sklearn model achieved the score {:.4f}.".
               format(fold_index + 1, best_score))
 
-        # Update progress bar
-        progress_bar.update()
-
-    # Report tracking information
-    print(progress_bar)
-
     print("\nThe best score is {:.4f}.".format(np.max(best_score_array)))
 
 
 def generate_prediction(description, testing_file_content,
                         testing_image_feature_dict, prediction_file_prefix,
-                        feature_extension):
+                        feature_extension,
+                        batch_size=solution_basic.PREDICTION_BATCH_SIZE):
     """Generate prediction.
     
     :param description: the folder name of the working directory
@@ -96,6 +121,8 @@ def generate_prediction(description, testing_file_content,
     :type prediction_file_prefix: string
     :param feature_extension: the extension of the feature files
     :type feature_extension: string
+    :param batch_size: the number of pairs which are predicted at once
+    :type batch_size: int
     :return: the prediction file will be saved to disk
     :rtype: None
     """
@@ -105,43 +132,42 @@ def generate_prediction(description, testing_file_content,
     working_directory = common.get_working_directory(description)
     model_path_rule = os.path.join(working_directory,
                                    "*" + common.SCIKIT_LEARN_EXTENSION)
-    metric_list = METRIC_LIST_DICT[feature_extension]
+    # The final feature of all pairs is computed once for the models without projection
+    testing_final_feature_array = None
+
     for model_path in sorted(glob.glob(model_path_rule)):
         model_name = os.path.basename(os.path.splitext(model_path)[0])
         print("\nWorking on {} ...".format(model_name))
 
+        # Apply the projection which was fitted together with the model
+        projection = feature_projection.load_projection(model_path)
+        metric_list = solution_basic.get_metric_list(
+            METRIC_LIST_DICT[feature_extension], projection is not None)
+        if projection is not None:
+            model_testing_final_feature_array = solution_basic.get_testing_final_feature(
+                testing_file_content, testing_image_feature_dict, metric_list,
+                projection)
+        else:
+            if testing_final_feature_array is None:
+                testing_final_feature_array = solution_basic.get_testing_final_feature(
+                    testing_file_content, testing_image_feature_dict,
+                    metric_list)
+            model_testing_final_feature_array = testing_final_feature_array
+
         # Load the sklearn model
         classifier = joblib.load(model_path)
 
-        # Add progress bar
-        progress_bar = pyprind.ProgBar(testing_file_content.shape[0],
-                                       monitor=True)
-
         # Generate prediction
-        prediction_list = []
-        for _, file_1_name, file_2_name in testing_file_content:
-            file_1_feature = testing_image_feature_dict[file_1_name]
-            file_2_feature = testing_image_feature_dict[file_2_name]
-            final_feature = solution_basic.get_final_feature(
-                file_1_feature, file_2_feature, metric_list)
-            final_feature = final_feature.reshape(1, -1)
-
-            probability_estimates = classifier.predict_proba(final_feature)
-            prediction = probability_estimates[0, 1]
-            prediction_list.append(prediction)
-
-            # Update progress bar
-            progress_bar.update()
-
-        # Report tracking information
-        print(progress_bar)
+        def predict_func(final_feature_array):
+            probability_estimates = classifier.predict_proba(
+                final_feature_array)
+            return probability_estimates[:, 1]
 
-        # Write prediction
         prediction_file_name = prediction_file_prefix + model_name + "_" + str(
             int(time.time())) + ".csv"
-        solution_basic.write_prediction(testing_file_content,
-                                        np.array(prediction_list),
-                                        prediction_file_name)
+        solution_basic.generate_prediction_in_batch(
+            testing_file_content, model_testing_final_feature_array,
+            predict_func, prediction_file_name, batch_size)
 
 
 def make_prediction(facial_image_extension, feature_extension):
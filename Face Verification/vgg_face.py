@@ -1,16 +1,38 @@
-import caffe
 import common
 import cv2
 import numpy as np
 import os
 
+# Whether Caffe runs on GPU, it is set in init_vgg_face_module
+use_gpu_mode = True
 
-def init_vgg_face_module():
-    """Initiate the vgg face module."""
 
-    global net
+def set_caffe_mode():
+    """Set the execution mode of Caffe in the current thread, since it is thread-local in Caffe.
+    
+    :return: the execution mode will be set
+    :rtype: None
+    """
+
+    import caffe
+
+    if use_gpu_mode:
+        caffe.set_mode_gpu()
+    else:
+        caffe.set_mode_cpu()
+
+
+def init_vgg_face_module(use_gpu=True):
+    """Initiate the vgg face module.
+    
+    :param use_gpu: whether run the Caffe network on GPU
+    :type use_gpu: boolean
+    """
+
+    global net, use_gpu_mode
 
-    caffe.set_mode_gpu()
+    use_gpu_mode = use_gpu
+    set_caffe_mode()
 
     model_definition_file_path = os.path.join(common.VGG_FACE_PATH,
                                               common.MODEL_DEFINITION_FILE_NAME)
@@ -24,6 +46,70 @@ def init_vgg_face_module():
                            mean=mean_content)
 
 
+def convert_facial_image_for_vgg_face(facial_image):
+    """Convert the facial image to the input of vgg face.
+    
+    :param facial_image: the facial image
+    :type facial_image: numpy array
+    :return: the resized facial image, None refers to a failure
+    :rtype: numpy array
+    """
+
+    try:
+        facial_image = cv2.resize(facial_image,
+                                  dsize=(common.VGG_FACE_IMAGE_SIZE,
+                                         common.VGG_FACE_IMAGE_SIZE))
+        return facial_image.astype(np.float32)
+    except:
+        return None
+
+
+def load_facial_image_for_vgg_face(facial_image_path):
+    """Load the facial image and convert it to the input of vgg face.
+    
+    :param facial_image_path: the path of the facial image
+    :type facial_image_path: string
+    :return: the resized facial image, None refers to a failure
+    :rtype: numpy array
+    """
+
+    try:
+        assert os.path.isfile(facial_image_path)
+        return convert_facial_image_for_vgg_face(cv2.imread(facial_image_path))
+    except:
+        return None
+
+
+def retrieve_features_by_vgg_face(facial_image_list):
+    """Retrieve the deep features of a batch of facial images by using vgg face.
+    The whole batch goes through the network in one forward pass.
+    
+    :param facial_image_list: the facial images returned by load_facial_image_for_vgg_face
+    :type facial_image_list: list
+    :return: the deep features, one row for each facial image
+    :rtype: numpy array
+    """
+
+    # The forward pass may run in another thread than the initiation
+    set_caffe_mode()
+
+    # Resize the input blob to the size of the batch
+    input_name = net.inputs[0]
+    input_shape = net.blobs[input_name].data.shape
+    if input_shape[0] != len(facial_image_list):
+        net.blobs[input_name].reshape(len(facial_image_list),
+                                      *input_shape[1:])
+        net.reshape()
+
+    caffe_input = np.array([
+        net.transformer.preprocess(input_name, facial_image)
+        for facial_image in facial_image_list
+    ])
+    output_blob_dict = net.forward_all(blobs=["fc7"],
+                                       **{input_name: caffe_input})
+    return np.array(output_blob_dict["fc7"])
+
+
 def retrieve_feature_by_vgg_face(facial_image_path, feature_file_path):
     """Retrieve the deep feature by using vgg face.
     
@@ -42,14 +128,9 @@ def retrieve_feature_by_vgg_face(facial_image_path, feature_file_path):
             return feature
 
         # Retrieve feature
-        assert os.path.isfile(facial_image_path)
-        facial_image = cv2.imread(facial_image_path)
-        facial_image = cv2.resize(facial_image,
-                                  dsize=(common.VGG_FACE_IMAGE_SIZE,
-                                         common.VGG_FACE_IMAGE_SIZE))
-        facial_image = facial_image.astype(np.float32)
-        _ = net.predict([facial_image], oversample=False).ravel()
-        feature = net.blobs["fc7"].data[0]
+        facial_image = load_facial_image_for_vgg_face(facial_image_path)
+        assert facial_image is not None
+        feature = retrieve_features_by_vgg_face([facial_image])[0]
 
         # Successful case. Save feature to file.
         assert feature is not None